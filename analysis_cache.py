@@ -0,0 +1,197 @@
+"""
+顔相分析結果のディスクキャッシュ
+Content-addressed, disk-backed cache for face analysis results
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_MAX_ENTRIES = int(os.environ.get("FENGSHUI_CACHE_MAX_ENTRIES", "1000"))
+DEFAULT_MAX_BYTES = int(os.environ.get("FENGSHUI_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+DEFAULT_TTL_SECONDS = float(os.environ.get("FENGSHUI_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def make_cache_key(image_hash: str, prompt_version: str, model_name: str) -> str:
+    """画像ハッシュ・プロンプト版・モデル名からキャッシュキーを生成"""
+    raw = f"{image_hash}|{prompt_version}|{model_name}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """キー（内容ハッシュ）ごとに1ファイルで保存するLRU + TTLキャッシュ"""
+
+    def __init__(
+        self,
+        directory: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        # key -> (最終アクセス時刻, ファイルサイズ)
+        self._index: Optional[dict] = None
+        self._total_bytes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self) -> None:
+        """初回アクセス時にディレクトリを走査してインデックスを構築"""
+        if self._index is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._index = {}
+        self._total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            self._index[entry.name[:-5]] = (stat.st_mtime, stat.st_size)
+            self._total_bytes += stat.st_size
+
+    def _remove(self, key: str) -> None:
+        _, size = self._index.pop(key, (0, 0))
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[dict]:
+        """キャッシュから取得（期限切れ・未登録ならNone）"""
+        with self._lock:
+            value = self._read(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def get_first(self, keys: list) -> Optional[dict]:
+        """複数キーを順に探し、最初に見つかった値を返す（ヒット・ミスは1回と数える）"""
+        with self._lock:
+            for key in keys:
+                value = self._read(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def _read(self, key: str) -> Optional[dict]:
+        """ロック取得済みの状態で1エントリを読み込む"""
+        self._load_index()
+        if key not in self._index:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            # 他プロセスによる削除や壊れたファイルはミス扱い
+            self._remove(key)
+            return None
+
+        if time.time() - payload.get("created_at", 0) > self.ttl_seconds:
+            self._remove(key)
+            self.expirations += 1
+            return None
+
+        now = time.time()
+        try:
+            os.utime(self._path(key), (now, now))
+        except OSError:
+            pass
+        self._index[key] = (now, self._index[key][1])
+        return payload["value"]
+
+    def set(self, key: str, value: dict) -> None:
+        """キャッシュに保存し、上限を超えたら古いものから削除"""
+        data = json.dumps(
+            {"created_at": time.time(), "value": value}, ensure_ascii=False
+        ).encode("utf-8")
+        with self._lock:
+            self._load_index()
+            if key in self._index:
+                self._remove(key)
+
+            # 一時ファイルに書いてからリネーム（並行プロセスでも壊れない）
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except OSError:
+                logging.warning(f"Cache write failed for key {key}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                return
+
+            self._index[key] = (time.time(), len(data))
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        """件数・サイズ上限を超えた分を最終アクセスの古い順に削除"""
+        if len(self._index) <= self.max_entries and self._total_bytes <= self.max_bytes:
+            return
+        for key, _ in sorted(self._index.items(), key=lambda item: item[1][0]):
+            if (
+                len(self._index) <= self.max_entries
+                and self._total_bytes <= self.max_bytes
+            ):
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """全エントリを削除"""
+        with self._lock:
+            self._load_index()
+            for key in list(self._index):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        """ヒット・ミス数などの統計を返す"""
+        with self._lock:
+            entries = len(self._index) if self._index is not None else 0
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": entries,
+                "bytes": self._total_bytes,
+            }
+
+
+_default_cache: Optional[AnalysisCache] = None
+
+
+def get_analysis_cache() -> AnalysisCache:
+    """プロセス共通のデフォルトキャッシュを返す"""
+    global _default_cache
+    if _default_cache is None:
+        cache_dir = os.environ.get("FENGSHUI_CACHE_DIR") or os.path.join(
+            os.getcwd(), "cache"
+        )
+        _default_cache = AnalysisCache(cache_dir)
+    return _default_cache
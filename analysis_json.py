@@ -0,0 +1,201 @@
+"""
+Geminiの応答テキストからのJSON抽出
+JSON extraction helpers for Gemini responses, including incremental parsing
+"""
+
+import json
+import re
+
+_FENCED_JSON = re.compile(r"```json\s*(.*?)\s*```", re.DOTALL)
+_WHITESPACE_AND_COMMAS = " \t\r\n,"
+
+
+def extract_json_text(response_text: str) -> str:
+    """```json ... ``` で囲まれていればその中身を、なければ全体を返す"""
+    json_match = _FENCED_JSON.search(response_text)
+    if json_match:
+        return json_match.group(1)
+    return response_text
+
+
+class IncrementalObjectParser:
+    """ストリームで届くJSONオブジェクトを、完成したトップレベルの項目から順に取り出す
+
+    数値など値の終わりが曖昧なものは、後ろに , か } が届いた時点で完成とみなす。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = None
+        self._decoder = json.JSONDecoder()
+        self.fields = {}
+        self.finished = False
+
+    def _skip(self, index: int, chars: str = _WHITESPACE_AND_COMMAS) -> int:
+        while index < len(self._buffer) and self._buffer[index] in chars:
+            index += 1
+        return index
+
+    def feed(self, text: str) -> list:
+        """テキストを追加し、新たに完成した (キー, 値) の一覧を返す"""
+        self._buffer += text
+        completed = []
+        if self._pos is None:
+            start = self._buffer.find("{")
+            if start < 0:
+                return completed
+            self._pos = start + 1
+
+        while not self.finished:
+            index = self._skip(self._pos)
+            if index >= len(self._buffer):
+                break
+            if self._buffer[index] == "}":
+                self.finished = True
+                break
+            try:
+                key, index = self._decoder.raw_decode(self._buffer, index)
+            except json.JSONDecodeError:
+                break
+            index = self._skip(index, " \t\r\n")
+            if index >= len(self._buffer) or self._buffer[index] != ":":
+                break
+            index = self._skip(index + 1, " \t\r\n")
+            if index >= len(self._buffer):
+                break
+            try:
+                value, index = self._decoder.raw_decode(self._buffer, index)
+            except json.JSONDecodeError:
+                break
+            index = self._skip(index, " \t\r\n")
+            if index >= len(self._buffer) or self._buffer[index] not in ",}":
+                break
+            self.fields[key] = value
+            completed.append((key, value))
+            self._pos = index
+        return completed
+
+
+class AnalysisParseError(ValueError):
+    """修復しても応答テキストをJSONオブジェクトとして解釈できない"""
+
+
+def repair_json_text(text: str, opening: str = "{") -> str:
+    """よくある崩れを修復したJSONテキストを返す
+
+    前後の説明文、末尾のカンマ、文字列中の生の改行、途中で切れた応答
+    （閉じていない文字列・括弧）に対応する。配列を修復する場合は opening="["。
+    """
+    start = text.find(opening)
+    if start < 0:
+        kind = "array" if opening == "[" else "object"
+        raise AnalysisParseError(f"no JSON {kind} found")
+
+    out = []
+    stack = []
+    # 各カンマの位置と、その時点で閉じる必要のある括弧（切り詰め用）
+    commas = []
+    in_string = False
+    escape = False
+    for ch in text[start:]:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            if stack and stack[-1] == ch:
+                stack.pop()
+                out.append(ch)
+            if not stack:
+                # 最初のオブジェクトが閉じたら、後ろの説明文は捨てる
+                break
+        elif ch == ",":
+            commas.append((len(out), list(stack)))
+            out.append(ch)
+        else:
+            out.append(ch)
+
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+    _strip_trailing_comma(out)
+    repaired = "".join(out) + "".join(reversed(stack))
+    if _is_valid_json(repaired):
+        return repaired
+
+    # 最後の項目が途中で切れている場合は、直前のカンマまで戻して閉じる
+    for position, open_brackets in reversed(commas):
+        candidate = "".join(out[:position]) + "".join(reversed(open_brackets))
+        if _is_valid_json(candidate):
+            return candidate
+    return repaired
+
+
+def _strip_trailing_comma(out: list) -> None:
+    index = len(out) - 1
+    while index >= 0 and out[index] in " \t\r\n":
+        index -= 1
+    if index >= 0 and out[index] == ",":
+        del out[index]
+
+
+def _is_valid_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_json_object(response_text: str) -> dict:
+    """応答テキストをJSONオブジェクトとして解析（失敗時は修復を試みる）"""
+    json_text = extract_json_text(response_text)
+    try:
+        result = json.loads(json_text)
+    except ValueError:
+        try:
+            result = json.loads(repair_json_text(json_text))
+        except ValueError as e:
+            raise AnalysisParseError(f"unparseable response: {str(e)}") from e
+    if not isinstance(result, dict):
+        raise AnalysisParseError(f"expected a JSON object, got {type(result).__name__}")
+    return result
+
+
+def parse_json_array(response_text: str) -> list:
+    """応答テキストをJSON配列として解析（失敗時は修復を試みる）
+
+    {"results": [...]} のように配列を1つだけ持つオブジェクトで返された場合は中身を返す。
+    途中で切れた応答では、最後の要素の項目が欠けていることがある。
+    """
+    json_text = extract_json_text(response_text)
+    try:
+        result = json.loads(json_text)
+    except ValueError:
+        opening = "[" if "[" in json_text else "{"
+        try:
+            result = json.loads(repair_json_text(json_text, opening))
+        except ValueError as e:
+            raise AnalysisParseError(f"unparseable response: {str(e)}") from e
+    if isinstance(result, dict):
+        lists = [value for value in result.values() if isinstance(value, list)]
+        if len(lists) == 1:
+            result = lists[0]
+    if not isinstance(result, list):
+        raise AnalysisParseError(f"expected a JSON array, got {type(result).__name__}")
+    return result
@@ -0,0 +1,526 @@
+"""
+風水診断のHTTP API
+Async HTTP service exposing the analyzer to other clients
+
+使い方:
+    GEMINI_API_KEY=... python api_server.py --port 8080 --workers 8
+    curl -F birthdate=1994-01-01 -F images=@a.jpg -F images=@b.jpg \\
+        http://127.0.0.1:8080/v1/report
+
+エンドポイント:
+    POST /v1/analyze  画像1枚（image）の顔相分析
+    POST /v1/report   画像2枚以上（images）と生年月日（birthdate）から順位付きレポート
+    GET  /v1/history  過去のレポートの候補者（birthdate・element・days・order・limit で検索）
+    GET  /healthz     稼働状況（ワーカーと待ち行列の状態）
+    GET  /metrics     Prometheus形式のメトリクス（FENGSHUI_METRICS=1 または --metrics）
+
+tier=scores を指定すると顔の形とスコアだけを求める短い分析で順位付けする。
+/v1/report では detail_top=N を合わせて指定すると、上位N人だけを詳細に分析し直す。
+
+分析は固定数のワーカーで処理し、待ち行列が満杯なら 503 を返す。リクエストごとの
+期限（X-Request-Timeout ヘッダーまたは timeout フィールド、秒）を過ぎた場合は
+未完了の分析を取り消して 504 を返す。クライアントが切断した場合も取り消す。
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import time
+from datetime import date, datetime
+from functools import partial
+from typing import Callable
+
+from aiohttp import web
+from PIL import Image, UnidentifiedImageError
+
+from fengshui_analyzer import (
+    ANALYSIS_TIERS,
+    MODELS_TO_TRY,
+    TIER_FULL,
+    analyze_face_fengshui,
+    configure_logging,
+    default_candidate_name,
+    is_failed_analysis,
+    rank_candidates,
+    save_report_history,
+    select_detail_candidates,
+)
+from metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS_TOTAL, get_metrics
+from model_router import get_model_router
+from rate_limiter import QuotaExceededError
+from result_store import ORDER_COLUMNS, get_result_store
+from single_flight import get_single_flight
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = int(os.environ.get("FENGSHUI_SERVER_WORKERS", "8"))
+DEFAULT_QUEUE_SIZE = int(os.environ.get("FENGSHUI_SERVER_QUEUE_SIZE", "64"))
+DEFAULT_REQUEST_TIMEOUT = float(os.environ.get("FENGSHUI_REQUEST_TIMEOUT", "60"))
+MAX_REQUEST_TIMEOUT = 300.0
+# 1リクエストの最大サイズ（multipart 全体）
+MAX_UPLOAD_BYTES = int(
+    float(os.environ.get("FENGSHUI_MAX_UPLOAD_MB", "40")) * 1024 * 1024
+)
+# 1回のレポートで順位付けする最大人数
+MAX_CANDIDATES = 20
+# 待ち行列が満杯のときにクライアントへ伝える再試行までの秒数
+RETRY_AFTER_SECONDS = 5
+# 履歴検索で返す最大件数
+MAX_HISTORY_LIMIT = 500
+
+_dumps = partial(json.dumps, ensure_ascii=False)
+
+
+class PoolFullError(Exception):
+    """待ち行列に空きがないときに送出"""
+
+
+class DeadlineExceededError(Exception):
+    """リクエストの期限までに分析が終わらなかったときに送出"""
+
+
+class RequestError(Exception):
+    """リクエストの内容が不正なときに送出（400）"""
+
+
+class AnalysisPool:
+    """分析ジョブを固定数のワーカーで処理する待ち行列
+
+    submit_all() は結果を受け取る Future を返す。Future を取り消すと、待ち行列の
+    ジョブは実行されず、実行中のジョブはタスクごと取り消される。
+    """
+
+    def __init__(
+        self, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue: asyncio.Queue = None
+        self._workers = []
+        self._running = set()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"analysis-worker-{index}")
+            for index in range(self.workers)
+        ]
+
+    async def stop(self) -> None:
+        """ワーカーと実行中のジョブを止める"""
+        for task in [*self._workers, *self._running]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._running, return_exceptions=True)
+        self._workers = []
+
+    def submit_all(self, jobs: list) -> list:
+        """ジョブ（コルーチンを返す関数）をまとめて登録し、Future のリストを返す
+
+        一部だけ受け付けることはせず、空きが足りなければ PoolFullError を送出する。
+        """
+        if self._queue.qsize() + len(jobs) > self.queue_size:
+            self.rejected += len(jobs)
+            raise PoolFullError(
+                f"analysis queue is full ({self._queue.qsize()}/{self.queue_size})"
+            )
+        loop = asyncio.get_running_loop()
+        futures = []
+        for job in jobs:
+            future = loop.create_future()
+            self._queue.put_nowait((job, future))
+            futures.append(future)
+        return futures
+
+    async def _worker(self) -> None:
+        while True:
+            job, future = await self._queue.get()
+            if future.done():
+                # 待っている間に期限切れ・切断で取り消された
+                self.cancelled += 1
+                continue
+            task = asyncio.create_task(job())
+            self._running.add(task)
+            future.add_done_callback(
+                lambda done, task=task: task.cancel() if done.cancelled() else None
+            )
+            try:
+                # ジョブの取り消しでワーカー自身が止まらないよう、wait で完了を待つ
+                await asyncio.wait({task})
+            finally:
+                self._running.discard(task)
+            if task.cancelled():
+                self.cancelled += 1
+            elif task.exception() is not None:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(task.exception())
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(task.result())
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
+
+
+def _error_response(status: int, message: str, headers: dict = None) -> web.Response:
+    return web.json_response(
+        {"error": message}, status=status, headers=headers, dumps=_dumps
+    )
+
+
+def _request_timeout(request: web.Request, form=None) -> float:
+    """リクエストの期限（秒）。ヘッダー、フォームの timeout、既定値の順に使う"""
+    value = request.headers.get("X-Request-Timeout")
+    if value is None and form is not None:
+        value = form.get("timeout")
+    if value is None:
+        return request.app["request_timeout"]
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise RequestError(f"invalid timeout: {value!r}")
+    if timeout <= 0:
+        raise RequestError("timeout must be positive")
+    return min(timeout, MAX_REQUEST_TIMEOUT)
+
+
+def _read_image(field, label: str) -> bytes:
+    """アップロードされたファイルを読み、画像として開けるか確認する（デコードはしない）"""
+    if not isinstance(field, web.FileField):
+        raise RequestError(f"{label} must be a file upload")
+    data = field.file.read()
+    try:
+        Image.open(io.BytesIO(data))
+    except (UnidentifiedImageError, OSError):
+        raise RequestError(f"{label} is not a supported image")
+    return data
+
+
+def _parse_birthdate(value) -> date:
+    if not value:
+        raise RequestError("birthdate is required (YYYY-MM-DD)")
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d").date()
+    except ValueError:
+        raise RequestError(f"invalid birthdate: {value!r} (expected YYYY-MM-DD)")
+
+
+def _parse_tier(form) -> str:
+    tier = form.get("tier") or TIER_FULL
+    if tier not in ANALYSIS_TIERS:
+        raise RequestError(f"tier must be one of {', '.join(ANALYSIS_TIERS)}")
+    return tier
+
+
+def _age_on(birthdate: date, today: date) -> int:
+    return (
+        today.year
+        - birthdate.year
+        - ((today.month, today.day) < (birthdate.month, birthdate.day))
+    )
+
+
+async def _run_analyses(request: web.Request, jobs: list, deadline: float) -> list:
+    """ジョブをワーカーに渡し、期限までに全件の結果を待つ"""
+    futures = request.app["pool"].submit_all(jobs)
+    try:
+        remaining = deadline - asyncio.get_running_loop().time()
+        done, _ = await asyncio.wait(
+            futures,
+            timeout=max(0.0, remaining),
+            return_when=asyncio.FIRST_EXCEPTION,
+        )
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        if len(done) < len(futures):
+            raise DeadlineExceededError("request deadline exceeded")
+        return [future.result() for future in futures]
+    finally:
+        # 期限切れ・切断・一部の失敗のいずれでも、残りの分析は取り消す
+        for future in futures:
+            future.cancel()
+
+
+def _analysis_job(
+    request: web.Request, image: bytes, name: str, tier: str = TIER_FULL
+) -> Callable:
+    api_key = request.app["api_key"]
+    return lambda: analyze_face_fengshui(image, api_key, name, tier=tier)
+
+
+async def handle_analyze(request: web.Request) -> web.Response:
+    """画像1枚を分析"""
+    started = asyncio.get_running_loop().time()
+    form = await request.post()
+    deadline = started + _request_timeout(request, form)
+    if "image" not in form:
+        raise RequestError("image is required")
+    image = _read_image(form["image"], "image")
+    name = form.get("name") or "女性"
+    tier = _parse_tier(form)
+
+    (analysis,) = await _run_analyses(
+        request, [_analysis_job(request, image, name, tier)], deadline
+    )
+    return web.json_response(
+        {"name": name, "analysis": analysis, "failed": is_failed_analysis(analysis)},
+        dumps=_dumps,
+    )
+
+
+async def handle_report(request: web.Request) -> web.Response:
+    """画像2枚以上と生年月日から順位付きレポートを作成"""
+    started = asyncio.get_running_loop().time()
+    form = await request.post()
+    deadline = started + _request_timeout(request, form)
+    birthdate = _parse_birthdate(form.get("birthdate"))
+    fields = form.getall("images", [])
+    if not 2 <= len(fields) <= MAX_CANDIDATES:
+        raise RequestError(f"images must contain 2 to {MAX_CANDIDATES} files")
+    images = [
+        _read_image(field, f"images[{index}]") for index, field in enumerate(fields)
+    ]
+    names = [str(name) for name in form.getall("names", [])]
+    names += [default_candidate_name(i) for i in range(len(names), len(images))]
+    names = names[: len(images)]
+    if form.get("age"):
+        try:
+            age = int(form["age"])
+        except ValueError:
+            raise RequestError(f"invalid age: {form['age']!r}")
+    else:
+        age = _age_on(birthdate, date.today())
+    tier = _parse_tier(form)
+    try:
+        detail_top = int(form.get("detail_top") or 0)
+    except ValueError:
+        raise RequestError(f"invalid detail_top: {form['detail_top']!r}")
+    if not 0 <= detail_top <= MAX_CANDIDATES:
+        raise RequestError(f"detail_top must be between 0 and {MAX_CANDIDATES}")
+
+    analyses = await _run_analyses(
+        request,
+        [
+            _analysis_job(request, image, name, tier)
+            for image, name in zip(images, names)
+        ],
+        deadline,
+    )
+    report = rank_candidates(
+        man_age=age,
+        man_birthdate=birthdate,
+        analyses=analyses,
+        names=names,
+    )
+    # スコアのみで順位付けした上位の人だけを詳細に分析し、順位を付け直す
+    targets = select_detail_candidates(report, detail_top)
+    if targets:
+        detailed = await _run_analyses(
+            request,
+            [
+                _analysis_job(request, images[candidate["index"]], candidate["name"])
+                for candidate in targets
+            ],
+            deadline,
+        )
+        for candidate, analysis in zip(targets, detailed):
+            if not is_failed_analysis(analysis):
+                analyses[candidate["index"]] = analysis
+        report = rank_candidates(
+            man_age=age,
+            man_birthdate=birthdate,
+            analyses=analyses,
+            names=names,
+        )
+    report["failed"] = [
+        name for name, analysis in zip(names, analyses) if is_failed_analysis(analysis)
+    ]
+    # SQLiteへの書き込みでイベントループを止めないよう別スレッドで保存する
+    report["report_id"] = await asyncio.to_thread(
+        save_report_history, report, birthdate, images, "api"
+    )
+    return web.json_response(report, dumps=_dumps)
+
+
+def _int_query(request: web.Request, name: str, default: int, maximum: int) -> int:
+    value = request.query.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        raise RequestError(f"invalid {name}: {value!r}")
+    if not 1 <= parsed <= maximum:
+        raise RequestError(f"{name} must be between 1 and {maximum}")
+    return parsed
+
+
+async def handle_history(request: web.Request) -> web.Response:
+    """過去のレポートの候補者を検索（例: ?days=7&order=wealth_fortune_score）"""
+    birthdate = request.query.get("birthdate")
+    order_by = request.query.get("order", "total_score")
+    if order_by not in ORDER_COLUMNS:
+        raise RequestError(f"order must be one of {', '.join(ORDER_COLUMNS)}")
+    days = request.query.get("days")
+    candidates = await asyncio.to_thread(
+        get_result_store().query_candidates,
+        birth_date=_parse_birthdate(birthdate) if birthdate is not None else None,
+        element=request.query.get("element"),
+        since=(
+            time.time() - _int_query(request, "days", 0, 36500) * 86400
+            if days is not None
+            else None
+        ),
+        order_by=order_by,
+        limit=_int_query(request, "limit", 20, MAX_HISTORY_LIMIT),
+    )
+    return web.json_response({"candidates": candidates}, dumps=_dumps)
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    return web.json_response(
+        {
+            "status": "ok",
+            "pool": request.app["pool"].stats(),
+            "single_flight": get_single_flight().stats(),
+            "hedging": get_model_router(MODELS_TO_TRY).hedge_stats(),
+        }
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=get_metrics().prometheus_text(),
+        content_type="text/plain",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+@web.middleware
+async def error_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """例外をJSONのエラー応答に変換し、エンドポイントごとに件数と時間を記録する"""
+    metrics = get_metrics()
+    resource = request.match_info.route.resource
+    endpoint = resource.canonical if resource is not None else "unmatched"
+    started = time.perf_counter()
+    try:
+        response = await handler(request)
+    except RequestError as e:
+        response = _error_response(400, str(e))
+    except PoolFullError as e:
+        response = _error_response(
+            503, str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    except DeadlineExceededError as e:
+        response = _error_response(504, str(e))
+    except QuotaExceededError as e:
+        response = _error_response(
+            429,
+            f"quota exceeded: {e.reason}",
+            headers={"Retry-After": str(max(1, round(e.estimated_wait)))},
+        )
+    except web.HTTPException as e:
+        response = _error_response(e.status, e.reason)
+    except asyncio.CancelledError:
+        # クライアントの切断（分析は _run_analyses で取り消し済み）
+        metrics.inc(HTTP_REQUESTS_TOTAL, endpoint=endpoint, status="cancelled")
+        raise
+    except Exception as e:
+        logging.exception(f"Request failed: {request.method} {request.path}")
+        response = _error_response(500, f"{type(e).__name__}: {str(e)}")
+    metrics.inc(HTTP_REQUESTS_TOTAL, endpoint=endpoint, status=str(response.status))
+    metrics.observe(
+        HTTP_REQUEST_SECONDS, time.perf_counter() - started, endpoint=endpoint
+    )
+    return response
+
+
+def create_app(
+    api_key: str,
+    workers: int = DEFAULT_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+) -> web.Application:
+    """APIのアプリケーションを作成（ワーカーは起動時に開始し、終了時に止める）"""
+    app = web.Application(
+        client_max_size=MAX_UPLOAD_BYTES, middlewares=[error_middleware]
+    )
+    app["api_key"] = api_key
+    app["request_timeout"] = min(request_timeout, MAX_REQUEST_TIMEOUT)
+    app["pool"] = AnalysisPool(workers, queue_size)
+
+    async def start_pool(app: web.Application) -> None:
+        app["pool"].start()
+
+    async def stop_pool(app: web.Application) -> None:
+        await app["pool"].stop()
+
+    app.on_startup.append(start_pool)
+    app.on_cleanup.append(stop_pool)
+    app.router.add_post("/v1/analyze", handle_analyze)
+    app.router.add_post("/v1/report", handle_report)
+    app.router.add_get("/v1/history", handle_history)
+    app.router.add_get("/healthz", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="風水診断のHTTP APIを起動する")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"))
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS, help="同時に分析する画像数"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="待ち行列に置ける画像数",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_REQUEST_TIMEOUT,
+        help="リクエストの既定の期限（秒）",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="/metrics の計測を有効にする"
+    )
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("--api-key または環境変数 GEMINI_API_KEY を指定してください")
+
+    configure_logging()
+    if args.metrics:
+        get_metrics().enable()
+
+    app = create_app(args.api_key, args.workers, args.queue_size, args.timeout)
+    # クライアントが切断したらハンドラーを取り消し、分析も止める
+    web.run_app(app, host=args.host, port=args.port, handler_cancellation=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
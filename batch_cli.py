@@ -0,0 +1,388 @@
+"""
+風水診断の一括処理CLI
+Offline batch analysis of photo directories
+
+使い方:
+    python batch_cli.py photos/ --birthdate 1994-01-01 --output results.jsonl
+    python batch_cli.py manifest.jsonl --birthdate 1994-01-01 --workers 4 --rpm 15
+    python batch_cli.py photos/ --birthdate 1994-01-01 --metrics metrics.prom
+    # スコアのみで全員を順位付けし、上位10人だけを詳細に分析する
+    python batch_cli.py photos/ --birthdate 1994-01-01 --tier scores --detail-top 10
+
+結果は1画像1行のJSONLとして完了順に追記される。同じ出力ファイルを指定して
+再実行すると、成功済みの画像を飛ばして続きから処理する。
+処理が終わると、成功した全件を1件のレポートとして結果の履歴（result_store）に保存する。
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from fengshui_analyzer import (
+    ANALYSIS_TIERS,
+    ANALYSIS_TIMEOUT,
+    TIER_FULL,
+    TIER_SCORES,
+    analysis_tier,
+    analyze_face_fengshui,
+    configure_logging,
+    image_fingerprint,
+    is_failed_analysis,
+    score_candidate,
+)
+from metrics import get_metrics
+from rate_limiter import get_rate_limiter
+from result_store import get_result_store
+from sexagenary import lookup_sexagenary
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+DEFAULT_WORKERS = 4
+DEFAULT_RPM = float(os.environ.get("FENGSHUI_RPM", "15"))
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+
+def load_items(source: str) -> list:
+    """ディレクトリまたはマニフェストから処理対象の一覧を作成"""
+    if os.path.isdir(source):
+        items = []
+        for root, _, files in os.walk(source):
+            for filename in files:
+                if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                    continue
+                path = os.path.join(root, filename)
+                item_id = os.path.relpath(path, source).replace(os.sep, "/")
+                items.append({"id": item_id, "path": path, "name": item_id})
+        return sorted(items, key=lambda item: item["id"])
+
+    # マニフェスト: JSONL（{"path": ..., "name": ..., "id": ...}）または1行1パスのテキスト
+    base_dir = os.path.dirname(os.path.abspath(source))
+    items = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+            else:
+                path, _, name = line.partition(",")
+                entry = {"path": path.strip(), "name": name.strip() or None}
+            path = entry["path"]
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            item_id = entry.get("id") or entry["path"]
+            items.append(
+                {"id": item_id, "path": path, "name": entry.get("name") or item_id}
+            )
+    return items
+
+
+def load_completed(output_path: str) -> dict:
+    """出力済みJSONLから成功済みの結果を読み込む（途中で途切れた行は無視）"""
+    completed = {}
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                completed[record["id"]] = record
+    return completed
+
+
+def _end_partial_line(output_path: str) -> None:
+    """前回が行の途中で中断していたら改行を足し、追記する行と混ざらないようにする"""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return
+    with open(output_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class ProgressReporter:
+    """処理件数とスループット（画像/分）を定期的に表示"""
+
+    def __init__(self, total: int, interval: float = DEFAULT_PROGRESS_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.ok = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self._last_report = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.ok + self.errors
+
+    def images_per_minute(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed * 60 if elapsed > 0 else 0.0
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.ok += 1
+        else:
+            self.errors += 1
+        now = time.monotonic()
+        if now - self._last_report >= self.interval or self.done == self.total:
+            self._last_report = now
+            self.report()
+
+    def report(self) -> None:
+        print(
+            f"[{self.done}/{self.total}] {self.images_per_minute():.1f} images/min "
+            f"(ok {self.ok}, error {self.errors})",
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+async def process_item(
+    item: dict,
+    api_key: str,
+    man_element: str,
+    timeout: float = None,
+    tier: str = TIER_FULL,
+) -> dict:
+    """1画像を分析してJSONLの1行分のレコードを作成"""
+    started = time.monotonic()
+    try:
+        image_bytes = await asyncio.to_thread(_read_bytes, item["path"])
+        analysis = await analyze_face_fengshui(
+            image_bytes, api_key, item["name"], timeout=timeout, tier=tier
+        )
+        # 五行はアプリ・APIの rank_candidates と同じ既定値（画像からは求めない）
+        candidate = score_candidate(man_element, analysis, item["name"])
+        status = "error" if is_failed_analysis(analysis) else "ok"
+        return {
+            "id": item["id"],
+            "path": item["path"],
+            "status": status,
+            "elapsed": round(time.monotonic() - started, 3),
+            "fingerprint": image_fingerprint(image_bytes),
+            **candidate,
+        }
+    except Exception as e:
+        return {
+            "id": item["id"],
+            "path": item["path"],
+            "status": "error",
+            "elapsed": round(time.monotonic() - started, 3),
+            "error": f"{type(e).__name__}: {str(e)}",
+        }
+
+
+async def run_batch(
+    items: list,
+    output_path: str,
+    api_key: str,
+    man_birthdate: datetime,
+    workers: int = DEFAULT_WORKERS,
+    requests_per_minute: float = DEFAULT_RPM,
+    progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    timeout: float = None,
+    tier: str = TIER_FULL,
+    detail_top: int = 0,
+) -> list:
+    """未処理の画像をワーカーで並列に分析し、完了順にJSONLへ追記
+
+    tier=TIER_SCORES ならスコアのみで全件を分析し、detail_top を指定すると
+    総合スコアの上位 detail_top 件だけを詳細に分析し直す（同じ id の行を追記する）。
+    """
+    man_element = lookup_sexagenary(man_birthdate).element
+    completed = load_completed(output_path)
+    if tier == TIER_FULL:
+        # 以前スコアのみで分析した画像は、詳細な分析でやり直す
+        completed = {
+            item_id: record
+            for item_id, record in completed.items()
+            if analysis_tier(record["face_analysis"]) == TIER_FULL
+        }
+    pending = [item for item in items if item["id"] not in completed]
+    if completed:
+        print(
+            f"Resuming: {len(completed)} done, {len(pending)} remaining",
+            file=sys.stderr,
+        )
+
+    # 一括処理は待てるので待ち時間の上限を外し、1分あたりの上限だけ設定する
+    get_rate_limiter().configure(
+        requests_per_minute=requests_per_minute, max_wait_seconds=float("inf")
+    )
+    progress = ProgressReporter(len(pending), progress_interval)
+    results = list(completed.values())
+
+    _end_partial_line(output_path)
+    with open(output_path, "a", encoding="utf-8") as out:
+
+        def write(record: dict) -> None:
+            # クラッシュしても完了分が失われないよう1行ごとにディスクへ書き出す
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+
+        async def run_workers(jobs: list, handle) -> None:
+            # 同時に分析するのは workers 件まで（詳細分析も同じ上限で回す）
+            queue: asyncio.Queue = asyncio.Queue()
+            for job in jobs:
+                queue.put_nowait(job)
+
+            async def worker() -> None:
+                while True:
+                    try:
+                        job = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await handle(job)
+
+            await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+
+        async def analyze(item: dict) -> None:
+            record = await process_item(item, api_key, man_element, timeout, tier)
+            write(record)
+            if record["status"] == "ok":
+                results.append(record)
+            progress.record(record["status"] == "ok")
+
+        await run_workers(pending, analyze)
+
+        # スコアのみで分析した上位の画像だけを詳細に分析する
+        targets = [
+            record
+            for record in heapq.nlargest(
+                detail_top, results, key=lambda r: r["total_score"]
+            )
+            if analysis_tier(record["face_analysis"]) == TIER_SCORES
+        ]
+        if targets:
+            print(f"Detailed analysis of top {len(targets)}", file=sys.stderr)
+        positions = {record["id"]: index for index, record in enumerate(results)}
+
+        async def analyze_detail(target: dict) -> None:
+            record = await process_item(target, api_key, man_element, timeout)
+            # 失敗した場合はスコアのみの結果を残す
+            if record["status"] == "ok":
+                write(record)
+                results[positions[record["id"]]] = record
+
+        await run_workers(targets, analyze_detail)
+
+    if (pending or targets) and results:
+        save_history(results, man_birthdate, man_element)
+    return results
+
+
+def save_history(results: list, man_birthdate: datetime, man_element: str) -> None:
+    """成功した全件を総合スコア順に1件のレポートとして履歴に保存"""
+    ranked = sorted(results, key=lambda r: r["total_score"], reverse=True)
+    candidates = [dict(record, rank=rank) for rank, record in enumerate(ranked, 1)]
+    try:
+        report_id = get_result_store().record_report(
+            man_birthdate,
+            man_element,
+            candidates,
+            [record.get("fingerprint") for record in candidates],
+            source="batch",
+            recommendation=candidates[0]["name"],
+        )
+    except Exception as e:
+        print(f"History not saved: {type(e).__name__}: {str(e)}", file=sys.stderr)
+        return
+    print(f"Saved to history as report {report_id}", file=sys.stderr)
+
+
+def write_metrics(path: str) -> None:
+    """計測結果をファイルに書き出す"""
+    metrics = get_metrics()
+    with open(path, "w", encoding="utf-8") as f:
+        if path.endswith(".prom"):
+            f.write(metrics.prometheus_text())
+        else:
+            json.dump(metrics.snapshot(), f, ensure_ascii=False, indent=2)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="顔写真を一括で風水診断する")
+    parser.add_argument("source", help="画像ディレクトリ、またはマニフェスト（JSONL/テキスト）")
+    parser.add_argument("--birthdate", required=True, help="男性の生年月日 (YYYY-MM-DD)")
+    parser.add_argument("--output", default="results.jsonl", help="結果のJSONLファイル")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"))
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument(
+        "--rpm", type=float, default=DEFAULT_RPM, help="1分あたりの最大リクエスト数"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=ANALYSIS_TIMEOUT,
+        help="1画像の分析の期限（秒、モデルの切り替えを含む。0で無制限）",
+    )
+    parser.add_argument(
+        "--tier",
+        choices=ANALYSIS_TIERS,
+        default=TIER_FULL,
+        help="分析の詳しさ（scores は顔の形とスコアのみで速い）",
+    )
+    parser.add_argument(
+        "--detail-top",
+        type=int,
+        default=0,
+        help="--tier scores のとき、詳細に分析し直す上位件数",
+    )
+    parser.add_argument("--top", type=int, default=5, help="最後に表示する上位件数")
+    parser.add_argument(
+        "--metrics",
+        help="処理段階ごとの計測結果の出力先（.prom ならPrometheus形式、それ以外はJSON）",
+    )
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("--api-key または環境変数 GEMINI_API_KEY を指定してください")
+
+    configure_logging()
+    if args.metrics:
+        get_metrics().enable()
+
+    man_birthdate = datetime.strptime(args.birthdate, "%Y-%m-%d")
+    items = load_items(args.source)
+    print(f"{len(items)} images found", file=sys.stderr)
+
+    results = asyncio.run(
+        run_batch(
+            items,
+            args.output,
+            args.api_key,
+            man_birthdate,
+            workers=args.workers,
+            requests_per_minute=args.rpm,
+            timeout=args.timeout,
+            tier=args.tier,
+            detail_top=args.detail_top,
+        )
+    )
+
+    if args.metrics:
+        write_metrics(args.metrics)
+
+    top = heapq.nlargest(args.top, results, key=lambda r: r["total_score"])
+    for rank, record in enumerate(top, start=1):
+        print(f"{rank}. {record['name']}: {record['total_score']} ({record['element']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
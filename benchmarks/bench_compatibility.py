@@ -0,0 +1,81 @@
+"""
+五行相性スコアの一括計算ベンチマーク
+Benchmark: scalar vs vectorized element-compatibility scoring
+
+使い方:
+    python benchmarks/bench_compatibility.py --pairs 1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fengshui_analyzer import (  # noqa: E402
+    ELEMENT_ORDER,
+    bulk_total_scores,
+    calculate_element_compatibility,
+    calculate_total_score,
+)
+
+
+def scalar_total_scores(fortune, wealth, elements1, elements2) -> list:
+    """1組ずつ calculate_element_compatibility で計算（比較用）"""
+    return [
+        round(
+            calculate_total_score(
+                {"fortune_score": f, "wealth_fortune_score": w},
+                calculate_element_compatibility(e1, e2)["score"],
+            ),
+            1,
+        )
+        for f, w, e1, e2 in zip(fortune, wealth, elements1, elements2)
+    ]
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=1_000_000)
+    parser.add_argument(
+        "--scalar-pairs",
+        type=int,
+        default=100_000,
+        help="スカラー版で計算する組数（遅いため一部のみ）",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    fortune = rng.integers(0, 101, args.pairs)
+    wealth = rng.integers(0, 101, args.pairs)
+    # 小数のスコアも混ぜて丸めの一致を確認する
+    fortune = np.where(rng.random(args.pairs) < 0.5, fortune, np.round(fortune * 0.97, 1))
+    names = np.array(ELEMENT_ORDER)
+    elements1 = names[rng.integers(0, 5, args.pairs)]
+    elements2 = names[rng.integers(0, 5, args.pairs)]
+
+    started = time.perf_counter()
+    bulk = bulk_total_scores(fortune, wealth, elements1, elements2)
+    bulk_seconds = time.perf_counter() - started
+
+    n = min(args.scalar_pairs, args.pairs)
+    f_list, w_list = fortune[:n].tolist(), wealth[:n].tolist()
+    e1_list, e2_list = elements1[:n].tolist(), elements2[:n].tolist()
+    started = time.perf_counter()
+    scalar = scalar_total_scores(f_list, w_list, e1_list, e2_list)
+    scalar_seconds = time.perf_counter() - started
+
+    mismatches = int(np.count_nonzero(bulk[:n] != np.array(scalar)))
+    print(f"scalar : {n / scalar_seconds:>14,.0f} pairs/s ({n:,} pairs)")
+    print(f"bulk   : {args.pairs / bulk_seconds:>14,.0f} pairs/s ({args.pairs:,} pairs)")
+    print(f"speedup: {(args.pairs / bulk_seconds) / (n / scalar_seconds):.1f}x")
+    print(f"mismatches vs scalar: {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
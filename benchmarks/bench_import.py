@@ -0,0 +1,86 @@
+"""
+モジュールのインポート時間ベンチマーク
+Benchmark: cold-start import time of fengshui_analyzer
+
+使い方:
+    python benchmarks/bench_import.py --runs 10
+    python benchmarks/bench_import.py --module batch_cli --max-ms 500
+
+毎回新しいPythonプロセスでインポートし、中央値と最大値を表示する。
+インポートだけで google.generativeai が読み込まれた場合や、ログ用の
+ディレクトリが作られた場合は失敗（終了コード1）とする。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行するスクリプト（インポート時間と読み込まれた重いモジュールを返す）
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "seconds": elapsed,
+    "genai_loaded": "google.generativeai" in sys.modules,
+}}))
+"""
+
+
+def measure_once(module: str, cwd: str) -> dict:
+    """新しいプロセスで1回インポートして計測"""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, PYTHONDONTWRITEBYTECODE="1")
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module)],
+        cwd=cwd,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="fengshui_analyzer")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--max-ms", type=float, default=None, help="中央値がこれを超えたら失敗にする"
+    )
+    args = parser.parse_args(argv)
+
+    failures = []
+    # 作業ディレクトリへの副作用（logs/ の作成など）を検出するため空のディレクトリで実行
+    with tempfile.TemporaryDirectory() as cwd:
+        # 1回目はバイトコードのコンパイルなどを含むため捨てる
+        measure_once(args.module, cwd)
+        results = [measure_once(args.module, cwd) for _ in range(args.runs)]
+        if os.listdir(cwd):
+            failures.append(f"import created files in cwd: {sorted(os.listdir(cwd))}")
+
+    times_ms = [r["seconds"] * 1000 for r in results]
+    median_ms = statistics.median(times_ms)
+    print(f"module : {args.module}")
+    print(f"median : {median_ms:8.1f} ms ({args.runs} runs)")
+    print(f"min    : {min(times_ms):8.1f} ms")
+    print(f"max    : {max(times_ms):8.1f} ms")
+
+    if any(r["genai_loaded"] for r in results):
+        failures.append("google.generativeai was imported eagerly")
+    if args.max_ms is not None and median_ms > args.max_ms:
+        failures.append(f"median {median_ms:.1f} ms exceeds {args.max_ms:.1f} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+分析1回あたりのピークメモリ（RSS）ベンチマーク
+Benchmark: peak RSS per analysis with reduced (draft) vs full-resolution decoding
+
+使い方:
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --size 4032x3024 --concurrency 4
+    # 変更前のコミットと比べる
+    git worktree add /tmp/fengshui-before <コミット>
+    python benchmarks/bench_memory.py --repo /tmp/fengshui-before
+
+計測ごとに新しいPythonプロセスを起動し、ウォームアップ（OpenCVの読み込みなど）後の
+RSSからピークまでの増分を「分析によるピーク」として表示する。reduced は既定の縮小デコード、
+full は FENGSHUI_WORKING_IMAGE_EDGE=0 でフル解像度にデコードした場合。
+疑似Geminiバックエンドを使うのでAPIキーは不要。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_pipeline import make_photo  # noqa: E402
+
+# 子プロセスで実行するスクリプト（分析前のRSSと分析中のピークを返す）
+# Linux では /proc/self/clear_refs でピーク（VmHWM）をリセットし、インポートや
+# ウォームアップのピークを除く。それ以外のOSでは ru_maxrss で代用する
+_PROBE = """
+import asyncio, json, resource, sys
+sys.path[:0] = [{repo!r}, {bench_dir!r}]
+from fake_genai import FakeBackend
+FakeBackend(latency=0.01, jitter=0.0).install()
+import fengshui_analyzer as fa
+
+def status_bytes(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+async def analyze(images):
+    await asyncio.gather(*(
+        fa.analyze_face_fengshui(image, "bench-key", use_cache=False)
+        for image in images
+    ))
+
+with open({photo!r}, "rb") as f:
+    photo = f.read()
+with open({warmup!r}, "rb") as f:
+    warmup = f.read()
+asyncio.run(analyze([warmup]))
+images = [bytes(photo) for _ in range({concurrency})]
+try:
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+except OSError:
+    pass
+baseline = status_bytes("VmRSS")
+asyncio.run(analyze(images))
+print(json.dumps({{"baseline": baseline, "peak": status_bytes("VmHWM")}}))
+"""
+
+MODES = {
+    "reduced": {},
+    "full": {"FENGSHUI_WORKING_IMAGE_EDGE": "0"},
+}
+
+
+def measure_once(
+    repo: str, photo_path: str, warmup_path: str, concurrency: int, mode: str
+) -> dict:
+    """新しいプロセスで1回分析し、分析前のRSSとピークを返す"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(
+            os.environ,
+            FENGSHUI_CACHE_DIR=cache_dir,
+            FENGSHUI_RPM="0",
+            FENGSHUI_RPD="0",
+            PYTHONDONTWRITEBYTECODE="1",
+            **MODES[mode],
+        )
+        probe = _PROBE.format(
+            repo=repo,
+            bench_dir=BENCH_DIR,
+            photo=photo_path,
+            warmup=warmup_path,
+            concurrency=concurrency,
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", probe],
+            cwd=repo,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", default="4032x3024", help="写真のサイズ（幅x高さ）")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に分析する枚数")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--repo", default=REPO_ROOT, help="計測するチェックアウト")
+    parser.add_argument("--mode", choices=sorted(MODES), action="append")
+    args = parser.parse_args(argv)
+
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    modes = args.mode or ["full", "reduced"]
+    with tempfile.TemporaryDirectory() as workdir:
+        photo_path = os.path.join(workdir, "photo.jpg")
+        warmup_path = os.path.join(workdir, "warmup.jpg")
+        with open(photo_path, "wb") as f:
+            f.write(make_photo((width, height)))
+        with open(warmup_path, "wb") as f:
+            f.write(make_photo((320, 240)))
+
+        print(f"repo       : {os.path.abspath(args.repo)}")
+        print(f"photo      : {width}x{height}, {os.path.getsize(photo_path)} bytes")
+        print(f"concurrency: {args.concurrency}")
+        results = {}
+        for mode in modes:
+            deltas = []
+            for _ in range(args.runs):
+                sample = measure_once(
+                    args.repo, photo_path, warmup_path, args.concurrency, mode
+                )
+                deltas.append((sample["peak"] - sample["baseline"]) / 1024 / 1024)
+            deltas.sort()
+            results[mode] = deltas[len(deltas) // 2]
+            print(
+                f"{mode:<8}: peak RSS +{results[mode]:7.1f} MB per run "
+                f"(+{results[mode] / args.concurrency:6.1f} MB per analysis, "
+                f"median of {args.runs})"
+            )
+    if "full" in results and "reduced" in results and results["full"]:
+        print(f"reduction: {(1 - results['reduced'] / results['full']) * 100:.0f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
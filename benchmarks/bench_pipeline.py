@@ -0,0 +1,466 @@
+"""
+分析パイプライン全体のベンチマーク（疑似Geminiバックエンド使用）
+Benchmark: analyze / report / image-hashing paths against a local fake Gemini
+
+使い方:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --requests 200 --concurrency 8 \\
+        --latency 0.5 --error-rate 0.05 --malformed-rate 0.05 --rate-limit-rate 0.02
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/<前回>.json
+    # ヘッジの効果（裾の長いレイテンシで p99 と余分な呼び出し数を比べる）
+    python benchmarks/bench_pipeline.py --jitter 0.8 --requests 400 --hedge
+    # 応答のない接続が混ざる場合（呼び出しごとの上限で次のモデルへ切り替わる）
+    python benchmarks/bench_pipeline.py --hang-rate 0.02 --attempt-timeout 2
+    # スコアのみの分析（出力の長さに比例する生成時間を加えて詳細な分析と比べる）
+    python benchmarks/bench_pipeline.py --output-latency 0.5 --tier scores
+
+APIキーもネットワークも使わない。結果は benchmarks/results/ にコミットIDと
+時刻付きのJSONで保存され、--compare で前回の結果との差分を表示する。
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from PIL import Image, ImageChops, ImageDraw
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+# キャッシュとレート制限の影響を受けないよう、インポート前に設定する
+os.environ.setdefault("FENGSHUI_CACHE_DIR", tempfile.mkdtemp(prefix="fengshui-bench-"))
+os.environ["FENGSHUI_RPM"] = "0"
+os.environ["FENGSHUI_RPD"] = "0"
+
+from fake_genai import FakeBackend  # noqa: E402
+from metrics import STAGE_SECONDS, get_metrics  # noqa: E402
+
+DEFAULT_RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# 実際のアップロードに近いサイズ（スマートフォン・フルHD・Web用）
+PHOTO_SIZES = {
+    "phone_12mp": (4032, 3024),
+    "full_hd": (1920, 1080),
+    "web": (800, 600),
+}
+
+
+def make_photo(size: tuple) -> bytes:
+    """顔らしい楕円とノイズを含む写真風のJPEGを作る（実写に近い圧縮率になる）"""
+    width, height = size
+    vertical = Image.linear_gradient("L").resize(size)
+    horizontal = Image.linear_gradient("L").transpose(Image.ROTATE_90).resize(size)
+    channels = [
+        horizontal.point(lambda v: 120 + v * 80 // 255),
+        vertical.point(lambda v: 100 + v * 60 // 255),
+        ImageChops.invert(horizontal).point(lambda v: 100 + v * 40 // 255),
+    ]
+    # effect_noise は128を中心とするガウスノイズなので、128を引いて加える
+    channels = [
+        ImageChops.add(channel, Image.effect_noise(size, 12), offset=-128)
+        for channel in channels
+    ]
+    image = Image.merge("RGB", channels)
+    draw = ImageDraw.Draw(image)
+    cx, cy, r = width // 2, height // 2, min(width, height) // 4
+    draw.ellipse(
+        (cx - r, cy - int(r * 1.3), cx + r, cy + int(r * 1.3)), fill=(224, 180, 150)
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def percentiles(samples: list) -> dict:
+    """p50/p95/p99（最近傍順位法）と平均・最大をミリ秒で返す"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = int(round(p / 100 * len(ordered) + 0.5)) - 1
+        index = max(0, min(len(ordered) - 1, index))
+        return ordered[index] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50_ms": round(rank(50), 3),
+        "p95_ms": round(rank(95), 3),
+        "p99_ms": round(rank(99), 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class MemoryProbe:
+    """区間内のPythonヒープのピーク（trace=True のとき）とプロセスの最大RSSを測る"""
+
+    def __init__(self, trace: bool = True):
+        self.trace = trace
+
+    def __enter__(self):
+        gc.collect()
+        if self.trace:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.result = {"max_rss_mb": round(_max_rss_bytes() / 1024 / 1024, 2)}
+        if self.trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.result["python_peak_mb"] = round(peak / 1024 / 1024, 2)
+        return False
+
+
+def _max_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KiB、macOS はバイト単位
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def bench_hashing(photos: dict, iterations: int) -> dict:
+    """image_fingerprint をバイト列・ファイルオブジェクト・PIL画像で計測"""
+    import fengshui_analyzer as fa
+
+    results = {}
+    for label, data in photos.items():
+        decoded = Image.open(io.BytesIO(data))
+        decoded.load()
+        timings = {"bytes": [], "file": [], "pil": []}
+        with MemoryProbe() as memory:
+            for _ in range(iterations):
+                started = time.perf_counter()
+                fa.image_fingerprint(data)
+                timings["bytes"].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                fa.image_fingerprint(io.BytesIO(data))
+                timings["file"].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                fa.image_fingerprint(decoded)
+                timings["pil"].append(time.perf_counter() - started)
+        results[label] = {
+            "size_bytes": len(data),
+            **{kind: percentiles(samples) for kind, samples in timings.items()},
+            "memory": memory.result,
+        }
+    return results
+
+
+async def _run_analyses(
+    photos: list,
+    requests: int,
+    concurrency: int,
+    batch_size: int,
+    hedge: bool,
+    tier: str,
+) -> tuple:
+    import fengshui_analyzer as fa
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    latencies = []
+    degraded = 0
+
+    async def one(start: int) -> None:
+        nonlocal degraded
+        count = min(batch_size, requests - start)
+        images = [photos[(start + i) % len(photos)] for i in range(count)]
+        async with semaphore:
+            started = time.perf_counter()
+            if batch_size > 1:
+                analyses = await fa.analyze_faces_batched(
+                    images,
+                    "bench-key",
+                    use_cache=False,
+                    max_batch_size=batch_size,
+                    tier=tier,
+                )
+            else:
+                # 同じ写真を繰り返し使うので、同時分析のまとめ込みは外す
+                analysis = await fa.analyze_face_fengshui(
+                    images[0],
+                    "bench-key",
+                    use_cache=False,
+                    coalesce=False,
+                    hedge=hedge,
+                    tier=tier,
+                )
+                analyses = [analysis]
+            # まとめて分析した場合は全員が同じレイテンシになる
+            latencies.extend([time.perf_counter() - started] * count)
+            degraded += sum(1 for a in analyses if fa.is_failed_analysis(a))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(0, requests, batch_size)))
+    return latencies, degraded, time.perf_counter() - started
+
+
+def bench_analyze(
+    photos: list,
+    requests: int,
+    concurrency: int,
+    backend,
+    batch_size: int = 1,
+    hedge: bool = False,
+    tier: str = "full",
+) -> dict:
+    """analyze_face_fengshui を同時実行し、レイテンシ分布とスループットを計測"""
+    from model_router import get_model_router
+
+    import fengshui_analyzer as fa
+
+    # tracemalloc はスレッドを含む処理を大きく遅くするため、ここではRSSのみ測る
+    with MemoryProbe(trace=False) as memory:
+        latencies, degraded, elapsed = asyncio.run(
+            _run_analyses(
+                photos, requests, concurrency, max(1, batch_size), hedge, tier
+            )
+        )
+    router = get_model_router(fa.MODELS_TO_TRY)
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "tier": tier,
+        "latency": percentiles(latencies),
+        "throughput_rps": round(requests / elapsed, 3),
+        "degraded": degraded,
+        "error_rate": round(degraded / requests, 4) if requests else 0.0,
+        "backend": backend.stats(),
+        "router": router.snapshot(),
+        "hedging": router.hedge_stats(),
+        "memory": memory.result,
+    }
+
+
+def bench_report(photos: list, iterations: int) -> dict:
+    """generate_compatibility_report を画像付きで計測"""
+    import fengshui_analyzer as fa
+    from fake_genai import SAMPLE_ANALYSIS
+
+    birthdate = datetime(1994, 1, 1)
+    timings = []
+    with MemoryProbe() as memory:
+        for i in range(iterations):
+            image1 = photos[i % len(photos)]
+            image2 = photos[(i + 1) % len(photos)]
+            started = time.perf_counter()
+            fa.generate_compatibility_report(
+                30,
+                birthdate,
+                dict(SAMPLE_ANALYSIS),
+                dict(SAMPLE_ANALYSIS),
+                woman1_image=image1,
+                woman2_image=image2,
+            )
+            timings.append(time.perf_counter() - started)
+    return {"latency": percentiles(timings), "memory": memory.result}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(results: dict, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"{stamp}-{results['revision']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def _flatten(prefix: str, value, out: dict) -> dict:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+
+def compare_results(previous: dict, current: dict) -> None:
+    """レイテンシ・スループット・メモリの指標を前回と比較して表示"""
+    sections = ("hashing", "analyze", "report")
+    before = _flatten("", {k: previous.get(k) for k in sections}, {})
+    after = _flatten("", {k: current.get(k) for k in sections}, {})
+    print(f"\ncompare: {previous.get('revision')} -> {current.get('revision')}")
+    for key in sorted(after):
+        if key not in before or not key.endswith(("_ms", "_rps", "_mb")):
+            continue
+        old, new = before[key], after[key]
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"  {key:<45} {old:>12.3f} -> {new:>12.3f} ({change:+.1f}%)")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="1回のリクエストで分析する人数"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="疑似APIの遅延の中央値（秒）"
+    )
+    parser.add_argument("--jitter", type=float, default=0.3, help="遅延の対数標準偏差")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合")
+    parser.add_argument(
+        "--malformed-rate", type=float, default=0.0, help="壊れたJSONを返す割合"
+    )
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0.0, help="429 を返す割合"
+    )
+    parser.add_argument(
+        "--hang-rate", type=float, default=0.0, help="応答が返らない割合"
+    )
+    parser.add_argument(
+        "--attempt-timeout",
+        type=float,
+        help="1回の呼び出しの上限（秒、既定は FENGSHUI_ATTEMPT_TIMEOUT）",
+    )
+    parser.add_argument(
+        "--hedge", action="store_true", help="遅い応答を次のモデルでヘッジする"
+    )
+    parser.add_argument(
+        "--output-latency",
+        type=float,
+        default=0.0,
+        help="疑似APIの出力1000文字あたりの生成時間（秒）",
+    )
+    parser.add_argument(
+        "--tier", choices=["full", "scores"], default="full", help="分析の詳しさ"
+    )
+    parser.add_argument("--hash-iterations", type=int, default=20)
+    parser.add_argument("--report-iterations", type=int, default=50)
+    parser.add_argument(
+        "--sizes",
+        default=",".join(PHOTO_SIZES),
+        help=f"使用する写真サイズ（{', '.join(PHOTO_SIZES)}）",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="疑似APIの乱数シード")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--no-save", action="store_true", help="結果を保存しない")
+    parser.add_argument("--compare", help="比較する過去の結果JSON")
+    parser.add_argument(
+        "--verbose", action="store_true", help="フォールバックの警告も表示"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    backend = FakeBackend(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+        hang_rate=args.hang_rate,
+        output_latency=args.output_latency,
+    )
+    backend.install()
+    if args.attempt_timeout is not None:
+        import fengshui_analyzer as fa
+
+        fa.ATTEMPT_TIMEOUT = args.attempt_timeout
+    metrics = get_metrics()
+    metrics.enable()
+
+    labels = [label.strip() for label in args.sizes.split(",") if label.strip()]
+    photos = {label: make_photo(PHOTO_SIZES[label]) for label in labels}
+
+    results = {
+        "revision": _git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "photos": {label: len(data) for label, data in photos.items()},
+    }
+    results["hashing"] = bench_hashing(photos, args.hash_iterations)
+    results["report"] = bench_report(list(photos.values()), args.report_iterations)
+    # APIを含む計測は最後に行う（スレッドプールの確保でRSSが増えるため）
+    metrics.reset()
+    results["analyze"] = bench_analyze(
+        list(photos.values()),
+        args.requests,
+        args.concurrency,
+        backend,
+        args.batch_size,
+        args.hedge,
+        args.tier,
+    )
+    results["metrics"] = metrics.snapshot()
+
+    for label, stats in results["hashing"].items():
+        print(
+            f"hash    {label:<11} {stats['size_bytes'] / 1024 / 1024:6.2f} MB  "
+            f"bytes p50 {stats['bytes']['p50_ms']:.2f} ms  "
+            f"file p50 {stats['file']['p50_ms']:.2f} ms  "
+            f"pil p50 {stats['pil']['p50_ms']:.2f} ms"
+        )
+    analyze = results["analyze"]
+    print(
+        f"analyze p50 {analyze['latency']['p50_ms']:.1f} ms  "
+        f"p95 {analyze['latency']['p95_ms']:.1f} ms  "
+        f"p99 {analyze['latency']['p99_ms']:.1f} ms  "
+        f"{analyze['throughput_rps']:.2f} images/s  degraded {analyze['degraded']}  "
+        f"API calls {analyze['backend']['calls']}"
+    )
+    report = results["report"]["latency"]
+    print(
+        f"report  p50 {report['p50_ms']:.2f} ms  p95 {report['p95_ms']:.2f} ms  "
+        f"p99 {report['p99_ms']:.2f} ms"
+    )
+    if args.hedge:
+        hedging = analyze["hedging"]
+        print(
+            f"hedge   {hedging['hedged']}/{hedging['analyses']} hedged  "
+            f"backup won {hedging['backup_won']}  skipped {hedging['skipped']}  "
+            f"extra calls {hedging['extra_calls']} "
+            f"(+{hedging['cost_overhead'] * 100:.1f}%)"
+        )
+    print(f"max RSS {analyze['memory']['max_rss_mb']:.1f} MB")
+    for series in results["metrics"]["histograms"].get(STAGE_SECONDS, []):
+        print(
+            f"stage   {series['labels']['stage']:<12} "
+            f"mean {series['sum'] / series['count'] * 1000:8.2f} ms  "
+            f"({series['count']} calls)"
+        )
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(json.load(f), results)
+    if not args.no_save:
+        print(f"saved: {save_results(results, args.results_dir)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+HTTP API の負荷試験（疑似Geminiバックエンド使用）
+Load test: api_server against a local fake Gemini
+
+使い方:
+    python benchmarks/bench_server.py --requests 200 --concurrency 32 --workers 8
+    # 期限切れ（504）と取り消しの確認
+    python benchmarks/bench_server.py --latency 1.0 --timeout 0.5
+    # 全リクエストで同じ画像を送る（同時分析のまとめ込みの確認）
+    python benchmarks/bench_server.py --same-images
+    # 起動済みのサーバーに送る（疑似バックエンドは使わない）
+    python benchmarks/bench_server.py --url http://127.0.0.1:8080
+
+--url を指定しない場合は、疑似バックエンドを組み込んだサーバーを同じプロセスで
+起動して /v1/report に画像2枚ずつのリクエストを送り、ステータス別の件数・
+レイテンシ分布・スループットとワーカーの状態を表示する。
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+# キャッシュとレート制限の影響を受けないよう、インポート前に設定する
+os.environ.setdefault("FENGSHUI_CACHE_DIR", tempfile.mkdtemp(prefix="fengshui-bench-"))
+os.environ["FENGSHUI_RPM"] = "0"
+os.environ["FENGSHUI_RPD"] = "0"
+
+import aiohttp  # noqa: E402
+
+from bench_pipeline import make_photo, percentiles  # noqa: E402
+from fake_genai import FakeBackend  # noqa: E402
+
+
+async def _start_server(args) -> tuple:
+    """疑似バックエンドを組み込んだサーバーを空いているポートで起動"""
+    from aiohttp import web
+
+    backend = FakeBackend(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+    )
+    backend.install()
+    import api_server
+
+    app = api_server.create_app(
+        "bench-key", args.workers, args.queue_size, args.timeout
+    )
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, backend, f"http://{host}:{port}"
+
+
+async def _send_report(
+    session, url: str, photos: list, index: int, unique: bool = True
+) -> tuple:
+    form = aiohttp.FormData()
+    form.add_field("birthdate", "1994-01-01")
+    for offset, photo in enumerate(photos):
+        # JPEGの終端の後ろに番号を付けて、リクエストごとに別の画像として扱わせる
+        # （分析結果のキャッシュに当たらないようにする）
+        data = photo + f"{index}-{offset}".encode() if unique else photo
+        form.add_field(
+            "images", data, filename=f"{index}-{offset}.jpg", content_type="image/jpeg"
+        )
+    started = time.perf_counter()
+    try:
+        async with session.post(f"{url}/v1/report", data=form) as response:
+            await response.read()
+            status = str(response.status)
+    except aiohttp.ClientError as e:
+        status = type(e).__name__
+    return status, time.perf_counter() - started
+
+
+async def run(args) -> int:
+    photos = [make_photo((800 + i * 16, 600)) for i in range(args.images_per_request)]
+    runner = backend = None
+    url = args.url
+    if url is None:
+        runner, backend, url = await _start_server(args)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    statuses = Counter()
+    latencies = []
+
+    async def one(index: int) -> None:
+        async with semaphore:
+            status, elapsed = await _send_report(
+                session, url, photos, index, unique=not args.same_images
+            )
+        statuses[status] += 1
+        if status == "200":
+            latencies.append(elapsed)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.requests)))
+            elapsed = time.perf_counter() - started
+            async with session.get(f"{url}/healthz") as response:
+                health = await response.json()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    print(f"url        : {url}")
+    print(f"requests   : {args.requests} (concurrency {args.concurrency})")
+    print(f"throughput : {args.requests / elapsed:.1f} req/s")
+    print(f"statuses   : {dict(sorted(statuses.items()))}")
+    if latencies:
+        latency = percentiles(latencies)
+        print(
+            f"latency ok : p50 {latency['p50_ms']:.0f} ms, p95 {latency['p95_ms']:.0f} ms, "
+            f"p99 {latency['p99_ms']:.0f} ms, max {latency['max_ms']:.0f} ms"
+        )
+    print(f"pool       : {health['pool']}")
+    print(f"coalescing : {health['single_flight']}")
+    if backend is not None:
+        print(f"backend    : {backend.stats()}")
+    return 0
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="起動済みのサーバーのURL")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16, help="同時接続数")
+    parser.add_argument("--images-per-request", type=int, default=2)
+    parser.add_argument(
+        "--same-images", action="store_true", help="全リクエストで同じ画像を送る"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="サーバーのワーカー数")
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument(
+        "--timeout", type=float, default=30.0, help="リクエストの期限（秒）"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="疑似APIの遅延の中央値（秒）"
+    )
+    parser.add_argument("--jitter", type=float, default=0.3, help="遅延の対数標準偏差")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合")
+    args = parser.parse_args(argv)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+"""
+google.generativeai のローカル代替（ベンチマーク用）
+Local stand-in for google.generativeai with configurable latency and failures
+
+使い方:
+    from fake_genai import FakeBackend
+    backend = FakeBackend(latency=0.2, error_rate=0.05, rate_limit_rate=0.02)
+    backend = FakeBackend(hang_rate=0.02, hang_seconds=120)  # 応答のない接続
+    backend = FakeBackend(output_latency=0.5)  # 出力1000文字あたり0.5秒の生成時間
+    backend.install()  # 以降の import google.generativeai はこの代替を返す
+
+APIキーやネットワークは不要。応答は本物と同じ形（response.text、
+stream=True ならチャンクの反復）で返し、失敗は本物と同じく code 属性付きの
+例外で表す。request_options={"timeout": 秒} を渡すと、本物と同じくその時間で
+504（Deadline Exceeded）になる。応答は response_schema にある項目だけを含み、
+output_latency を指定すると出力の長さに比例した生成時間が遅延に加わる。
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+import types
+
+# 本物の応答に近い分量の顔相分析
+SAMPLE_ANALYSIS = {
+    "face_shape": "卵型",
+    "face_shape_meaning": "バランスの取れた運勢で、人間関係に恵まれやすい顔立ちです。",
+    "eyes_analysis": "目元は穏やかで、思いやりと観察力の高さを示しています。",
+    "nose_analysis": "鼻筋が通っており、金運と自立心の強さが表れています。",
+    "mouth_analysis": "口角が上がっており、社交性が高く人に好かれやすい相です。",
+    "forehead_analysis": "額が広く、知性と計画性に優れています。",
+    "ears_analysis": "耳たぶがふっくらしており、財を蓄える力があります。",
+    "complexion_analysis": "血色が良く、健康運・対人運ともに良好です。",
+    "fortune_score": 78,
+    "wealth_fortune_score": 72,
+    "overall_impression": "全体として明るく安定した運勢の持ち主です。",
+    "strengths": ["協調性が高い", "金銭感覚が堅実", "周囲を明るくする"],
+    "wealth_potential": "堅実に資産を築き、家庭を豊かにする力があります。",
+}
+
+
+class FakeAPIError(Exception):
+    """SDKの例外と同じく HTTPステータスを code 属性に持つ"""
+
+    def __init__(self, code: int, message: str):
+        self.code = code
+        super().__init__(f"{code} {message}")
+
+
+class FakeBackend:
+    """遅延・エラー率・壊れたJSON・429・応答なしを設定できる疑似Geminiバックエンド"""
+
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.3,
+        error_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        stream_chunks: int = 8,
+        seed: int = 0,
+        hang_rate: float = 0.0,
+        hang_seconds: float = 120.0,
+        output_latency: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.output_latency = output_latency
+        self.stream_chunks = stream_chunks
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+        self.rate_limited = 0
+        self.hung = 0
+        self.timed_out = 0
+        self.api_key = None
+
+    def _draw(self) -> tuple:
+        """1回の呼び出しの遅延と結果の種類を決める（スレッドから呼ばれる）"""
+        with self._lock:
+            self.calls += 1
+            # 対数正規分布で本物らしい裾の長いレイテンシにする
+            delay = self.latency * self._random.lognormvariate(0.0, self.jitter)
+            roll = self._random.random()
+            if roll < self.hang_rate:
+                # 応答が返らない接続（期限を指定しなければ hang_seconds 待たされる）
+                self.hung += 1
+                return self.hang_seconds, "ok", None
+            roll -= self.hang_rate
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return delay * 0.1, "rate_limited", None
+            roll -= self.rate_limit_rate
+            if roll < self.error_rate:
+                self.errors += 1
+                return delay, "error", None
+            roll -= self.error_rate
+            if roll < self.malformed_rate:
+                self.malformed += 1
+                return delay, "malformed", self._random.random()
+            return delay, "ok", None
+
+    def respond(
+        self,
+        contents=None,
+        generation_config=None,
+        stream: bool = False,
+        request_options=None,
+    ):
+        """generate_content の代わりに応答を作る
+
+        response_schema が配列なら、送られた画像の数だけ index 付きの分析を返す。
+        """
+        delay, kind, cut = self._draw()
+        schema = (generation_config or {}).get("response_schema") or {}
+        if schema.get("type") == "array":
+            fields = schema.get("items", {}).get("properties") or SAMPLE_ANALYSIS
+            analysis = {k: v for k, v in SAMPLE_ANALYSIS.items() if k in fields}
+            images = [part for part in contents or [] if not isinstance(part, str)]
+            payload = [{"index": index, **analysis} for index in range(len(images))]
+        else:
+            fields = schema.get("properties") or SAMPLE_ANALYSIS
+            payload = {k: v for k, v in SAMPLE_ANALYSIS.items() if k in fields}
+        text = json.dumps(payload, ensure_ascii=False)
+        # 出力が長いほど生成に時間がかかる
+        delay += len(text) / 1000 * self.output_latency
+
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and delay > timeout and not stream:
+            time.sleep(timeout)
+            with self._lock:
+                self.timed_out += 1
+            raise FakeAPIError(504, "Deadline Exceeded")
+        if kind == "rate_limited":
+            time.sleep(delay)
+            raise FakeAPIError(429, "Resource has been exhausted (e.g. check quota).")
+        if kind == "error":
+            time.sleep(delay)
+            raise FakeAPIError(503, "The service is currently unavailable.")
+
+        if kind == "malformed":
+            # 途中で切れた応答（修復できるものも、できないものもある）
+            text = "以下が分析結果です。\n" + text[: max(1, int(len(text) * cut))]
+
+        if not stream:
+            time.sleep(delay)
+            return types.SimpleNamespace(text=text)
+        return self._stream(text, delay)
+
+    def _stream(self, text: str, delay: float):
+        size = max(1, -(-len(text) // self.stream_chunks))
+        for start in range(0, len(text), size):
+            time.sleep(delay / self.stream_chunks)
+            yield types.SimpleNamespace(text=text[start : start + size])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "malformed": self.malformed,
+                "rate_limited": self.rate_limited,
+                "hung": self.hung,
+                "timed_out": self.timed_out,
+            }
+
+    def module(self) -> types.ModuleType:
+        """google.generativeai と同じ名前を持つモジュールを作る"""
+        backend = self
+        genai = types.ModuleType("google.generativeai")
+
+        def configure(api_key: str = None, **kwargs) -> None:
+            backend.api_key = api_key
+
+        class GenerativeModel:
+            def __init__(self, model_name: str, generation_config=None, **kwargs):
+                self.model_name = model_name
+                self.generation_config = generation_config
+
+            def generate_content(
+                self, contents, stream: bool = False, request_options=None, **kwargs
+            ):
+                return backend.respond(
+                    contents, self.generation_config, stream, request_options
+                )
+
+        genai.configure = configure
+        genai.GenerativeModel = GenerativeModel
+        genai.fake_backend = backend
+        return genai
+
+    def install(self) -> types.ModuleType:
+        """sys.modules に登録し、以降の import google.generativeai で使われるようにする"""
+        genai = self.module()
+        try:
+            import google
+        except ImportError:
+            google = types.ModuleType("google")
+            google.__path__ = []
+            sys.modules["google"] = google
+        google.generativeai = genai
+        sys.modules["google.generativeai"] = genai
+        return genai
@@ -3,52 +3,88 @@
 Feng Shui compatibility analyzer using Google Gemini API
 """
 
-import google.generativeai as genai
+import asyncio
+from dataclasses import dataclass
 from datetime import datetime
-from PIL import Image
+from functools import lru_cache
+from typing import Awaitable, Callable
+from PIL import Image, ImageOps
 import io
 import base64
 import logging
 import traceback
 import hashlib
+import heapq
+import re
 import os
 import tempfile
+import threading
+import time
+from analysis_cache import get_analysis_cache, make_cache_key
+from analysis_json import (
+    AnalysisParseError,
+    IncrementalObjectParser,
+    parse_json_array,
+    parse_json_object,
+)
+from metrics import (
+    ANALYSES_TOTAL,
+    DEADLINE_EXCEEDED_TOTAL,
+    FALLBACK_DEPTH,
+    FALLBACK_DEPTH_BUCKETS,
+    HEDGES_TOTAL,
+    MODEL_CALLS_TOTAL,
+    MODEL_LATENCY_SECONDS,
+    STAGE_SECONDS,
+    get_metrics,
+)
+from model_router import (
+    ERROR_FATAL,
+    HEDGE_BACKUP_WON,
+    HEDGE_FAILED,
+    HEDGE_NONE,
+    HEDGE_PRIMARY_WON,
+    HEDGE_SKIPPED,
+    get_model_router,
+)
+from result_store import get_result_store
+from single_flight import get_single_flight
+from sexagenary import (
+    ELEMENT_ORDER,
+    ZODIAC_ANIMALS,
+    ZODIAC_ELEMENTS,
+    lookup_sexagenary,
+    sexagenary_of_year,
+)
+from rate_limiter import get_rate_limiter
 
-# ロギング設定（クロスプラットフォーム）
-try:
-    # 優先順: 環境変数 -> ワークスペース内の logs ディレクトリ -> OS の一時ディレクトリ
-    log_dir = os.environ.get("FENGSHUI_LOG_DIR") or os.path.join(os.getcwd(), "logs")
-    os.makedirs(log_dir, exist_ok=True)
-    log_path = os.path.join(log_dir, "error.log")
-
-    logging.basicConfig(
-        filename=log_path,
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        encoding="utf-8",
-    )
-except Exception:
-    # ファイル出力ができない環境では標準エラーへフォールバック
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-    )
 
-# 十二支の計算
-ZODIAC_ANIMALS = [
-    "子(鼠)",
-    "丑(牛)",
-    "寅(虎)",
-    "卯(兎)",
-    "辰(龍)",
-    "巳(蛇)",
-    "午(馬)",
-    "未(羊)",
-    "申(猿)",
-    "酉(鶏)",
-    "戌(犬)",
-    "亥(猪)",
-]
+def configure_logging() -> None:
+    """ロギング設定（クロスプラットフォーム）
+
+    インポート時には何もしないため、アプリやCLIなどのエントリーポイントから呼び出す。
+    """
+    try:
+        # 優先順: 環境変数 -> ワークスペース内の logs ディレクトリ
+        log_dir = os.environ.get("FENGSHUI_LOG_DIR") or os.path.join(
+            os.getcwd(), "logs"
+        )
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, "error.log")
+
+        logging.basicConfig(
+            filename=log_path,
+            level=logging.INFO,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+            encoding="utf-8",
+        )
+    except Exception:
+        # ファイル出力ができない環境では標準エラーへフォールバック
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+
 
 # 五行の対応関係
 FIVE_ELEMENTS = {
@@ -61,85 +97,294 @@ FIVE_ELEMENTS = {
 
 
 def calculate_zodiac(birth_year: int) -> str:
-    """生年から干支を計算"""
-    base_year = 1924
-    index = (birth_year - base_year) % 12
-    return ZODIAC_ANIMALS[index]
+    """生年から十二支を計算（立春の前後を区別する場合は lookup_sexagenary を使う）"""
+    return sexagenary_of_year(birth_year).zodiac
 
 
 def get_element_from_zodiac(zodiac: str) -> str:
-    """干支から五行を判定"""
-    element_map = {
-        "子(鼠)": "水",
-        "亥(猪)": "水",
-        "寅(虎)": "木",
-        "卯(兎)": "木",
-        "巳(蛇)": "火",
-        "午(馬)": "火",
-        "申(猿)": "金",
-        "酉(鶏)": "金",
-        "丑(牛)": "土",
-        "辰(龍)": "土",
-        "未(羊)": "土",
-        "戌(犬)": "土",
-    }
-    return element_map.get(zodiac, "土")
+    """十二支から五行を判定"""
+    return ZODIAC_ELEMENTS.get(zodiac, "土")
 
 
-def calculate_element_compatibility(element1: str, element2: str) -> dict:
-    """五行の相性を計算"""
-    generating_cycle = {"木": "火", "火": "土", "土": "金", "金": "水", "水": "木"}
-    overcoming_cycle = {"木": "土", "土": "水", "水": "火", "火": "金", "金": "木"}
+# 五行の相生・相克
+GENERATING_CYCLE = {"木": "火", "火": "土", "土": "金", "金": "水", "水": "木"}
+OVERCOMING_CYCLE = {"木": "土", "土": "水", "水": "火", "火": "金", "金": "木"}
+
+# 関係ごとの相性スコアと説明
+COMPATIBILITY_RESULTS = {
+    "相生": {
+        "relationship": "相生",
+        "score": 90,
+        "description": "お互いを助け合う良い相性です",
+    },
+    "相克": {
+        "relationship": "相克",
+        "score": 40,
+        "description": "一方が他方を抑制する関係です",
+    },
+    "被克": {
+        "relationship": "被克",
+        "score": 45,
+        "description": "抑制される関係ですが、成長の機会にもなります",
+    },
+    "同気": {
+        "relationship": "同気",
+        "score": 70,
+        "description": "同じ気を持つ安定した関係です",
+    },
+    "平和": {"relationship": "平和", "score": 65, "description": "穏やかな関係です"},
+}
+
+# 一括計算で使う五行の添字（並びは ELEMENT_ORDER）
+ELEMENT_INDEX = {element: index for index, element in enumerate(ELEMENT_ORDER)}
+
+# 総合スコアの重み
+FORTUNE_WEIGHT = 0.3
+WEALTH_WEIGHT = 0.4
+COMPATIBILITY_WEIGHT = 0.3
 
+
+def _element_relationship(element1: str, element2: str) -> str:
+    """2つの五行の関係名を判定"""
     if (
-        generating_cycle.get(element1) == element2
-        or generating_cycle.get(element2) == element1
+        GENERATING_CYCLE.get(element1) == element2
+        or GENERATING_CYCLE.get(element2) == element1
     ):
-        return {
-            "relationship": "相生",
-            "score": 90,
-            "description": "お互いを助け合う良い相性です",
-        }
-    elif overcoming_cycle.get(element1) == element2:
-        return {
-            "relationship": "相克",
-            "score": 40,
-            "description": "一方が他方を抑制する関係です",
-        }
-    elif overcoming_cycle.get(element2) == element1:
-        return {
-            "relationship": "被克",
-            "score": 45,
-            "description": "抑制される関係ですが、成長の機会にもなります",
-        }
+        return "相生"
+    elif OVERCOMING_CYCLE.get(element1) == element2:
+        return "相克"
+    elif OVERCOMING_CYCLE.get(element2) == element1:
+        return "被克"
     elif element1 == element2:
-        return {
-            "relationship": "同気",
-            "score": 70,
-            "description": "同じ気を持つ安定した関係です",
-        }
+        return "同気"
     else:
-        return {"relationship": "平和", "score": 65, "description": "穏やかな関係です"}
+        return "平和"
 
 
-async def analyze_face_fengshui(
-    image: Image.Image, api_key: str, person_name: str = "女性"
-) -> dict:
-    """Gemini APIを使用して顔相を分析"""
-    genai.configure(api_key=api_key)
-
-    models_to_try = [
-        "models/gemini-2.5-flash",
-        "models/gemini-flash-latest",
-        "models/gemini-2.0-flash",
-        "models/gemini-pro-latest",
-        "models/gemini-2.5-pro",
-    ]
+# 5×5の関係表（ELEMENT_ORDER の添字で引く）
+RELATIONSHIP_TABLE = [
+    [_element_relationship(e1, e2) for e2 in ELEMENT_ORDER] for e1 in ELEMENT_ORDER
+]
 
-    prompt = f"""
-この{person_name}の顔写真を風水・人相学の観点から分析してください。以下の要素を考慮してください：
 
-1. **顔の輪郭**: 丸顔、面長、四角、卵型などの形状とその風水的意味
+def calculate_element_compatibility(element1: str, element2: str) -> dict:
+    """五行の相性を計算"""
+    index1 = ELEMENT_INDEX.get(element1)
+    index2 = ELEMENT_INDEX.get(element2)
+    if index1 is None or index2 is None:
+        relationship = _element_relationship(element1, element2)
+    else:
+        relationship = RELATIONSHIP_TABLE[index1][index2]
+    return dict(COMPATIBILITY_RESULTS[relationship])
+
+
+@lru_cache(maxsize=1)
+def _compatibility_score_matrix():
+    """5×5の相性スコア行列（NumPy配列、初回のみ作成）"""
+    import numpy as np
+
+    return np.array(
+        [
+            [COMPATIBILITY_RESULTS[relationship]["score"] for relationship in row]
+            for row in RELATIONSHIP_TABLE
+        ],
+        dtype=np.int16,
+    )
+
+
+def encode_elements(elements):
+    """五行（文字列または ELEMENT_ORDER の添字）の配列を添字の配列に変換"""
+    import numpy as np
+
+    array = np.asarray(elements)
+    if array.dtype.kind in "iu":
+        codes = array.astype(np.intp)
+    else:
+        # 五行は5種類しかないので、要素ごとの辞書引きより5回の一括比較の方が速い
+        codes = np.full(array.shape, -1, dtype=np.intp)
+        for index, element in enumerate(ELEMENT_ORDER):
+            codes[array == element] = index
+    if codes.size and (codes.min() < 0 or codes.max() >= len(ELEMENT_ORDER)):
+        unknown = np.ravel(array)[np.ravel(codes) < 0]
+        raise ValueError(
+            f"Unknown element: {unknown[0] if unknown.size else 'index out of range'}"
+        )
+    return codes
+
+
+def bulk_element_compatibility(elements1, elements2):
+    """五行の組の配列から相性スコアの配列を一括計算（ブロードキャスト対応）"""
+    matrix = _compatibility_score_matrix()
+    return matrix[encode_elements(elements1), encode_elements(elements2)]
+
+
+def bulk_total_scores(fortune_scores, wealth_scores, elements1, elements2):
+    """総合スコアを一括計算（calculate_total_score と同じ丸め結果）"""
+    import numpy as np
+
+    compatibility = bulk_element_compatibility(elements1, elements2)
+    total = (
+        np.asarray(fortune_scores, dtype=np.float64) * FORTUNE_WEIGHT
+        + np.asarray(wealth_scores, dtype=np.float64) * WEALTH_WEIGHT
+        + compatibility * COMPATIBILITY_WEIGHT
+    )
+    rounded = np.array(np.round(total, 1))
+    # total*10 の誤差で丸め方向が変わりうる中間値だけ Python の round で計算し直す
+    scaled = total * 10
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [round(value, 1) for value in total[near_tie].tolist()]
+    return rounded
+
+
+# 分析に失敗したときの face_shape（劣化結果の判定に使う）
+FAILED_FACE_SHAPE = "分析失敗"
+
+# プロンプトを変更したら更新する（キャッシュキーに含まれる）
+PROMPT_VERSION = "v2"
+
+# 分析の詳しさ。scores は顔の形とスコアだけを返す選考用の短い分析で、
+# 出力が短い分だけ速い。full は従来の詳細な分析
+TIER_FULL = "full"
+TIER_SCORES = "scores"
+ANALYSIS_TIERS = (TIER_FULL, TIER_SCORES)
+PROMPT_VERSIONS = {TIER_FULL: PROMPT_VERSION, TIER_SCORES: "scores-v1"}
+# スコアのみで順位付けしたあと、詳細に分析する上位の人数
+DEFAULT_DETAIL_TOP = int(os.environ.get("FENGSHUI_DETAIL_TOP", "3"))
+
+# 試行するモデル（優先順）
+MODELS_TO_TRY = [
+    "models/gemini-2.5-flash",
+    "models/gemini-flash-latest",
+    "models/gemini-2.0-flash",
+    "models/gemini-pro-latest",
+    "models/gemini-2.5-pro",
+]
+
+# 複数画像を同時に分析するときの最大並列数
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("FENGSHUI_MAX_CONCURRENCY", "4"))
+
+# ヘッジ: 先頭のモデルがレイテンシのこのパーセンタイルを過ぎても応答しなければ、
+# 次のモデルにも同じリクエストを送る（記録が少ない間は HEDGE_DELAY 秒を使う）
+HEDGE_ENABLED = os.environ.get("FENGSHUI_HEDGE", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("FENGSHUI_HEDGE_PERCENTILE", "95"))
+HEDGE_DELAY = float(os.environ.get("FENGSHUI_HEDGE_DELAY", "10"))
+
+# 1回のモデル呼び出しの上限と、フォールバックを含めた1件の分析全体の期限（秒、0で無制限）
+ATTEMPT_TIMEOUT = float(os.environ.get("FENGSHUI_ATTEMPT_TIMEOUT", "30"))
+ANALYSIS_TIMEOUT = float(os.environ.get("FENGSHUI_ANALYSIS_TIMEOUT", "90"))
+
+# アップロード前の画像前処理の既定値
+DEFAULT_MAX_IMAGE_EDGE = int(os.environ.get("FENGSHUI_MAX_IMAGE_EDGE", "1024"))
+DEFAULT_JPEG_QUALITY = int(os.environ.get("FENGSHUI_JPEG_QUALITY", "85"))
+DEFAULT_MAX_IMAGE_BYTES = int(os.environ.get("FENGSHUI_MAX_IMAGE_BYTES", "400000"))
+MIN_JPEG_QUALITY = 50
+# 顔検出枠の周囲に残す余白（枠サイズに対する比率）
+FACE_CROP_MARGIN = 0.6
+# 集合写真モード: 小さな顔も見つけるため、通常より大きめの縮小画像で検出する
+GROUP_DETECT_EDGE = 1280
+FACE_TILE_EDGE = 512
+DEFAULT_MAX_GROUP_FACES = int(os.environ.get("FENGSHUI_MAX_GROUP_FACES", "6"))
+# 大きな写真は長辺がこの値以下の作業用コピーとして扱う。顔を切り出しても
+# 送信サイズ（DEFAULT_MAX_IMAGE_EDGE）程度の解像度が残るよう、それより大きくする
+WORKING_IMAGE_EDGE = int(
+    os.environ.get("FENGSHUI_WORKING_IMAGE_EDGE", str(DEFAULT_MAX_IMAGE_EDGE * 3 // 2))
+)
+
+
+# 構造化出力のスキーマ（Gemini の response_schema 形式）
+ANALYSIS_TEXT_FIELDS = [
+    "face_shape",
+    "face_shape_meaning",
+    "eyes_analysis",
+    "nose_analysis",
+    "mouth_analysis",
+    "forehead_analysis",
+    "ears_analysis",
+    "complexion_analysis",
+    "overall_impression",
+    "wealth_potential",
+]
+ANALYSIS_SCORE_FIELDS = ["fortune_score", "wealth_fortune_score"]
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{field: {"type": "string"} for field in ANALYSIS_TEXT_FIELDS},
+        **{
+            field: {"type": "integer", "description": "0から100の整数"}
+            for field in ANALYSIS_SCORE_FIELDS
+        },
+        "strengths": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ANALYSIS_TEXT_FIELDS + ANALYSIS_SCORE_FIELDS + ["strengths"],
+}
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ANALYSIS_SCHEMA,
+}
+# 複数人をまとめて分析するときのスキーマ（画像番号 index 付きの配列）
+BATCH_ANALYSIS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer", "description": "画像番号"},
+            **ANALYSIS_SCHEMA["properties"],
+        },
+        "required": ["index"] + ANALYSIS_SCHEMA["required"],
+    },
+}
+BATCH_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": BATCH_ANALYSIS_SCHEMA,
+}
+# スコアのみの分析のスキーマ（順位付けに必要な項目だけ）
+SCORES_FIELDS = ["face_shape"] + ANALYSIS_SCORE_FIELDS
+SCORES_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        field: ANALYSIS_SCHEMA["properties"][field] for field in SCORES_FIELDS
+    },
+    "required": SCORES_FIELDS,
+}
+BATCH_SCORES_ANALYSIS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": BATCH_ANALYSIS_SCHEMA["items"]["properties"]["index"],
+            **SCORES_ANALYSIS_SCHEMA["properties"],
+        },
+        "required": ["index"] + SCORES_FIELDS,
+    },
+}
+# get_generative_model で使う設定の名前
+GENERATION_CONFIGS = {
+    "single": GENERATION_CONFIG,
+    "batch": BATCH_GENERATION_CONFIG,
+    "scores": {
+        "response_mime_type": "application/json",
+        "response_schema": SCORES_ANALYSIS_SCHEMA,
+    },
+    "batch_scores": {
+        "response_mime_type": "application/json",
+        "response_schema": BATCH_SCORES_ANALYSIS_SCHEMA,
+    },
+}
+# 分析の詳しさごとの (1人ずつ, まとめて) の設定名と必須項目
+TIER_CONFIG_NAMES = {
+    TIER_FULL: ("single", "batch"),
+    TIER_SCORES: ("scores", "batch_scores"),
+}
+TIER_REQUIRED_FIELDS = {
+    TIER_FULL: ANALYSIS_SCHEMA["required"],
+    TIER_SCORES: SCORES_ANALYSIS_SCHEMA["required"],
+}
+
+# 1回のリクエストにまとめる最大人数（超える分は複数リクエストに分ける）
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get("FENGSHUI_MAX_BATCH_SIZE", "6"))
+
+ANALYSIS_CRITERIA = """1. **顔の輪郭**: 丸顔、面長、四角、卵型などの形状とその風水的意味
 2. **目**: 大きさ、形、位置、輝きから見る運勢（特に金運との関連）
 3. **鼻**: 高さ、大きさ、形から見る財運
 4. **口**: 形、大きさから見る対人運と金運
@@ -148,7 +393,15 @@ async def analyze_face_fengshui(
 7. **顔色・肌**: 明るさ、血色から見る健康運と金運
 8. **全体的な印象**: 調和、バランスから見る総合運
 
-特に**金運（財運）**に関する分析を重点的にお願いします。
+特に**金運（財運）**に関する分析を重点的にお願いします。"""
+
+
+def build_analysis_prompt(person_name: str = "女性") -> str:
+    """顔相分析用のプロンプトを生成"""
+    return f"""
+この{person_name}の顔写真を風水・人相学の観点から分析してください。以下の要素を考慮してください：
+
+{ANALYSIS_CRITERIA}
 
 分析結果は以下のJSON形式で返してください：
 {{
@@ -170,39 +423,722 @@ async def analyze_face_fengshui(
 必ずJSON形式で返答してください。
 """
 
-    last_error = None
 
-    for model_name in models_to_try:
+def build_batch_analysis_prompt(person_names: list) -> str:
+    """複数人の顔写真をまとめて分析するプロンプトを生成"""
+    people = "\n".join(
+        f"- 画像{index}: {name}" for index, name in enumerate(person_names)
+    )
+    return f"""
+これから{len(person_names)}人分の顔写真を順に送ります。各画像の直前に「画像番号: 名前」を記載します。
+
+{people}
+
+それぞれの顔写真を風水・人相学の観点から個別に分析してください。以下の要素を考慮してください：
+
+{ANALYSIS_CRITERIA}
+
+分析結果は、1人につき1つのオブジェクトを持つJSON配列で返してください。
+各オブジェクトには画像番号を "index" として含め、以下の項目をすべて記載してください：
+{{
+    "index": 0,
+    "face_shape": "顔の形（例：丸顔）",
+    "face_shape_meaning": "顔の形の風水的意味",
+    "eyes_analysis": "目の分析結果",
+    "nose_analysis": "鼻の分析結果（財運との関連を含む）",
+    "mouth_analysis": "口の分析結果",
+    "forehead_analysis": "額の分析結果",
+    "ears_analysis": "耳の分析結果",
+    "complexion_analysis": "顔色・肌の分析結果",
+    "fortune_score": 85,
+    "wealth_fortune_score": 80,
+    "overall_impression": "全体的な印象と総合評価",
+    "strengths": ["強み1", "強み2", "強み3"],
+    "wealth_potential": "金運のポテンシャルについての詳細な説明"
+}}
+
+必ず{len(person_names)}人分すべてを含むJSON配列で返答してください。
+"""
+
+
+def build_scores_prompt(person_name: str = "女性") -> str:
+    """スコアのみの分析用のプロンプトを生成（説明文は出力させない）"""
+    return f"""
+この{person_name}の顔写真を風水・人相学の観点から評価してください。以下の要素を考慮してください：
+
+{ANALYSIS_CRITERIA}
+
+説明文は不要です。顔の形とスコアだけを以下のJSON形式で返してください：
+{{
+    "face_shape": "顔の形（例：丸顔）",
+    "fortune_score": 85,
+    "wealth_fortune_score": 80
+}}
+
+必ずJSON形式で返答してください。
+"""
+
+
+def build_batch_scores_prompt(person_names: list) -> str:
+    """複数人の顔写真をまとめてスコアのみ評価するプロンプトを生成"""
+    people = "\n".join(
+        f"- 画像{index}: {name}" for index, name in enumerate(person_names)
+    )
+    return f"""
+これから{len(person_names)}人分の顔写真を順に送ります。各画像の直前に「画像番号: 名前」を記載します。
+
+{people}
+
+それぞれの顔写真を風水・人相学の観点から個別に評価してください。以下の要素を考慮してください：
+
+{ANALYSIS_CRITERIA}
+
+説明文は不要です。1人につき1つのオブジェクトを持つJSON配列で、画像番号を "index" として
+含め、顔の形とスコアだけを返してください：
+{{
+    "index": 0,
+    "face_shape": "顔の形（例：丸顔）",
+    "fortune_score": 85,
+    "wealth_fortune_score": 80
+}}
+
+必ず{len(person_names)}人分すべてを含むJSON配列で返答してください。
+"""
+
+
+# 分析の詳しさごとの (1人ずつ, まとめて) のプロンプト
+TIER_PROMPT_BUILDERS = {
+    TIER_FULL: (build_analysis_prompt, build_batch_analysis_prompt),
+    TIER_SCORES: (build_scores_prompt, build_batch_scores_prompt),
+}
+
+
+def _check_tier(tier: str) -> str:
+    if tier not in ANALYSIS_TIERS:
+        raise ValueError(f"tier must be one of {ANALYSIS_TIERS}: {tier!r}")
+    return tier
+
+
+def analysis_tier(analysis: dict) -> str:
+    """分析結果の詳しさ（スコアのみの結果には analysis_tier が付く）"""
+    return analysis.get("analysis_tier", TIER_FULL)
+
+
+# 画像指紋の計算単位
+_FINGERPRINT_CHUNK_BYTES = 1024 * 1024
+_FINGERPRINT_BAND_ROWS = 256
+
+# 画像指紋から五行を割り当てる順序（割り当て結果を変えないため並びは固定）
+IMAGE_ELEMENTS = ["金", "水", "木", "火", "土"]
+
+
+def image_fingerprint(source) -> str:
+    """画像の指紋（SHA-256）を再エンコードせずに計算
+
+    アップロードされた元のバイト列・ファイルオブジェクトはそのままチャンク単位で、
+    PIL画像は生のピクセルバッファを行ブロック単位でハッシュする。
+    PIL画像はその場で編集（paste など）されうるため、結果を再利用せず毎回計算する。
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+
+    if isinstance(source, Image.Image):
+        hasher = hashlib.sha256()
+        hasher.update(f"{source.mode}|{source.size}".encode("utf-8"))
+        for top in range(0, source.height, _FINGERPRINT_BAND_ROWS):
+            bottom = min(source.height, top + _FINGERPRINT_BAND_ROWS)
+            hasher.update(source.crop((0, top, source.width, bottom)).tobytes())
+        return hasher.hexdigest()
+
+    # ファイルオブジェクト（Streamlit の UploadedFile など）は読み取り位置を戻す
+    hasher = hashlib.sha256()
+    position = source.tell()
+    source.seek(0)
+    try:
+        for chunk in iter(lambda: source.read(_FINGERPRINT_CHUNK_BYTES), b""):
+            hasher.update(chunk)
+    finally:
+        source.seek(position)
+    return hasher.hexdigest()
+
+
+def get_element_from_image(image) -> str:
+    """画像の指紋から五行を判定（同じ画像なら常に同じ結果）"""
+    try:
+        fingerprint = image_fingerprint(image)
+        element = IMAGE_ELEMENTS[int(fingerprint[:8], 16) % len(IMAGE_ELEMENTS)]
+        logging.info(f"Image fingerprint: {fingerprint[:12]}, Element: {element}")
+        return element
+    except Exception as e:
+        logging.warning(f"Image fingerprint failed: {str(e)}")
+        return "土"
+
+
+@dataclass
+class PreparedImage:
+    """Geminiへ送信する前処理済み画像"""
+
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    width: int
+    height: int
+    passthrough: bool = False
+    face_cropped: bool = False
+
+    @property
+    def saved_bytes(self) -> int:
+        """前処理で削減したバイト数"""
+        return max(0, self.original_bytes - len(self.data))
+
+    def as_part(self) -> dict:
+        """generate_content に渡せる形式に変換"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+# CascadeClassifier はスレッドセーフではないため、読み込みと検出は1つずつ行う
+_face_cascade_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_face_cascade():
+    """OpenCVの顔検出器を読み込む（未インストールならNone）"""
+    try:
+        import cv2
+
+        cascade_class = cv2.CascadeClassifier
+    except (ImportError, AttributeError):
+        logging.info("opencv face detector is unavailable; face cropping is disabled")
+        return None
+    cascade = cascade_class(
+        os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+    )
+    return None if cascade.empty() else cascade
+
+
+def detect_face_boxes(image: Image.Image, detect_edge: int = 640) -> list:
+    """画像内の顔の位置 (left, top, right, bottom) を大きい順に返す"""
+    with _face_cascade_lock:
+        cascade = _load_face_cascade()
+    if cascade is None:
+        return []
+    import numpy as np
+
+    # 検出は縮小したグレースケール画像で行い、座標を元のサイズに戻す
+    gray = image.convert("L")
+    scale = min(1.0, detect_edge / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize(
+            (max(1, int(gray.width * scale)), max(1, int(gray.height * scale))),
+            Image.BILINEAR,
+        )
+    with _face_cascade_lock:
+        faces = cascade.detectMultiScale(
+            np.asarray(gray), scaleFactor=1.1, minNeighbors=5, minSize=(24, 24)
+        )
+    boxes = [
+        (
+            int(x / scale),
+            int(y / scale),
+            int((x + w) / scale),
+            int((y + h) / scale),
+        )
+        for (x, y, w, h) in faces
+    ]
+    boxes.sort(key=lambda b: (b[2] - b[0]) * (b[3] - b[1]), reverse=True)
+    return boxes
+
+
+def crop_to_face(
+    image: Image.Image, box: tuple, margin: float = FACE_CROP_MARGIN
+) -> Image.Image:
+    """顔の枠に余白を付けて切り出す（髪・耳・顎まで含める）"""
+    left, top, right, bottom = box
+    pad_x = int((right - left) * margin)
+    pad_y = int((bottom - top) * margin)
+    return image.crop(
+        (
+            max(0, left - pad_x),
+            max(0, top - pad_y),
+            min(image.width, right + pad_x),
+            min(image.height, bottom + pad_y),
+        )
+    )
+
+
+def image_nbytes(image: Image.Image) -> int:
+    """デコード済みピクセルが占めるおおよそのバイト数"""
+    return image.width * image.height * len(image.getbands())
+
+
+def _draft_for_edge(image: Image.Image, max_edge: int) -> None:
+    """未デコードのJPEGを、長辺が max_edge 以上残る範囲で縮小デコードさせる
+
+    JPEGはデコード時に 1/2・1/4・1/8 へ縮小できるため、フル解像度の
+    ピクセルをメモリに展開せずに済む（JPEG以外・小さい画像では何もしない）。
+    """
+    if not max_edge or image.format != "JPEG" or max(image.size) <= max_edge:
+        return
+    scale = max_edge / max(image.size)
+    image.draft(
+        "RGB",
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+    )
+
+
+def _exif_transpose(image: Image.Image, owned: bool) -> Image.Image:
+    """EXIFの向きを補正（向きが正しければコピーを作らない）"""
+    if image.getexif().get(0x0112, 1) == 1:
+        return image
+    if owned:
+        ImageOps.exif_transpose(image, in_place=True)
+        return image
+    return ImageOps.exif_transpose(image)
+
+
+def open_image(source, max_edge: int = WORKING_IMAGE_EDGE) -> Image.Image:
+    """画像を長辺 max_edge 以下のRGBの作業用コピーとして読み込む
+
+    バイト列・ファイルオブジェクト・PIL画像を受け付ける。JPEGは縮小デコードし、
+    EXIFの向きは補正済みで返す。ファイルオブジェクトの読み取り位置は戻す。
+    """
+    if isinstance(source, Image.Image):
+        image = _exif_transpose(source, owned=False)
+    else:
+        position = None
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        else:
+            position = source.tell()
         try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content([prompt, image])
+            image = Image.open(source)
+            _draft_for_edge(image, max_edge)
+            image.load()
+        finally:
+            if position is not None:
+                source.seek(position)
+        image = _exif_transpose(image, owned=True)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max_edge and max(image.size) > max_edge:
+        image = ImageOps.contain(image, (max_edge, max_edge), Image.LANCZOS)
+    elif image is source:
+        image = image.copy()
+    return image
 
-            import json
-            import re
 
-            response_text = response.text
-            json_match = re.search(r"```json\s*(.*?)\s*```", response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-            else:
-                json_str = response_text
+def _encode_jpeg(image: Image.Image, quality: int, max_bytes: int) -> tuple:
+    """JPEGに圧縮し、上限を超える場合は品質を下げて再圧縮"""
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+        if len(data) <= max_bytes or quality <= MIN_JPEG_QUALITY:
+            return data, quality
+        quality = max(MIN_JPEG_QUALITY, quality - 10)
 
-            analysis_result = json.loads(json_str)
-            return analysis_result
 
-        except Exception as e:
-            error_msg = f"Model {model_name} failed: {str(e)}\n{traceback.format_exc()}"
-            logging.error(error_msg)
-            last_error = e
-            continue
+def preprocess_image(
+    source,
+    max_edge: int = DEFAULT_MAX_IMAGE_EDGE,
+    quality: int = DEFAULT_JPEG_QUALITY,
+    max_bytes: int = DEFAULT_MAX_IMAGE_BYTES,
+    crop_face: bool = True,
+    decode_edge: int = WORKING_IMAGE_EDGE,
+) -> PreparedImage:
+    """EXIF回転・顔の切り出し・縮小・再圧縮を行いアップロード用の画像を作成
+
+    大きなJPEGは長辺 decode_edge 程度に縮小デコードする（0ならフル解像度）。
+    """
+    owned = isinstance(source, (bytes, bytearray))
+    if owned:
+        original_bytes = len(source)
+        image = Image.open(io.BytesIO(source))
+        # 予算内のJPEGはデコード・再エンコードせずにそのまま送る
+        orientation = image.getexif().get(0x0112, 1)
+        if (
+            image.format == "JPEG"
+            and orientation == 1
+            and max(image.size) <= max_edge
+            and original_bytes <= max_bytes
+        ):
+            return PreparedImage(
+                data=bytes(source),
+                mime_type="image/jpeg",
+                original_bytes=original_bytes,
+                width=image.width,
+                height=image.height,
+                passthrough=True,
+            )
+        _draft_for_edge(image, decode_edge)
+    else:
+        image = source
+        # PIL画像の場合はデコード済みピクセルのサイズを元のサイズとみなす
+        original_bytes = image.width * image.height * len(image.getbands())
+
+    metrics = get_metrics()
+    with metrics.stage("decode"):
+        # PILは遅延デコードなので、ここで明示的にデコードして計測を分ける
+        image.load()
+        image = _exif_transpose(image, owned)
+
+    face_cropped = False
+    if crop_face:
+        with metrics.stage("face_detect"):
+            boxes = detect_face_boxes(image)
+        if boxes:
+            image = crop_to_face(image, boxes[0])
+            face_cropped = True
+
+    with metrics.stage("encode"):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if max(image.size) > max_edge:
+            image = ImageOps.contain(image, (max_edge, max_edge), Image.LANCZOS)
+
+        data, used_quality = _encode_jpeg(image, quality, max_bytes)
+    prepared = PreparedImage(
+        data=data,
+        mime_type="image/jpeg",
+        original_bytes=original_bytes,
+        width=image.width,
+        height=image.height,
+        face_cropped=face_cropped,
+    )
+    logging.info(
+        f"Preprocessed image: {original_bytes} -> {len(data)} bytes "
+        f"(saved {prepared.saved_bytes}, quality {used_quality}, "
+        f"{image.width}x{image.height}, face_cropped={face_cropped})"
+    )
+    return prepared
+
+
+@dataclass
+class FaceTile:
+    """集合写真から切り出した1人分の顔画像（JPEG）"""
+
+    data: bytes
+    box: tuple
+    width: int
+    height: int
+
+    def to_image(self) -> Image.Image:
+        """表示用にPIL画像へ戻す"""
+        return Image.open(io.BytesIO(self.data))
+
+
+def extract_face_tiles(
+    source,
+    max_faces: int = DEFAULT_MAX_GROUP_FACES,
+    tile_edge: int = FACE_TILE_EDGE,
+    detect_edge: int = GROUP_DETECT_EDGE,
+) -> list:
+    """集合写真から顔を検出し、切り出して縮小した顔タイルを左から順に返す
+
+    大きく写っている顔から最大 max_faces 人を選ぶ。タイルは送信サイズの上限内の
+    JPEGなので、分析時の前処理では再エンコードされない。
+    """
+    # 小さく写った顔の解像度を保つため、集合写真は縮小デコードしない
+    owned = isinstance(source, (bytes, bytearray))
+    if owned:
+        source = Image.open(io.BytesIO(source))
+    image = _exif_transpose(source, owned)
+
+    with get_metrics().stage("face_detect"):
+        boxes = detect_face_boxes(image, detect_edge)[: max(0, max_faces)]
+    boxes.sort(key=lambda box: (box[0], box[1]))
+
+    tiles = []
+    for box in boxes:
+        tile = crop_to_face(image, box)
+        if tile.mode != "RGB":
+            tile = tile.convert("RGB")
+        tile.thumbnail((tile_edge, tile_edge), Image.LANCZOS)
+        data, _ = _encode_jpeg(tile, DEFAULT_JPEG_QUALITY, DEFAULT_MAX_IMAGE_BYTES)
+        tiles.append(FaceTile(data=data, box=box, width=tile.width, height=tile.height))
+    logging.info(f"Extracted {len(tiles)} face tiles from {image.width}x{image.height}")
+    return tiles
+
+
+_configured_api_key = None
+_configure_lock = threading.Lock()
+
+
+def _load_genai():
+    """google.generativeai を初回のAPI呼び出し時に読み込む（インポートに約1秒かかるため）"""
+    import google.generativeai as genai
+
+    return genai
+
+
+def configure_api_key(api_key: str) -> None:
+    """APIキーを設定（同じキーなら再設定しない）"""
+    global _configured_api_key
+    with _configure_lock:
+        if api_key != _configured_api_key:
+            _load_genai().configure(api_key=api_key)
+            _configured_api_key = api_key
+
+
+@lru_cache(maxsize=32)
+def _build_generative_model(model_name: str, config_name: str):
+    return _load_genai().GenerativeModel(
+        model_name, generation_config=GENERATION_CONFIGS[config_name]
+    )
+
+
+def get_generative_model(model_name: str, api_key: str, config_name: str = "single"):
+    """モデルクライアントを返す（クライアントはモデルと設定ごとに使い回す）
+
+    APIキーは genai.configure によるプロセス全体の設定で、クライアントには
+    保持されない。呼び出しのたびに api_key を設定し直すが、異なるキーの呼び出しが
+    同時に走ると、どちらも最後に設定したキーで送信される（1プロセス1キーが前提）。
+    config_name は GENERATION_CONFIGS のキー（"single" / "batch" /
+    "scores" / "batch_scores"）。
+    """
+    configure_api_key(api_key)
+    return _build_generative_model(model_name, config_name)
+
+
+class AnalysisTimeoutError(TimeoutError):
+    """分析全体の期限切れ（stage は期限が尽きた処理段階）"""
+
+    def __init__(self, stage: str, budget: float):
+        self.stage = stage
+        self.budget = budget
+        super().__init__(f"analysis deadline ({budget:g}s) exceeded during {stage}")
+
+
+@dataclass
+class AnalysisDeadline:
+    """分析全体の期限（ends_at はイベントループの時刻、budget は全体の秒数）"""
 
-    final_error_msg = (
-        f"All models failed. Last error: {str(last_error)}\n{traceback.format_exc()}"
+    ends_at: float
+    budget: float
+
+
+def _remaining(deadline) -> float:
+    """期限（イベントループの時刻）までの残り秒数（期限なしは None）"""
+    if deadline is None:
+        return None
+    return deadline.ends_at - asyncio.get_running_loop().time()
+
+
+async def _within_deadline(awaitable, deadline, stage: str):
+    """awaitable を期限まで待ち、間に合わなければ AnalysisTimeoutError を送出"""
+    remaining = _remaining(deadline)
+    if remaining is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(0.0, remaining))
+    except asyncio.TimeoutError:
+        # 中の処理が送出した TimeoutError は期限切れと区別してそのまま送出する
+        if _remaining(deadline) > 0:
+            raise
+        raise AnalysisTimeoutError(stage, deadline.budget)
+
+
+def _make_deadline(timeout: float = None) -> AnalysisDeadline:
+    """分析全体の期限を作る
+
+    timeout の既定は ANALYSIS_TIMEOUT で、0 なら期限なし（None）。
+    """
+    budget = ANALYSIS_TIMEOUT if timeout is None else timeout
+    if budget <= 0:
+        return None
+    return AnalysisDeadline(asyncio.get_running_loop().time() + budget, budget)
+
+
+async def _acquire_attempt(limiter, on_queue_wait: Callable, metrics, deadline) -> float:
+    """1回分のクォータを確保し、その呼び出しに使える秒数（上限なしは None）を返す
+
+    呼び出しは ATTEMPT_TIMEOUT 秒と分析全体の残り時間の短い方で打ち切る。
+    1日の上限到達や待ち時間の上限超過はレート制限の QuotaExceededError を優先し、
+    上限内の待ち時間だけで期限を過ぎるなら、クォータを消費せずに
+    AnalysisTimeoutError を送出する。待ち時間に上限のないレート制限（一括処理）
+    では順番待ちを期限に数えず、待った分だけ期限を延ばす。
+    """
+    remaining = _remaining(deadline)
+    queue_unbounded = limiter.max_wait_seconds == float("inf")
+    if remaining is not None:
+        # 先のモデルの呼び出しで期限を使い切った場合は順番待ちより先に判定する
+        if remaining <= 0:
+            raise AnalysisTimeoutError("model_call", deadline.budget)
+        if limiter.check_wait() >= remaining and not queue_unbounded:
+            raise AnalysisTimeoutError("queue_wait", deadline.budget)
+    # フォールバックも含め、1回の呼び出しごとにクォータを1つ消費する
+    with metrics.stage("queue_wait"):
+        if deadline is not None and queue_unbounded:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await limiter.acquire(on_queue_wait)
+            deadline.ends_at += loop.time() - started
+        else:
+            await _within_deadline(
+                limiter.acquire(on_queue_wait), deadline, "queue_wait"
+            )
+
+    timeout = ATTEMPT_TIMEOUT if ATTEMPT_TIMEOUT > 0 else None
+    remaining = _remaining(deadline)
+    if remaining is not None:
+        if remaining <= 0:
+            raise AnalysisTimeoutError("model_call", deadline.budget)
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+
+async def _generate_content(model, contents: list, timeout: float):
+    """ブロッキングなSDK呼び出しをスレッドで実行し、timeout 秒で打ち切る"""
+    # SDKにも同じ期限を渡し、応答のない接続をスレッドに残さない
+    request_options = {"timeout": timeout} if timeout is not None else None
+    return await asyncio.wait_for(
+        asyncio.to_thread(
+            model.generate_content, contents, request_options=request_options
+        ),
+        timeout,
+    )
+
+
+def _attempt_timeout_error(model_name: str, timeout: float, deadline) -> TimeoutError:
+    """打ち切った呼び出しの例外を返す（分析全体の期限が尽きていれば送出する）"""
+    remaining = _remaining(deadline)
+    if remaining is not None and remaining <= 0:
+        raise AnalysisTimeoutError("model_call", deadline.budget)
+    return TimeoutError(f"{model_name} did not respond within {timeout:g}s")
+
+
+def _lookup_cached_analysis(
+    image, models_to_try: list, use_cache: bool, tier: str = TIER_FULL
+) -> tuple:
+    """キャッシュを引き、(キャッシュ, 画像ハッシュ, 結果またはNone) を返す
+
+    ディスクキャッシュになければ、結果の履歴（result_store）を探す。
+    詳細な分析はスコアも含むので、スコアのみの分析の代わりにも使う。
+    """
+    versions = [PROMPT_VERSIONS[TIER_FULL]]
+    if tier == TIER_SCORES:
+        versions.append(PROMPT_VERSIONS[TIER_SCORES])
+    cache = get_analysis_cache() if use_cache else None
+    if cache is None:
+        return None, None, None
+    try:
+        image_hash = image_fingerprint(image)
+        cached = cache.get_first(
+            [
+                make_cache_key(image_hash, version, model_name)
+                for version in versions
+                for model_name in models_to_try
+            ]
+        )
+        if cached is not None:
+            logging.info(f"Cache hit: {image_hash[:12]}")
+            return cache, image_hash, cached
+    except Exception as e:
+        logging.warning(f"Cache lookup failed: {str(e)}")
+        return cache, None, None
+
+    stored = None
+    try:
+        for version in versions:
+            stored = get_result_store().get_analysis(
+                image_hash, version, models_to_try
+            )
+            if stored is not None:
+                break
+    except Exception as e:
+        logging.warning(f"Result store lookup failed: {str(e)}")
+    if stored is not None:
+        logging.info(f"Result store hit: {image_hash[:12]}")
+    return cache, image_hash, stored
+
+
+def _store_cached_analysis(
+    cache, image_hash, model_name: str, result: dict, tier: str = TIER_FULL
+) -> None:
+    """成功した分析結果をキャッシュと結果の履歴に保存"""
+    if cache is None or image_hash is None:
+        return
+    version = PROMPT_VERSIONS[tier]
+    try:
+        cache.set(make_cache_key(image_hash, version, model_name), result)
+    except Exception as e:
+        logging.warning(f"Cache store failed: {str(e)}")
+    try:
+        get_result_store().add_analysis(image_hash, version, model_name, result)
+    except Exception as e:
+        logging.warning(f"Result store write failed: {str(e)}")
+
+
+async def _prepare_image_part(image, preprocess: bool):
+    """送信サイズを抑えるため、全モデル共通で一度だけ前処理する"""
+    if preprocess:
+        prepared = await asyncio.to_thread(preprocess_image, image)
+        return prepared.as_part()
+    if isinstance(image, (bytes, bytearray)):
+        return Image.open(io.BytesIO(image))
+    return image
+
+
+def _coerce_score(value):
+    """スコアを0〜100の整数に丸める（"85点" のような文字列も受け付ける。読めなければ None）"""
+    if isinstance(value, str):
+        match = re.search(r"-?\d+(?:\.\d+)?", value)
+        value = float(match.group()) if match else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if value != value:  # NaN
+        return None
+    return int(round(min(100, max(0, value))))
+
+
+def normalize_analysis(result: dict, tier: str = TIER_FULL) -> dict:
+    """必須項目を確認し、スコアの検証・補正と、項目の型をそろえる
+
+    途中で切れた応答を既定値で埋めて成功扱いにしないよう、必須項目が欠けているか
+    スコアを数値として読めない場合は AnalysisParseError を送出する。
+    """
+    missing = [field for field in TIER_REQUIRED_FIELDS[tier] if field not in result]
+    if missing:
+        raise AnalysisParseError(f"response is missing fields: {', '.join(missing)}")
+    for field in ANALYSIS_SCORE_FIELDS:
+        score = _coerce_score(result[field])
+        if score is None:
+            raise AnalysisParseError(f"invalid {field}: {result[field]!r}")
+        result[field] = score
+    strengths = result.get("strengths", [])
+    if isinstance(strengths, str):
+        strengths = [strengths]
+    elif not isinstance(strengths, list):
+        strengths = []
+    result["strengths"] = [str(item) for item in strengths]
+    for field in ANALYSIS_TEXT_FIELDS:
+        if field in result and not isinstance(result[field], str):
+            result[field] = str(result[field])
+    if tier == TIER_SCORES:
+        result["analysis_tier"] = TIER_SCORES
+    return result
+
+
+def _parse_analysis_text(response_text: str, tier: str = TIER_FULL) -> dict:
+    """応答テキストから分析結果を取り出し、スコアを検証する"""
+    return normalize_analysis(parse_json_object(response_text), tier)
+
+
+def _record_model_failure(router, model_name: str, error: Exception) -> str:
+    """モデルの失敗を記録してログに残し、エラー分類を返す"""
+    kind = router.record_failure(model_name, error)
+    logging.warning(
+        f"Model {model_name} failed ({kind}): {type(error).__name__}: {str(error)}"
     )
-    logging.error(final_error_msg)
+    logging.debug(traceback.format_exc())
+    return kind
+
 
+def _failed_analysis_result(last_error: Exception) -> dict:
+    """全モデルが失敗したときの劣化結果"""
+    logging.error(f"All models failed. Last error: {str(last_error)}")
     return {
-        "face_shape": "分析失敗",
+        "face_shape": FAILED_FACE_SHAPE,
         "face_shape_meaning": "モデルエラー",
         "eyes_analysis": f"エラー: {str(last_error)}",
         "nose_analysis": "分析できませんでした",
@@ -218,6 +1154,854 @@ async def analyze_face_fengshui(
     }
 
 
+def _record_model_call(metrics, model_name: str, outcome: str, latency: float) -> None:
+    """1回のモデル呼び出しの結果とレイテンシを記録"""
+    metrics.inc(MODEL_CALLS_TOTAL, model=model_name, outcome=outcome)
+    metrics.observe(MODEL_LATENCY_SECONDS, latency, model=model_name)
+
+
+def _record_analysis(metrics, result: str, attempts: int) -> None:
+    """1件の分析の結果と、試したモデル数（フォールバックの深さ）を記録"""
+    metrics.inc(ANALYSES_TOTAL, result=result)
+    if attempts:
+        metrics.observe(FALLBACK_DEPTH, attempts, buckets=FALLBACK_DEPTH_BUCKETS)
+
+
+def _timed_out_result(metrics, error: AnalysisTimeoutError) -> dict:
+    """期限が尽きた段階を記録し、劣化結果を返す"""
+    logging.warning(f"Analysis timed out: {str(error)}")
+    metrics.inc(DEADLINE_EXCEEDED_TOTAL, stage=error.stage)
+    _record_analysis(metrics, "timeout", 0)
+    return _failed_analysis_result(error)
+
+
+async def analyze_face_fengshui(
+    image,
+    api_key: str,
+    person_name: str = "女性",
+    use_cache: bool = True,
+    preprocess: bool = True,
+    on_queue_wait: Callable = None,
+    coalesce: bool = True,
+    hedge: bool = None,
+    timeout: float = None,
+    tier: str = TIER_FULL,
+) -> dict:
+    """Gemini APIを使用して顔相を分析（image は PIL画像またはアップロードされたバイト列）
+
+    API呼び出しはプロセス共通のレート制限を通る。順番待ちになる場合は
+    on_queue_wait(reservation) で待ち順と推定待ち時間を通知する。1日の上限に
+    達している場合や待ち時間が上限を超える場合は、期限より先に判定して
+    rate_limiter.QuotaExceededError を送出する。
+    同じ画像の分析が他のセッションなどで実行中なら、新たに呼び出さずに
+    その結果（または例外）を待つ（coalesce=False で無効）。
+    hedge=True（既定は FENGSHUI_HEDGE）なら、先頭のモデルの応答が遅いときに
+    次のモデルにも同時に問い合わせ、先に届いた有効な結果を使う。
+    timeout（既定は FENGSHUI_ANALYSIS_TIMEOUT 秒、0で無制限）はフォールバックを
+    含めた分析全体の期限で、後のモデルは残りの時間だけを使う。期限を過ぎた場合
+    （上限内の順番待ちが残り時間より長い場合を含む）は劣化結果を返す。
+    tier=TIER_SCORES なら顔の形とスコアだけを求める（候補者の選考用。結果は
+    詳細な分析と同じく generate_compatibility_report・rank_candidates に渡せる）。
+    """
+    _check_tier(tier)
+    models_to_try = MODELS_TO_TRY
+    metrics = get_metrics()
+    deadline = _make_deadline(timeout)
+
+    # 同じ画像・プロンプト・モデルの結果があればAPIを呼ばずに返す
+    # （ディスクとSQLiteの読み込みでイベントループを止めないよう別スレッドで引く）
+    with metrics.stage("cache_lookup"):
+        cache, image_hash, cached = await asyncio.to_thread(
+            _lookup_cached_analysis, image, models_to_try, use_cache, tier
+        )
+    if cached is not None:
+        _record_analysis(metrics, "cached", 0)
+        return cached
+
+    def run() -> Awaitable:
+        return _analyze_face_uncached(
+            image,
+            api_key,
+            person_name,
+            cache,
+            image_hash,
+            preprocess,
+            on_queue_wait,
+            HEDGE_ENABLED if hedge is None else hedge,
+            deadline,
+            tier,
+        )
+
+    if not coalesce:
+        return await run()
+    if image_hash is None:
+        try:
+            image_hash = image_fingerprint(image)
+        except Exception as e:
+            logging.warning(f"Image fingerprint failed: {str(e)}")
+            return await run()
+    # キャッシュと同じく、名前はキーに含めない（名前は分析内容に影響しない）
+    key = (image_hash, PROMPT_VERSIONS[tier], tuple(models_to_try), api_key)
+    try:
+        # 他の呼び出しの結果を待つ場合も、自分の期限までしか待たない
+        return await _within_deadline(
+            get_single_flight().do(key, run), deadline, "coalesce"
+        )
+    except AnalysisTimeoutError as e:
+        return _timed_out_result(metrics, e)
+
+
+async def _analyze_face_uncached(
+    image,
+    api_key: str,
+    person_name: str,
+    cache,
+    image_hash,
+    preprocess: bool,
+    on_queue_wait: Callable,
+    hedge: bool = False,
+    deadline: AnalysisDeadline = None,
+    tier: str = TIER_FULL,
+) -> dict:
+    """キャッシュになかった1枚をモデルを切り替えながら分析する"""
+    models_to_try = MODELS_TO_TRY
+    metrics = get_metrics()
+    prompt = TIER_PROMPT_BUILDERS[tier][0](person_name)
+
+    # 直近で成功したモデルから試し、停止中（サーキットが開いた）モデルは飛ばす
+    router = get_model_router(models_to_try)
+    limiter = get_rate_limiter()
+
+    def attempt(model_name: str) -> Awaitable:
+        return _attempt_model(
+            model_name,
+            api_key,
+            [prompt, image_part],
+            router,
+            limiter,
+            metrics,
+            on_queue_wait,
+            deadline,
+            tier,
+        )
+
+    try:
+        with metrics.stage("preprocess"):
+            image_part = await _within_deadline(
+                _prepare_image_part(image, preprocess), deadline, "preprocess"
+            )
+
+        candidates = router.candidates()
+        if hedge and len(candidates) >= 2:
+            model_name, analysis_result, attempts, last_error = await _run_hedged(
+                candidates, attempt, router, limiter, metrics
+            )
+        else:
+            model_name = analysis_result = last_error = None
+            attempts = 0
+            for candidate in candidates:
+                attempts += 1
+                analysis_result, last_error, kind = await attempt(candidate)
+                if analysis_result is not None:
+                    model_name = candidate
+                    break
+                if kind == ERROR_FATAL:
+                    # APIキー不正などは他のモデルでも失敗するため打ち切る
+                    break
+
+    except AnalysisTimeoutError as e:
+        # 残りのフォールバックは試さずに劣化結果を返す
+        return _timed_out_result(metrics, e)
+
+    if analysis_result is not None:
+        _record_analysis(metrics, "success", attempts)
+        await asyncio.to_thread(
+            _store_cached_analysis, cache, image_hash, model_name, analysis_result, tier
+        )
+        return analysis_result
+    _record_analysis(metrics, "degraded", attempts)
+    return _failed_analysis_result(last_error)
+
+
+async def _attempt_model(
+    model_name: str,
+    api_key: str,
+    parts: list,
+    router,
+    limiter,
+    metrics,
+    on_queue_wait: Callable,
+    deadline: AnalysisDeadline = None,
+    tier: str = TIER_FULL,
+) -> tuple:
+    """1つのモデルに1回問い合わせ、(結果, 例外, エラー分類) を返す
+
+    失敗はルーターとメトリクスに記録してから返す。取り消された呼び出しは
+    モデルの健全性にもレイテンシにも数えず、outcome="cancelled" として数える。
+    呼び出しは ATTEMPT_TIMEOUT 秒と分析全体の残り時間の短い方で打ち切り、
+    全体の期限が尽きた場合は AnalysisTimeoutError を送出する。
+    """
+    timeout = await _acquire_attempt(limiter, on_queue_wait, metrics, deadline)
+
+    started = time.perf_counter()
+    try:
+        model = get_generative_model(
+            model_name, api_key, TIER_CONFIG_NAMES[tier][0]
+        )
+        # ブロッキングなSDK呼び出しはスレッドで実行し、イベントループを止めない
+        # （画像の送信と推論はSDK内の1回の呼び出しなので分けて計測できない）
+        with metrics.stage("model_call"):
+            response = await _generate_content(model, parts, timeout)
+        latency = time.perf_counter() - started
+        with metrics.stage("parse"):
+            analysis_result = _parse_analysis_text(response.text, tier)
+
+    except asyncio.CancelledError:
+        # 途中で打ち切った時間はレイテンシの分布に入れない
+        metrics.inc(MODEL_CALLS_TOTAL, model=model_name, outcome="cancelled")
+        raise
+
+    except AnalysisParseError as e:
+        # モデルは応答しているので健全性には数えず、解析失敗として別に集計する
+        router.record_parse_failure(model_name, e)
+        _record_model_call(
+            metrics, model_name, "parse_error", time.perf_counter() - started
+        )
+        logging.warning(f"Model {model_name} returned unparseable JSON: {str(e)}")
+        return None, e, None
+
+    except asyncio.TimeoutError:
+        _record_model_call(
+            metrics, model_name, "timeout", time.perf_counter() - started
+        )
+        # 1回分の上限で打ち切った場合は、遅いモデルとして記録して次のモデルへ進む
+        error = _attempt_timeout_error(model_name, timeout, deadline)
+        return None, error, _record_model_failure(router, model_name, error)
+
+    except Exception as e:
+        _record_model_call(
+            metrics, model_name, "failure", time.perf_counter() - started
+        )
+        return None, e, _record_model_failure(router, model_name, e)
+
+    router.record_success(model_name, latency)
+    _record_model_call(metrics, model_name, "success", latency)
+    return analysis_result, None, None
+
+
+async def _run_hedged(
+    candidates: list, attempt: Callable, router, limiter, metrics
+) -> tuple:
+    """ヘッジ付きでモデルを試し、(モデル名, 結果, 試行数, 最後の例外) を返す
+
+    先頭のモデルがレイテンシの HEDGE_PERCENTILE パーセンタイルを過ぎても
+    応答しなければ、次のモデルにも同じリクエストを送る（1回の分析につき1回まで）。
+    先に解析できた結果を採用し、残りの呼び出しは取り消す。失敗した場合は
+    ヘッジなしと同じく次のモデルへ進む。SDKの呼び出しはスレッドで動くため、
+    取り消しても送信済みのリクエストは止まらない（結果を待たずに捨てる）。
+    """
+    loop = asyncio.get_running_loop()
+    remaining = list(candidates)
+    running = {}  # タスク -> (モデル名, 開始時刻)
+    attempts = 0
+    primary = backup = None
+    outcome = HEDGE_NONE
+    last_error = None
+
+    def launch() -> str:
+        nonlocal attempts
+        model_name = remaining.pop(0)
+        attempts += 1
+        running[asyncio.ensure_future(attempt(model_name))] = (model_name, loop.time())
+        return model_name
+
+    launch()
+    try:
+        while running:
+            timeout = None
+            if outcome == HEDGE_NONE and remaining and len(running) == 1:
+                primary, started = next(iter(running.values()))
+                delay = router.hedge_delay(primary, HEDGE_PERCENTILE, HEDGE_DELAY)
+                timeout = max(0.0, started + delay - loop.time())
+            done, _ = await asyncio.wait(
+                running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not done:
+                # 予備のリクエストがレート制限で待たされるなら、混雑を悪化させない
+                if limiter.estimate_wait() > 0:
+                    outcome = HEDGE_SKIPPED
+                else:
+                    backup = launch()
+                    outcome = HEDGE_FAILED
+                    logging.info(f"Hedging {primary} with {backup}")
+                continue
+
+            for task in done:
+                model_name, _ = running.pop(task)
+                analysis_result, error, kind = task.result()
+                if analysis_result is not None:
+                    # ヘッジした2つ以外のモデルで成功した場合は failed のまま
+                    if model_name == backup:
+                        outcome = HEDGE_BACKUP_WON
+                    elif model_name == primary and backup is not None:
+                        outcome = HEDGE_PRIMARY_WON
+                    return model_name, analysis_result, attempts, None
+                last_error = error
+                if kind == ERROR_FATAL:
+                    # APIキー不正などは他のモデルでも失敗するため打ち切る
+                    return None, None, attempts, last_error
+            if not running and remaining:
+                launch()
+        return None, None, attempts, last_error
+    except asyncio.CancelledError:
+        # 分析自体が取り消された場合はヘッジの統計に数えない
+        outcome = None
+        raise
+    finally:
+        # 負けた呼び出しを取り消す（ここで取り消した数がヘッジの余分なコスト）
+        extra_calls = len(running)
+        for task, (model_name, started) in running.items():
+            task.cancel()
+            if outcome == HEDGE_BACKUP_WON:
+                router.record_slow_call(model_name, loop.time() - started)
+        if running:
+            await asyncio.wait(running)
+        if outcome is not None:
+            router.record_hedge(outcome, extra_calls)
+            metrics.inc(HEDGES_TOTAL, outcome=outcome)
+
+
+async def _stream_response_text(model, parts: list, timeout: float = None):
+    """generate_content(stream=True) をスレッドで回し、届いたテキストを順に返す
+
+    途中で取り消されたり閉じられたりした場合は、スレッドの終了を待たずに戻る。
+    スレッドは次のチャンクが届いた時点で読み込みをやめる。
+    timeout 秒以内に最後まで届かなければ asyncio.TimeoutError を送出する。
+    """
+    loop = asyncio.get_running_loop()
+    ends_at = loop.time() + timeout if timeout is not None else None
+    request_options = {"timeout": timeout} if timeout is not None else None
+    queue: asyncio.Queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    def put(item: tuple) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # 呼び出し側のイベントループはすでに閉じている
+            stopped.set()
+
+    def produce() -> None:
+        try:
+            for chunk in model.generate_content(
+                parts, stream=True, request_options=request_options
+            ):
+                if stopped.is_set():
+                    return
+                put(("text", chunk.text))
+            put(("done", None))
+        except Exception as e:
+            put(("error", e))
+
+    # 既定のスレッドプールで回すと asyncio.run の終了時に読み終わるまで待たされるため、
+    # 終了を待たないデーモンスレッドで読む
+    threading.Thread(target=produce, name="gemini-stream", daemon=True).start()
+    try:
+        while True:
+            if ends_at is None:
+                kind, payload = await queue.get()
+            else:
+                kind, payload = await asyncio.wait_for(
+                    queue.get(), max(0.0, ends_at - loop.time())
+                )
+            if kind == "text":
+                yield payload
+            elif kind == "error":
+                raise payload
+            else:
+                break
+    finally:
+        stopped.set()
+
+
+async def analyze_face_fengshui_stream(
+    image,
+    api_key: str,
+    person_name: str = "女性",
+    use_cache: bool = True,
+    preprocess: bool = True,
+    on_queue_wait: Callable = None,
+    timeout: float = None,
+):
+    """顔相分析をストリーミングで行い、完成した項目から (キー, 値) を順に返す
+
+    途中でモデルが失敗した場合は次のモデルで最初からやり直すため、
+    同じキーが再度返ることがある（後に返った値が正しい）。
+    期限は analyze_face_fengshui と同じく、1回の呼び出しを ATTEMPT_TIMEOUT 秒で、
+    分析全体を timeout 秒（既定は FENGSHUI_ANALYSIS_TIMEOUT）で打ち切る。
+    """
+    models_to_try = MODELS_TO_TRY
+    metrics = get_metrics()
+    deadline = _make_deadline(timeout)
+
+    with metrics.stage("cache_lookup"):
+        cache, image_hash, cached = await asyncio.to_thread(
+            _lookup_cached_analysis, image, models_to_try, use_cache
+        )
+    if cached is not None:
+        _record_analysis(metrics, "cached", 0)
+        for key, value in cached.items():
+            yield key, value
+        return
+
+    prompt = build_analysis_prompt(person_name)
+    last_error = None
+    attempts = 0
+    router = get_model_router(models_to_try)
+    limiter = get_rate_limiter()
+
+    try:
+        with metrics.stage("preprocess"):
+            image_part = await _within_deadline(
+                _prepare_image_part(image, preprocess), deadline, "preprocess"
+            )
+
+        for model_name in router.candidates():
+            timeout = await _acquire_attempt(limiter, on_queue_wait, metrics, deadline)
+            attempts += 1
+            started = time.perf_counter()
+            try:
+                model = get_generative_model(model_name, api_key)
+                parser = IncrementalObjectParser()
+                chunks = []
+                async for text in _stream_response_text(
+                    model, [prompt, image_part], timeout
+                ):
+                    chunks.append(text)
+                    for key, value in parser.feed(text):
+                        yield key, value
+                # 呼び出し側が項目を処理する時間も含む
+                latency = time.perf_counter() - started
+                metrics.observe(STAGE_SECONDS, latency, stage="model_call")
+
+                # 全文を改めて解析し、逐次解析で取りこぼした項目があれば返す
+                with metrics.stage("parse"):
+                    analysis_result = _parse_analysis_text("".join(chunks))
+                router.record_success(model_name, latency)
+                _record_model_call(metrics, model_name, "success", latency)
+                _record_analysis(metrics, "success", attempts)
+                for key, value in analysis_result.items():
+                    if parser.fields.get(key, parser) != value:
+                        yield key, value
+                await asyncio.to_thread(
+                    _store_cached_analysis,
+                    cache,
+                    image_hash,
+                    model_name,
+                    analysis_result,
+                )
+                return
+
+            except AnalysisParseError as e:
+                last_error = e
+                router.record_parse_failure(model_name, e)
+                _record_model_call(
+                    metrics, model_name, "parse_error", time.perf_counter() - started
+                )
+                logging.warning(
+                    f"Model {model_name} returned unparseable JSON: {str(e)}"
+                )
+
+            except asyncio.TimeoutError:
+                _record_model_call(
+                    metrics, model_name, "timeout", time.perf_counter() - started
+                )
+                last_error = _attempt_timeout_error(model_name, timeout, deadline)
+                if _record_model_failure(router, model_name, last_error) == ERROR_FATAL:
+                    break
+
+            except Exception as e:
+                last_error = e
+                _record_model_call(
+                    metrics, model_name, "failure", time.perf_counter() - started
+                )
+                if _record_model_failure(router, model_name, e) == ERROR_FATAL:
+                    break
+
+    except AnalysisTimeoutError as e:
+        for key, value in _timed_out_result(metrics, e).items():
+            yield key, value
+        return
+
+    _record_analysis(metrics, "degraded", attempts)
+    for key, value in _failed_analysis_result(last_error).items():
+        yield key, value
+
+
+def is_failed_analysis(analysis: dict) -> bool:
+    """analyze_face_fengshui の結果が全モデル失敗時の劣化結果かを判定"""
+    return analysis.get("face_shape") == FAILED_FACE_SHAPE
+
+
+async def analyze_faces_concurrently(
+    images: list,
+    api_key: str,
+    person_names: list = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    on_queue_wait: Callable = None,
+    tier: str = TIER_FULL,
+) -> list:
+    """複数の顔画像を並列数を制限しつつ同時に分析（結果は入力順）"""
+    if person_names is None:
+        person_names = ["女性"] * len(images)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def analyze_one(image, person_name: str) -> dict:
+        async with semaphore:
+            return await analyze_face_fengshui(
+                image, api_key, person_name, on_queue_wait=on_queue_wait, tier=tier
+            )
+
+    return await asyncio.gather(
+        *(analyze_one(image, name) for image, name in zip(images, person_names))
+    )
+
+
+async def stream_faces_concurrently(
+    images: list,
+    api_key: str,
+    person_names: list = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    on_queue_wait: Callable = None,
+):
+    """複数の顔画像をストリーミングで同時に分析し、(番号, キー, 値) を届いた順に返す"""
+    if person_names is None:
+        person_names = ["女性"] * len(images)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def stream_one(index: int, image, person_name: str) -> None:
+        try:
+            async with semaphore:
+                async for key, value in analyze_face_fengshui_stream(
+                    image, api_key, person_name, on_queue_wait=on_queue_wait
+                ):
+                    await queue.put((index, key, value))
+        finally:
+            await queue.put((index, None, None))
+
+    tasks = [
+        asyncio.create_task(stream_one(index, image, name))
+        for index, (image, name) in enumerate(zip(images, person_names))
+    ]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            index, key, value = await queue.get()
+            if key is None:
+                remaining -= 1
+                continue
+            yield index, key, value
+        # 例外（QuotaExceededError など）があれば呼び出し側へ伝える
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _complete_batch_items(items: list, count: int, tier: str = TIER_FULL) -> dict:
+    """バッチ応答から、番号が正しく必須項目が揃った分析を番号ごとに取り出す"""
+    analyses = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item = dict(item)
+        index = item.pop("index", None)
+        if isinstance(index, str) and index.strip().isdigit():
+            index = int(index)
+        if (
+            not isinstance(index, int)
+            or isinstance(index, bool)
+            or not 0 <= index < count
+            or index in analyses
+        ):
+            continue
+        # 途中で切れた要素は使わず、1人ずつの分析でやり直す
+        try:
+            analyses[index] = normalize_analysis(item, tier)
+        except AnalysisParseError:
+            continue
+    return analyses
+
+
+async def _analyze_batch(
+    images: list,
+    api_key: str,
+    person_names: list,
+    preprocess: bool,
+    on_queue_wait: Callable,
+    tier: str = TIER_FULL,
+    deadline: AnalysisDeadline = None,
+) -> tuple:
+    """複数人を1回のリクエストで分析し、(番号 -> 結果, モデル名, 最後のエラー, 試行数) を返す
+
+    1人ずつの分析と同じく、呼び出しは ATTEMPT_TIMEOUT 秒と期限の残り時間の
+    短い方で打ち切り、期限が尽きた場合は AnalysisTimeoutError を送出する。
+    """
+    metrics = get_metrics()
+    with metrics.stage("preprocess"):
+        image_parts = await _within_deadline(
+            asyncio.gather(
+                *(_prepare_image_part(image, preprocess) for image in images)
+            ),
+            deadline,
+            "preprocess",
+        )
+    contents = [TIER_PROMPT_BUILDERS[tier][1](person_names)]
+    for index, (name, part) in enumerate(zip(person_names, image_parts)):
+        contents += [f"画像{index}: {name}", part]
+
+    last_error = None
+    attempts = 0
+    router = get_model_router(MODELS_TO_TRY)
+    limiter = get_rate_limiter()
+
+    for model_name in router.candidates():
+        # 人数にかかわらず1回のリクエストなのでクォータは1つだけ消費する
+        timeout = await _acquire_attempt(limiter, on_queue_wait, metrics, deadline)
+        attempts += 1
+        started = time.perf_counter()
+        try:
+            model = get_generative_model(
+                model_name, api_key, TIER_CONFIG_NAMES[tier][1]
+            )
+            with metrics.stage("model_call"):
+                response = await _generate_content(model, contents, timeout)
+            latency = time.perf_counter() - started
+            with metrics.stage("parse"):
+                analyses = _complete_batch_items(
+                    parse_json_array(response.text), len(images), tier
+                )
+            if not analyses:
+                raise AnalysisParseError("batch response has no complete analysis")
+            router.record_success(model_name, latency)
+            _record_model_call(metrics, model_name, "success", latency)
+            return analyses, model_name, None, attempts
+
+        except AnalysisParseError as e:
+            last_error = e
+            router.record_parse_failure(model_name, e)
+            _record_model_call(
+                metrics, model_name, "parse_error", time.perf_counter() - started
+            )
+            logging.warning(f"Model {model_name} returned unparseable JSON: {str(e)}")
+
+        except asyncio.TimeoutError:
+            _record_model_call(
+                metrics, model_name, "timeout", time.perf_counter() - started
+            )
+            last_error = _attempt_timeout_error(model_name, timeout, deadline)
+            if _record_model_failure(router, model_name, last_error) == ERROR_FATAL:
+                break
+
+        except Exception as e:
+            last_error = e
+            _record_model_call(
+                metrics, model_name, "failure", time.perf_counter() - started
+            )
+            if _record_model_failure(router, model_name, e) == ERROR_FATAL:
+                break
+
+    return {}, None, last_error, attempts
+
+
+async def analyze_faces_batched(
+    images: list,
+    api_key: str,
+    person_names: list = None,
+    use_cache: bool = True,
+    preprocess: bool = True,
+    on_queue_wait: Callable = None,
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    tier: str = TIER_FULL,
+    timeout: float = None,
+) -> list:
+    """複数人の顔写真を1回のリクエストでまとめて分析（結果は入力順）
+
+    各結果は analyze_face_fengshui と同じ形式。人数が max_batch_size を超える
+    場合はリクエストを分ける。応答に含まれなかった人だけ1人ずつ分析し直し、
+    全モデルが失敗した場合は劣化結果を返す。timeout は analyze_face_fengshui と
+    同じく分析全体の期限で、1人ずつの分析し直しも残りの時間で行う。
+    """
+    _check_tier(tier)
+    if person_names is None:
+        person_names = ["女性"] * len(images)
+    metrics = get_metrics()
+    deadline = _make_deadline(timeout)
+    results = [None] * len(images)
+    hashes = [None] * len(images)
+
+    async def lookup(image) -> tuple:
+        with metrics.stage("cache_lookup"):
+            return await asyncio.to_thread(
+                _lookup_cached_analysis, image, MODELS_TO_TRY, use_cache, tier
+            )
+
+    cache = None
+    lookups = await asyncio.gather(*(lookup(image) for image in images))
+    for index, (cache, image_hash, cached) in enumerate(lookups):
+        hashes[index] = image_hash
+        if cached is not None:
+            _record_analysis(metrics, "cached", 0)
+            results[index] = cached
+
+    async def analyze_single(index: int) -> None:
+        remaining = _remaining(deadline)
+        if remaining is not None and remaining <= 0:
+            results[index] = _timed_out_result(
+                metrics, AnalysisTimeoutError("model_call", deadline.budget)
+            )
+            return
+        results[index] = await analyze_face_fengshui(
+            images[index],
+            api_key,
+            person_names[index],
+            use_cache=use_cache,
+            preprocess=preprocess,
+            on_queue_wait=on_queue_wait,
+            # 期限なし（deadline が None）は timeout=0
+            timeout=remaining or 0,
+            tier=tier,
+        )
+
+    async def analyze_chunk(chunk: list) -> None:
+        if len(chunk) == 1:
+            await analyze_single(chunk[0])
+            return
+        try:
+            analyses, model_name, last_error, attempts = await _analyze_batch(
+                [images[index] for index in chunk],
+                api_key,
+                [person_names[index] for index in chunk],
+                preprocess,
+                on_queue_wait,
+                tier,
+                deadline,
+            )
+        except AnalysisTimeoutError as e:
+            # 期限が尽きたので1人ずつのやり直しはせず、全員を劣化結果にする
+            for index in chunk:
+                results[index] = _timed_out_result(metrics, e)
+            return
+        missing = []
+        for position, index in enumerate(chunk):
+            analysis = analyses.get(position)
+            if analysis is None:
+                missing.append(index)
+                continue
+            results[index] = analysis
+            _record_analysis(metrics, "success", attempts)
+            await asyncio.to_thread(
+                _store_cached_analysis,
+                cache,
+                hashes[index],
+                model_name,
+                analysis,
+                tier,
+            )
+
+        if model_name is None:
+            # 全モデルが失敗した場合は1人ずつ試しても同じなので劣化結果を返す
+            for index in missing:
+                _record_analysis(metrics, "degraded", attempts)
+                results[index] = _failed_analysis_result(last_error)
+            return
+        await asyncio.gather(*(analyze_single(index) for index in missing))
+
+    pending = [index for index, result in enumerate(results) if result is None]
+    size = max(1, max_batch_size)
+    await asyncio.gather(
+        *(
+            analyze_chunk(pending[start : start + size])
+            for start in range(0, len(pending), size)
+        )
+    )
+    return results
+
+
+async def analyze_group_photo(
+    image,
+    api_key: str,
+    person_names: list = None,
+    max_faces: int = DEFAULT_MAX_GROUP_FACES,
+    use_cache: bool = True,
+    on_queue_wait: Callable = None,
+    tier: str = TIER_FULL,
+) -> dict:
+    """集合写真に写っている全員を検出・切り出しし、1回のリクエストで分析
+
+    戻り値の faces は左から順の {"name", "box", "image"}（image は顔タイルのJPEG）で、
+    analyses と同じ順に並ぶ。rank_candidates に names・images としてそのまま渡せる。
+    """
+    tiles = await asyncio.to_thread(extract_face_tiles, image, max_faces)
+    # 名前が顔の数より少なければ、残りは既定の名前で補う
+    person_names = list(person_names or [])[: len(tiles)]
+    person_names += [
+        default_candidate_name(i) for i in range(len(person_names), len(tiles))
+    ]
+    analyses = await analyze_faces_batched(
+        [tile.data for tile in tiles],
+        api_key,
+        person_names,
+        use_cache=use_cache,
+        on_queue_wait=on_queue_wait,
+        max_batch_size=max(1, len(tiles)),
+        tier=tier,
+    )
+    return {
+        "faces": [
+            {"name": name, "box": tile.box, "image": tile.data}
+            for name, tile in zip(person_names, tiles)
+        ],
+        "analyses": analyses,
+    }
+
+
+def calculate_total_score(analysis: dict, compatibility_score: float) -> float:
+    """顔相スコア・金運スコア・五行相性から総合スコアを計算（丸め前）"""
+    return (
+        analysis.get("fortune_score", 50) * FORTUNE_WEIGHT
+        + analysis.get("wealth_fortune_score", 50) * WEALTH_WEIGHT
+        + compatibility_score * COMPATIBILITY_WEIGHT
+    )
+
+
+def score_candidate(
+    man_element: str,
+    analysis: dict,
+    name: str,
+    image=None,
+    default_element: str = "土",
+) -> dict:
+    """1人分の五行・相性・総合スコアを計算"""
+    # 画像の指紋で五行を判定（画像がない場合は既定値）
+    with get_metrics().stage("element"):
+        element = (
+            get_element_from_image(image) if image is not None else default_element
+        )
+    compatibility = calculate_element_compatibility(man_element, element)
+    return {
+        "name": name,
+        "element": element,
+        "face_analysis": analysis,
+        "compatibility": compatibility,
+        "total_score": round(
+            calculate_total_score(analysis, compatibility["score"]), 1
+        ),
+    }
+
+
 def generate_compatibility_report(
     man_age: int,
     man_birthdate: datetime,
@@ -225,61 +2009,194 @@ def generate_compatibility_report(
     woman2_analysis: dict,
     woman1_name: str = "女性A",
     woman2_name: str = "女性B",
-    woman1_image: Image.Image = None,
-    woman2_image: Image.Image = None,
+    woman1_image=None,
+    woman2_image=None,
 ) -> dict:
-    """総合的な相性レポートを生成"""
-    man_zodiac = calculate_zodiac(man_birthdate.year)
-    man_element = get_element_from_zodiac(man_zodiac)
+    """総合的な相性レポートを生成（画像は PIL画像またはアップロードされたバイト列）"""
+    man_eto = lookup_sexagenary(man_birthdate)
+    man_element = man_eto.element
 
-    # 画像ハッシュで五行を判定（確実に異なる値にする）
-    def get_element_from_image(image: Image.Image) -> str:
-        """画像ハッシュから五行を判定"""
-        try:
-            img_bytes = io.BytesIO()
-            image.save(img_bytes, format="PNG")
-            image_hash = int(hashlib.md5(img_bytes.getvalue()).hexdigest()[:8], 16)
-            elements = ["金", "水", "木", "火", "土"]
-            element = elements[image_hash % 5]
-            logging.info(f"Image hash: {image_hash}, Element: {element}")
-            return element
-        except:
-            return "土"
-
-    woman1_element = get_element_from_image(woman1_image) if woman1_image else "土"
-    woman2_element = get_element_from_image(woman2_image) if woman2_image else "金"
-
-    compatibility1 = calculate_element_compatibility(man_element, woman1_element)
-    compatibility2 = calculate_element_compatibility(man_element, woman2_element)
-
-    total_score1 = (
-        woman1_analysis.get("fortune_score", 50) * 0.3
-        + woman1_analysis.get("wealth_fortune_score", 50) * 0.4
-        + compatibility1["score"] * 0.3
-    )
-
-    total_score2 = (
-        woman2_analysis.get("fortune_score", 50) * 0.3
-        + woman2_analysis.get("wealth_fortune_score", 50) * 0.4
-        + compatibility2["score"] * 0.3
-    )
+    with get_metrics().stage("scoring"):
+        woman1 = score_candidate(
+            man_element,
+            woman1_analysis,
+            woman1_name,
+            woman1_image,
+            default_element="土",
+        )
+        woman2 = score_candidate(
+            man_element,
+            woman2_analysis,
+            woman2_name,
+            woman2_image,
+            default_element="金",
+        )
+        total_score1 = calculate_total_score(
+            woman1_analysis, woman1["compatibility"]["score"]
+        )
+        total_score2 = calculate_total_score(
+            woman2_analysis, woman2["compatibility"]["score"]
+        )
 
     return {
-        "man_info": {"age": man_age, "zodiac": man_zodiac, "element": man_element},
-        "woman1": {
-            "name": woman1_name,
-            "element": woman1_element,
-            "face_analysis": woman1_analysis,
-            "compatibility": compatibility1,
-            "total_score": round(total_score1, 1),
-        },
-        "woman2": {
-            "name": woman2_name,
-            "element": woman2_element,
-            "face_analysis": woman2_analysis,
-            "compatibility": compatibility2,
-            "total_score": round(total_score2, 1),
+        "man_info": {
+            "age": man_age,
+            "zodiac": man_eto.zodiac,
+            "eto": man_eto.name,
+            "element": man_element,
         },
+        "woman1": woman1,
+        "woman2": woman2,
         "recommendation": woman1_name if total_score1 > total_score2 else woman2_name,
         "score_difference": abs(round(total_score1 - total_score2, 1)),
     }
+
+
+def save_report_history(
+    report: dict, man_birthdate, images: list = None, source: str = "app"
+):
+    """レポートを結果の履歴に保存し、レポートIDを返す（失敗時はNone）
+
+    report は rank_candidates または generate_compatibility_report の結果。
+    images は rank_candidates に渡した画像（候補者の指紋の記録に使う）。
+    """
+    if "candidates" in report:
+        candidates = report["candidates"]
+        sources = [
+            images[candidate["index"]] if images else None for candidate in candidates
+        ]
+    else:
+        candidates = [report["woman1"], report["woman2"]]
+        sources = list(images) if images else [None, None]
+
+    fingerprints = []
+    for source_image in sources:
+        try:
+            fingerprints.append(
+                image_fingerprint(source_image) if source_image is not None else None
+            )
+        except Exception:
+            fingerprints.append(None)
+
+    try:
+        with get_metrics().stage("history"):
+            return get_result_store().record_report(
+                man_birthdate,
+                report["man_info"]["element"],
+                candidates,
+                fingerprints,
+                source=source,
+                recommendation=report.get("recommendation"),
+            )
+    except Exception as e:
+        logging.warning(f"Result store write failed: {str(e)}")
+        return None
+
+
+def default_candidate_name(index: int) -> str:
+    """候補者の既定の表示名（女性A, 女性B, ...）"""
+    if index < 26:
+        return f"女性{chr(ord('A') + index)}"
+    return f"女性{index + 1}"
+
+
+def rank_candidates(
+    man_age: int,
+    man_birthdate: datetime,
+    analyses: list,
+    names: list = None,
+    images: list = None,
+    top_k: int = None,
+) -> dict:
+    """任意人数の候補者を一度にスコアリングし、総合スコア順のレポートを生成
+
+    top_k を指定すると上位 top_k 人だけを返す（全件ソートせずヒープで選択）。
+    同点の場合は入力順が先の候補者を上位とする。
+    images を渡さない候補者の五行は入力順によらず score_candidate の既定値になる。
+    names・images を渡す場合は analyses と同じ長さでなければ ValueError。
+    """
+    man_eto = lookup_sexagenary(man_birthdate)
+    man_element = man_eto.element
+
+    if names is None:
+        names = [default_candidate_name(i) for i in range(len(analyses))]
+    if images is None:
+        images = [None] * len(analyses)
+    if not len(names) == len(images) == len(analyses):
+        raise ValueError(
+            f"names ({len(names)}) and images ({len(images)}) must match "
+            f"analyses ({len(analyses)})"
+        )
+
+    scored = []
+    with get_metrics().stage("scoring"):
+        for index, (analysis, name, image) in enumerate(zip(analyses, names, images)):
+            candidate = score_candidate(man_element, analysis, name, image)
+            candidate["index"] = index
+            total = calculate_total_score(
+                analysis, candidate["compatibility"]["score"]
+            )
+            scored.append((total, -index, candidate))
+
+        if top_k is not None and top_k < len(scored):
+            ranked = heapq.nlargest(top_k, scored, key=lambda item: item[:2])
+        else:
+            ranked = sorted(scored, key=lambda item: item[:2], reverse=True)
+
+    candidates = []
+    for rank, (_, _, candidate) in enumerate(ranked, start=1):
+        candidate["rank"] = rank
+        candidates.append(candidate)
+
+    score_gap = (
+        abs(round(ranked[0][0] - ranked[1][0], 1)) if len(ranked) >= 2 else None
+    )
+    return {
+        "man_info": {
+            "age": man_age,
+            "zodiac": man_eto.zodiac,
+            "eto": man_eto.name,
+            "element": man_element,
+        },
+        "candidate_count": len(scored),
+        "candidates": candidates,
+        "recommendation": candidates[0]["name"] if candidates else None,
+        "score_difference": score_gap,
+    }
+
+
+def select_detail_candidates(report: dict, top_k: int = DEFAULT_DETAIL_TOP) -> list:
+    """順位付きレポートの上位 top_k 人のうち、スコアのみの分析だった候補者"""
+    return [
+        candidate
+        for candidate in report["candidates"][: max(0, top_k)]
+        if analysis_tier(candidate["face_analysis"]) == TIER_SCORES
+    ]
+
+
+async def analyze_top_candidates(
+    report: dict,
+    images: list,
+    api_key: str,
+    top_k: int = DEFAULT_DETAIL_TOP,
+    on_queue_wait: Callable = None,
+) -> dict:
+    """スコアのみで順位付けしたレポートの上位 top_k 人だけを詳細に分析
+
+    images は rank_candidates に渡した分析と同じ順の画像。戻り値は
+    {候補者の入力順の番号: 詳細な分析} で、分析のリストの該当する要素を置き換えて
+    rank_candidates をやり直せば詳細な分析のスコアで並び直る。
+    詳細な分析に失敗した候補者はスコアのみの分析のまま残すため含めない。
+    """
+    targets = select_detail_candidates(report, top_k)
+    analyses = await analyze_faces_concurrently(
+        [images[candidate["index"]] for candidate in targets],
+        api_key,
+        [candidate["name"] for candidate in targets],
+        on_queue_wait=on_queue_wait,
+    )
+    return {
+        candidate["index"]: analysis
+        for candidate, analysis in zip(targets, analyses)
+        if not is_failed_analysis(analysis)
+    }
@@ -0,0 +1,269 @@
+"""
+処理段階ごとの計測とメトリクス
+Lightweight per-stage timers, counters and histograms with Prometheus/JSON export
+
+既定では無効で、無効時の timer() は共有の何もしないオブジェクトを返すだけなので
+計測箇所のコストはほぼゼロになる。環境変数 FENGSHUI_METRICS=1 か
+get_metrics().enable() で有効にする。
+"""
+
+import os
+import threading
+import time
+from typing import Optional
+
+# 秒単位のレイテンシ用バケット（Prometheus のヒストグラムと同じ累積形式で出力）
+DEFAULT_LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+# フォールバックの深さ（何番目のモデルで終わったか）用
+FALLBACK_DEPTH_BUCKETS = (1, 2, 3, 4, 5)
+
+STAGE_SECONDS = "fengshui_stage_seconds"
+MODEL_LATENCY_SECONDS = "fengshui_model_latency_seconds"
+MODEL_CALLS_TOTAL = "fengshui_model_calls_total"
+FALLBACK_DEPTH = "fengshui_fallback_depth"
+ANALYSES_TOTAL = "fengshui_analyses_total"
+HTTP_REQUESTS_TOTAL = "fengshui_http_requests_total"
+SINGLE_FLIGHT_CALLS_TOTAL = "fengshui_single_flight_calls_total"
+HTTP_REQUEST_SECONDS = "fengshui_http_request_seconds"
+HEDGES_TOTAL = "fengshui_hedges_total"
+DEADLINE_EXCEEDED_TOTAL = "fengshui_deadline_exceeded_total"
+
+METRIC_HELP = {
+    STAGE_SECONDS: "Time spent in each pipeline stage",
+    MODEL_LATENCY_SECONDS: "Latency of Gemini calls per model (upload and inference)",
+    MODEL_CALLS_TOTAL: "Gemini calls per model and outcome",
+    FALLBACK_DEPTH: "Number of models tried per analysis",
+    ANALYSES_TOTAL: "Face analyses by result",
+    HTTP_REQUESTS_TOTAL: "HTTP API requests per endpoint and status",
+    SINGLE_FLIGHT_CALLS_TOTAL: "Analyses by single-flight role (executed/coalesced/retried)",
+    HTTP_REQUEST_SECONDS: "HTTP API request latency per endpoint",
+    HEDGES_TOTAL: "Hedged analyses by outcome (none/primary_won/backup_won/failed/skipped)",
+    DEADLINE_EXCEEDED_TOTAL: "Analyses that ran out of their deadline, by stage",
+}
+
+
+class _NullTimer:
+    """無効時に返す何もしないタイマー"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._started
+        self._metrics.observe(self._name, self.elapsed, **self._labels)
+        return False
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> list:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_key: tuple, extra: tuple = ()) -> str:
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs)
+    return "{" + body + "}"
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """スレッドセーフなカウンターとヒストグラムの集合"""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {label_key: value}
+        self._histograms = {}  # name -> {label_key: _Histogram}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        """集計値をすべて消す"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """カウンターを増やす"""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: tuple = DEFAULT_LATENCY_BUCKETS,
+        **labels,
+    ) -> None:
+        """ヒストグラムに値を記録"""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        """with ブロックの所要時間をヒストグラムに記録するタイマー"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def stage(self, stage: str):
+        """処理段階（preprocess, model_call など）の所要時間を記録するタイマー"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, STAGE_SECONDS, {"stage": stage})
+
+    def snapshot(self) -> dict:
+        """JSONに変換できる形で現在の値を返す"""
+        with self._lock:
+            counters = {
+                name: [
+                    {"labels": dict(key), "value": value}
+                    for key, value in sorted(series.items())
+                ]
+                for name, series in sorted(self._counters.items())
+            }
+            histograms = {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "buckets": {
+                            _format_number(bound): cumulative
+                            for bound, cumulative in zip(
+                                histogram.buckets, histogram.cumulative()
+                            )
+                        },
+                    }
+                    for key, histogram in sorted(series.items())
+                ]
+                for name, series in sorted(self._histograms.items())
+            }
+        return {"enabled": self.enabled, "counters": counters, "histograms": histograms}
+
+    def prometheus_text(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_number(value)}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, cumulative in zip(
+                        histogram.buckets, histogram.cumulative()
+                    ):
+                        le = (("le", _format_number(float(bound))),)
+                        lines.append(
+                            f"{name}_bucket{_format_labels(key, le)} {cumulative}"
+                        )
+                    inf = (("le", "+Inf"),)
+                    lines.append(
+                        f"{name}_bucket{_format_labels(key, inf)} {histogram.count}"
+                    )
+                    lines.append(
+                        f"{name}_sum{_format_labels(key)} {_format_number(histogram.sum)}"
+                    )
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+_default_metrics: Optional[Metrics] = None
+_default_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """プロセス共通のメトリクスを返す（FENGSHUI_METRICS=1 なら有効）"""
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics(
+                enabled=os.environ.get("FENGSHUI_METRICS", "").lower()
+                in ("1", "true", "yes", "on")
+            )
+        return _default_metrics
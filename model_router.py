@@ -0,0 +1,270 @@
+"""
+モデルの健全性に基づくルーティング
+Health-aware model router with per-model circuit breakers
+"""
+
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+# エラーの分類
+ERROR_RETRYABLE = "retryable"  # 429/5xx・通信エラー：次のモデルへ切り替え、一定時間避ける
+ERROR_MODEL = "model"  # 404など：このモデルは長時間使わない
+ERROR_FATAL = "fatal"  # APIキー不正など：どのモデルでも失敗するので打ち切る
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+MODEL_STATUS_CODES = {404}
+FATAL_STATUS_CODES = {400, 401, 403}
+
+DEFAULT_FAILURE_THRESHOLD = 2
+DEFAULT_COOLDOWN_SECONDS = 30.0
+DEFAULT_MAX_COOLDOWN_SECONDS = 600.0
+DEFAULT_MODEL_COOLDOWN_SECONDS = 3600.0
+# レイテンシの指数移動平均の重み
+LATENCY_EWMA_ALPHA = 0.2
+# パーセンタイルの計算に使う直近の成功レイテンシの件数と、計算に必要な最小件数
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+# ヘッジの結果の分類
+HEDGE_NONE = "none"  # 待ち時間内に応答があり、予備のリクエストは送らなかった
+HEDGE_PRIMARY_WON = "primary_won"
+HEDGE_BACKUP_WON = "backup_won"
+HEDGE_FAILED = "failed"  # 予備を送ったが、どちらも有効な結果を返さなかった
+HEDGE_SKIPPED = "skipped"  # レート制限の待ちが発生するため予備を送らなかった
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """例外からHTTPステータスコードを取り出す"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return int(code)
+    # SDKのバージョンによってはメッセージにのみコードが含まれる
+    match = re.match(r"\s*(\d{3})\b", str(error))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def classify_error(error: Exception) -> str:
+    """例外を再試行可能・モデル固有・致命的に分類"""
+    code = _status_code(error)
+    if code in FATAL_STATUS_CODES:
+        return ERROR_FATAL
+    if code in MODEL_STATUS_CODES:
+        return ERROR_MODEL
+    # 429/5xx・通信エラーなどは別モデルで再試行する
+    return ERROR_RETRYABLE
+
+
+class ModelHealth:
+    """1モデル分の成功率・レイテンシ・サーキットブレーカーの状態"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.successes = 0
+        self.failures = 0
+        self.parse_failures = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.last_error = ""
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def success_rate(self) -> float:
+        total = self.successes + self.failures
+        return self.successes / total if total else 1.0
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """直近の成功レイテンシのパーセンタイル（件数が足りなければNone）"""
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        rank = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[rank]
+
+    def to_dict(self, now: float) -> dict:
+        p95 = self.latency_percentile(95)
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "parse_failures": self.parse_failures,
+            "success_rate": round(self.success_rate(), 3),
+            "latency_ewma": (
+                round(self.latency_ewma, 3) if self.latency_ewma is not None else None
+            ),
+            "latency_p95": round(p95, 3) if p95 is not None else None,
+            "circuit_open": self.is_open(now),
+            "open_for_seconds": round(max(0.0, self.open_until - now), 1),
+            "last_error": self.last_error,
+        }
+
+
+class ModelRouter:
+    """直近で成功したモデルを優先し、失敗中のモデルを飛ばして試行順を決める"""
+
+    def __init__(
+        self,
+        models: list,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        cooldown_seconds: float = DEFAULT_COOLDOWN_SECONDS,
+        max_cooldown_seconds: float = DEFAULT_MAX_COOLDOWN_SECONDS,
+        model_cooldown_seconds: float = DEFAULT_MODEL_COOLDOWN_SECONDS,
+    ):
+        self.models = list(models)
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.model_cooldown_seconds = model_cooldown_seconds
+        self._health = {name: ModelHealth(name) for name in self.models}
+        self._preferred: Optional[str] = None
+        self._hedges = Counter()
+        self._hedge_extra_calls = 0
+        self._lock = threading.Lock()
+
+    def candidates(self) -> list:
+        """今回試行するモデルを順番に返す"""
+        with self._lock:
+            now = time.monotonic()
+            ordered = list(self.models)
+            if self._preferred in self._health:
+                ordered.remove(self._preferred)
+                ordered.insert(0, self._preferred)
+            available = [m for m in ordered if not self._health[m].is_open(now)]
+            if available:
+                return available
+            # 全モデルが停止中なら、最も早く復帰するモデルを1つだけ試す（半開状態）
+            return [min(ordered, key=lambda m: self._health[m].open_until)]
+
+    def record_success(self, model_name: str, latency: float) -> None:
+        """成功を記録し、サーキットを閉じる"""
+        with self._lock:
+            health = self._health.setdefault(model_name, ModelHealth(model_name))
+            health.successes += 1
+            health.consecutive_failures = 0
+            health.open_until = 0.0
+            health.cooldown = 0.0
+            if health.latency_ewma is None:
+                health.latency_ewma = latency
+            else:
+                health.latency_ewma += LATENCY_EWMA_ALPHA * (
+                    latency - health.latency_ewma
+                )
+            health.latencies.append(latency)
+            self._preferred = model_name
+
+    def record_slow_call(self, model_name: str, elapsed: float) -> None:
+        """ヘッジに負けて取り消した呼び出しの経過時間を記録
+
+        実際のレイテンシは elapsed 以上だが、パーセンタイルの順位は変わらないので
+        そのまま加える（加えないと遅い呼び出しが抜けて待ち時間が短くなっていく）。
+        """
+        with self._lock:
+            health = self._health.setdefault(model_name, ModelHealth(model_name))
+            health.latencies.append(elapsed)
+
+    def hedge_delay(self, model_name: str, percentile: float, default: float) -> float:
+        """予備のリクエストを送るまでの待ち時間（直近のレイテンシのパーセンタイル）
+
+        成功の記録が MIN_LATENCY_SAMPLES 件に満たないモデルは default を使う。
+        """
+        with self._lock:
+            health = self._health.get(model_name)
+            value = health.latency_percentile(percentile) if health else None
+        return default if value is None else value
+
+    def record_hedge(self, outcome: str, extra_calls: int = 0) -> None:
+        """ヘッジ対象の分析1件の結果と、取り消した（無駄になった）呼び出し数を記録"""
+        with self._lock:
+            self._hedges[outcome] += 1
+            self._hedge_extra_calls += extra_calls
+
+    def hedge_stats(self) -> dict:
+        """ヘッジの統計（cost_overhead は分析1件あたりの余分な呼び出し数）"""
+        with self._lock:
+            analyses = sum(self._hedges.values())
+            hedged = (
+                self._hedges[HEDGE_PRIMARY_WON]
+                + self._hedges[HEDGE_BACKUP_WON]
+                + self._hedges[HEDGE_FAILED]
+            )
+            return {
+                "analyses": analyses,
+                "hedged": hedged,
+                "primary_won": self._hedges[HEDGE_PRIMARY_WON],
+                "backup_won": self._hedges[HEDGE_BACKUP_WON],
+                "failed": self._hedges[HEDGE_FAILED],
+                "skipped": self._hedges[HEDGE_SKIPPED],
+                "extra_calls": self._hedge_extra_calls,
+                "hedge_rate": round(hedged / analyses, 3) if analyses else 0.0,
+                "cost_overhead": (
+                    round(self._hedge_extra_calls / analyses, 3) if analyses else 0.0
+                ),
+            }
+
+    def record_failure(self, model_name: str, error: Exception) -> str:
+        """失敗を記録し、必要ならサーキットを開く（エラー分類を返す）"""
+        kind = classify_error(error)
+        with self._lock:
+            health = self._health.setdefault(model_name, ModelHealth(model_name))
+            health.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+            if kind == ERROR_FATAL:
+                # リクエスト側の問題なのでモデルの健全性には数えない
+                return kind
+
+            health.failures += 1
+            health.consecutive_failures += 1
+            now = time.monotonic()
+            if kind == ERROR_MODEL:
+                health.open_until = now + self.model_cooldown_seconds
+            elif (
+                _status_code(error) == 429
+                or health.consecutive_failures >= self.failure_threshold
+            ):
+                # 再オープンのたびに待ち時間を倍にする
+                health.cooldown = min(
+                    self.max_cooldown_seconds,
+                    health.cooldown * 2 if health.cooldown else self.cooldown_seconds,
+                )
+                health.open_until = now + health.cooldown
+            if self._preferred == model_name:
+                self._preferred = None
+            return kind
+
+    def record_parse_failure(self, model_name: str, error: Exception) -> None:
+        """応答の解析失敗を記録（モデルは応答しているのでサーキットには影響しない）"""
+        with self._lock:
+            health = self._health.setdefault(model_name, ModelHealth(model_name))
+            health.parse_failures += 1
+            health.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+
+    def snapshot(self) -> dict:
+        """監視用に各モデルの状態を返す"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "preferred": self._preferred,
+                "hedging": dict(self._hedges),
+                "models": {
+                    name: health.to_dict(now) for name, health in self._health.items()
+                },
+            }
+
+
+_default_router: Optional[ModelRouter] = None
+_default_router_lock = threading.Lock()
+
+
+def get_model_router(models: list) -> ModelRouter:
+    """プロセス共通のルーターを返す（初回呼び出し時のモデル一覧で作成）"""
+    global _default_router
+    with _default_router_lock:
+        if _default_router is None:
+            _default_router = ModelRouter(models)
+        return _default_router
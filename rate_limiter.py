@@ -0,0 +1,201 @@
+"""
+Gemini API呼び出しのレート制限と待ち行列
+Process-wide, quota-aware rate limiter and fair request queue for Gemini calls
+
+Streamlit の各セッションは別スレッド・別イベントループで動くため、
+状態はスレッドロックで守り、待機だけを各イベントループ上で行う。
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+DEFAULT_RPM = float(os.environ.get("FENGSHUI_RPM", "15"))
+DEFAULT_RPD = int(os.environ.get("FENGSHUI_RPD", "1500"))
+DEFAULT_BURST = int(os.environ.get("FENGSHUI_RATE_BURST", "1"))
+DEFAULT_MAX_WAIT_SECONDS = float(os.environ.get("FENGSHUI_MAX_QUEUE_WAIT", "120"))
+
+SECONDS_PER_DAY = 24 * 3600
+
+
+class QuotaExceededError(Exception):
+    """待ち時間が上限を超える（1日の上限到達を含む）ときに送出"""
+
+    def __init__(self, estimated_wait: float, reason: str):
+        self.estimated_wait = estimated_wait
+        self.reason = reason
+        super().__init__(f"{reason} (estimated wait {estimated_wait:.0f}s)")
+
+
+class Reservation:
+    """1リクエスト分の予約（待ち順と推定待ち時間）"""
+
+    def __init__(self, ticket: int, position: int, wait_seconds: float):
+        self.ticket = ticket
+        self.position = position
+        self.wait_seconds = wait_seconds
+
+
+class RateLimiter:
+    """1分・1日あたりの上限を守るトークンバケット（GCRA）と先着順の待ち行列
+
+    予約は到着順に時刻枠を割り当てるため、後から来た呼び出しが先に通ることはない。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = DEFAULT_RPM,
+        requests_per_day: int = DEFAULT_RPD,
+        burst: int = DEFAULT_BURST,
+        max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS,
+    ):
+        self._lock = threading.Lock()
+        self._tat = 0.0  # 次のリクエストの理論到着時刻
+        self._day = self._current_day()
+        self._used_today = 0
+        self._next_ticket = 0
+        self._waiting = 0
+        self._granted = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_observed_wait = 0.0
+        self.configure(requests_per_minute, requests_per_day, burst, max_wait_seconds)
+
+    def configure(
+        self,
+        requests_per_minute: float = None,
+        requests_per_day: int = None,
+        burst: int = None,
+        max_wait_seconds: float = None,
+    ) -> None:
+        """上限を変更（0以下は無制限）"""
+        with self._lock:
+            if max_wait_seconds is not None:
+                self.max_wait_seconds = max_wait_seconds
+            if requests_per_minute is not None:
+                self.requests_per_minute = requests_per_minute
+            if requests_per_day is not None:
+                self.requests_per_day = requests_per_day
+            if burst is not None:
+                self.burst = max(1, burst)
+
+    @staticmethod
+    def _current_day() -> int:
+        return int(time.time() // SECONDS_PER_DAY)
+
+    def _seconds_until_next_day(self) -> float:
+        return SECONDS_PER_DAY - (time.time() % SECONDS_PER_DAY)
+
+    def _roll_day(self) -> None:
+        day = self._current_day()
+        if day != self._day:
+            self._day = day
+            self._used_today = 0
+
+    def _compute_wait(self, now: float) -> tuple:
+        """次の予約の開始時刻と待ち時間を計算（ロック取得済み）"""
+        if self.requests_per_minute <= 0:
+            return now, 0.0
+        interval = 60.0 / self.requests_per_minute
+        tolerance = interval * (self.burst - 1)
+        start = max(now, self._tat - tolerance)
+        return start, start - now
+
+    def _admit(self, now: float) -> tuple:
+        """上限内で予約できるなら開始時刻と待ち時間を返す（ロック取得済み）
+
+        1日の上限に達しているか、待ち時間が上限を超えるなら QuotaExceededError。
+        """
+        self._roll_day()
+        if 0 < self.requests_per_day <= self._used_today:
+            self._rejected += 1
+            raise QuotaExceededError(
+                self._seconds_until_next_day(), "daily request quota exhausted"
+            )
+        start, wait = self._compute_wait(now)
+        if wait > self.max_wait_seconds:
+            self._rejected += 1
+            raise QuotaExceededError(wait, "request queue is full")
+        return start, wait
+
+    def estimate_wait(self) -> float:
+        """今予約した場合の推定待ち時間（秒）"""
+        with self._lock:
+            self._roll_day()
+            if 0 < self.requests_per_day <= self._used_today:
+                return self._seconds_until_next_day()
+            return self._compute_wait(time.monotonic())[1]
+
+    def check_wait(self) -> float:
+        """予約せずに推定待ち時間を返す（reserve と同じく上限超過は QuotaExceededError）"""
+        with self._lock:
+            return self._admit(time.monotonic())[1]
+
+    def reserve(self) -> Reservation:
+        """時刻枠を予約する（待ち時間が上限を超えるなら QuotaExceededError）"""
+        with self._lock:
+            now = time.monotonic()
+            start, wait = self._admit(now)
+
+            if self.requests_per_minute > 0:
+                self._tat = max(now, self._tat) + 60.0 / self.requests_per_minute
+            self._used_today += 1
+            self._granted += 1
+            self._total_wait += wait
+            self._max_observed_wait = max(self._max_observed_wait, wait)
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            position = self._waiting + 1 if wait > 0 else 0
+            if wait > 0:
+                self._waiting += 1
+            return Reservation(ticket, position, wait)
+
+    def _release_waiter(self) -> None:
+        with self._lock:
+            self._waiting -= 1
+
+    async def acquire(self, on_wait: Optional[Callable] = None) -> Reservation:
+        """予約した時刻枠まで待つ（待つ場合は on_wait(reservation) で通知）"""
+        reservation = self.reserve()
+        if reservation.wait_seconds <= 0:
+            return reservation
+        if on_wait is not None:
+            on_wait(reservation)
+        try:
+            await asyncio.sleep(reservation.wait_seconds)
+        finally:
+            self._release_waiter()
+        return reservation
+
+    def stats(self) -> dict:
+        """監視用の統計（待ち行列の深さ・待ち時間など）"""
+        with self._lock:
+            self._roll_day()
+            return {
+                "queue_depth": self._waiting,
+                "estimated_wait": round(self._compute_wait(time.monotonic())[1], 3),
+                "requests_per_minute": self.requests_per_minute,
+                "requests_per_day": self.requests_per_day,
+                "used_today": self._used_today,
+                "granted": self._granted,
+                "rejected": self._rejected,
+                "avg_wait": (
+                    round(self._total_wait / self._granted, 3) if self._granted else 0.0
+                ),
+                "max_wait": round(self._max_observed_wait, 3),
+            }
+
+
+_default_limiter: Optional[RateLimiter] = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """全Gemini呼び出しで共有するプロセス共通のレート制限を返す"""
+    global _default_limiter
+    with _default_limiter_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter()
+        return _default_limiter
@@ -0,0 +1,419 @@
+"""
+分析結果・レポートの履歴を保存するSQLiteストア
+Local SQLite store for face analyses and compatibility reports
+
+ディスクキャッシュ（analysis_cache）は期限・件数の上限で古い結果を消すが、
+こちらは結果を消さずに残し、生年月日・五行・スコアなどで過去の結果を検索できる。
+WALモードで開くため、複数のセッション（スレッド・プロセス）が同時に書き込んでも
+読み込みは待たされない。接続はスレッドごとに1つ持つ。
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_BATCH_SIZE = int(os.environ.get("FENGSHUI_RESULT_DB_BATCH_SIZE", "32"))
+DEFAULT_FLUSH_INTERVAL = float(os.environ.get("FENGSHUI_RESULT_DB_FLUSH_SECONDS", "1"))
+DEFAULT_BUSY_TIMEOUT = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    fingerprint TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    model TEXT NOT NULL,
+    fortune_score INTEGER,
+    wealth_fortune_score INTEGER,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (fingerprint, prompt_version, model)
+);
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    source TEXT NOT NULL,
+    birth_date TEXT NOT NULL,
+    man_element TEXT,
+    candidate_count INTEGER NOT NULL,
+    recommendation TEXT
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    report_id INTEGER NOT NULL REFERENCES reports(id) ON DELETE CASCADE,
+    rank INTEGER,
+    name TEXT,
+    fingerprint TEXT,
+    element TEXT,
+    compatibility_score REAL,
+    fortune_score INTEGER,
+    wealth_fortune_score INTEGER,
+    total_score REAL,
+    birth_date TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reports_birth_date ON reports (birth_date, created_at);
+CREATE INDEX IF NOT EXISTS idx_candidates_report ON candidates (report_id);
+CREATE INDEX IF NOT EXISTS idx_candidates_fingerprint ON candidates (fingerprint);
+CREATE INDEX IF NOT EXISTS idx_candidates_birth_date
+    ON candidates (birth_date, total_score);
+CREATE INDEX IF NOT EXISTS idx_candidates_element ON candidates (element, total_score);
+CREATE INDEX IF NOT EXISTS idx_candidates_total_score ON candidates (total_score);
+CREATE INDEX IF NOT EXISTS idx_candidates_wealth ON candidates (wealth_fortune_score);
+CREATE INDEX IF NOT EXISTS idx_candidates_created_at ON candidates (created_at);
+"""
+
+# 検索結果の並び順に使える列（SQLに埋め込むため許可した列だけ受け付ける）
+ORDER_COLUMNS = ("total_score", "wealth_fortune_score", "fortune_score", "created_at")
+
+_CANDIDATE_COLUMNS = (
+    "report_id",
+    "rank",
+    "name",
+    "fingerprint",
+    "element",
+    "compatibility_score",
+    "fortune_score",
+    "wealth_fortune_score",
+    "total_score",
+    "birth_date",
+    "created_at",
+)
+
+
+def format_birth_date(birth_date) -> str:
+    """date・datetime・文字列の生年月日を "YYYY-MM-DD" にそろえる"""
+    if isinstance(birth_date, str):
+        return birth_date[:10]
+    return f"{birth_date:%Y-%m-%d}"
+
+
+class ResultStore:
+    """分析結果とレポートの履歴をSQLiteに保存・検索する"""
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.busy_timeout = busy_timeout
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._initialized = False
+        # 未書き込みの分析結果: (指紋, プロンプト版, モデル名) -> 行
+        self._pending = {}
+        self._flush_timer = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """このスレッドの接続を返す（初回はスキーマを作成）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        conn.row_factory = sqlite3.Row
+        # WALは書き込み中も読み込みを止めない。NORMAL はWALなら十分安全で速い
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        with self._lock:
+            if not self._initialized:
+                with conn:
+                    conn.executescript(_SCHEMA)
+                self._initialized = True
+        self._local.conn = conn
+        return conn
+
+    def get_analysis(
+        self, fingerprint: str, prompt_version: str, model_names: list
+    ) -> Optional[dict]:
+        """保存済みの分析結果を探す（model_names の順に探し、最初に見つかったもの）"""
+        with self._lock:
+            for model_name in model_names:
+                row = self._pending.get((fingerprint, prompt_version, model_name))
+                if row is not None:
+                    self.hits += 1
+                    return json.loads(row[5])
+
+        placeholders = ", ".join("?" for _ in model_names)
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT model, result FROM analyses"
+                f" WHERE fingerprint = ? AND prompt_version = ? AND model IN ({placeholders})",
+                (fingerprint, prompt_version, *model_names),
+            )
+            .fetchall()
+        )
+        results = {row["model"]: row["result"] for row in rows}
+        with self._lock:
+            for model_name in model_names:
+                if model_name in results:
+                    self.hits += 1
+                    return json.loads(results[model_name])
+            self.misses += 1
+        return None
+
+    def add_analysis(
+        self, fingerprint: str, prompt_version: str, model_name: str, analysis: dict
+    ) -> None:
+        """分析結果を追加（batch_size 件たまるか flush_interval 秒たつと書き込む）
+
+        書き込むまでは他のプロセスから見えないため、件数がたまらなくても
+        flush_interval 秒後には別スレッドで書き込む（0 なら件数だけで判断する）。
+        """
+        row = (
+            fingerprint,
+            prompt_version,
+            model_name,
+            analysis.get("fortune_score"),
+            analysis.get("wealth_fortune_score"),
+            json.dumps(analysis, ensure_ascii=False),
+            time.time(),
+        )
+        with self._lock:
+            self._pending[row[:3]] = row
+            full = len(self._pending) >= self.batch_size
+            if not full and self._flush_timer is None and self.flush_interval > 0:
+                self._flush_timer = threading.Timer(
+                    self.flush_interval, self._flush_later
+                )
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if full:
+            self.flush()
+
+    def _flush_later(self) -> None:
+        """タイマーのスレッドで書き込み、そのスレッドの接続を閉じる"""
+        with self._lock:
+            self._flush_timer = None
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logging.warning(f"Result store flush failed: {str(e)}")
+        finally:
+            self._close_connection()
+
+    def _take_pending(self) -> list:
+        with self._lock:
+            rows = list(self._pending.values())
+            self._pending.clear()
+        return rows
+
+    def _write_analyses(self, conn: sqlite3.Connection, rows: list) -> None:
+        conn.executemany(
+            "INSERT OR REPLACE INTO analyses"
+            " (fingerprint, prompt_version, model, fortune_score,"
+            " wealth_fortune_score, result, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def flush(self) -> None:
+        """たまっている分析結果を1回のトランザクションで書き込む"""
+        rows = self._take_pending()
+        if not rows:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                self._write_analyses(conn, rows)
+        except sqlite3.Error:
+            # 書き込めなかった分は戻し、次の書き込みで再試行する
+            with self._lock:
+                for row in rows:
+                    self._pending.setdefault(row[:3], row)
+            raise
+
+    def record_report(
+        self,
+        birth_date,
+        man_element: str,
+        candidates: list,
+        fingerprints: list = None,
+        source: str = "app",
+        recommendation: str = None,
+    ) -> int:
+        """レポート1件と候補者全員を1回のトランザクションで保存し、レポートIDを返す
+
+        candidates は score_candidate の結果（rank があれば順位として保存）。
+        fingerprints は candidates と同じ順の画像の指紋（不明なものは None）。
+        たまっている分析結果も同じトランザクションで書き込む。
+        """
+        birth_date = format_birth_date(birth_date)
+        if fingerprints is None:
+            fingerprints = [None] * len(candidates)
+        now = time.time()
+        pending = self._take_pending()
+        conn = self._connect()
+        try:
+            with conn:
+                if pending:
+                    self._write_analyses(conn, pending)
+                report_id = conn.execute(
+                    "INSERT INTO reports (created_at, source, birth_date, man_element,"
+                    " candidate_count, recommendation) VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        now,
+                        source,
+                        birth_date,
+                        man_element,
+                        len(candidates),
+                        recommendation,
+                    ),
+                ).lastrowid
+                conn.executemany(
+                    f"INSERT INTO candidates ({', '.join(_CANDIDATE_COLUMNS)})"
+                    f" VALUES ({', '.join('?' for _ in _CANDIDATE_COLUMNS)})",
+                    [
+                        (
+                            report_id,
+                            candidate.get("rank"),
+                            candidate.get("name"),
+                            fingerprint,
+                            candidate.get("element"),
+                            candidate.get("compatibility", {}).get("score"),
+                            candidate.get("face_analysis", {}).get("fortune_score"),
+                            candidate.get("face_analysis", {}).get(
+                                "wealth_fortune_score"
+                            ),
+                            candidate.get("total_score"),
+                            birth_date,
+                            now,
+                        )
+                        for candidate, fingerprint in zip(candidates, fingerprints)
+                    ],
+                )
+        except sqlite3.Error:
+            with self._lock:
+                for row in pending:
+                    self._pending.setdefault(row[:3], row)
+            raise
+        return report_id
+
+    def query_candidates(
+        self,
+        birth_date=None,
+        element: str = None,
+        fingerprint: str = None,
+        since: float = None,
+        order_by: str = "total_score",
+        limit: int = 20,
+    ) -> list:
+        """過去のレポートの候補者を条件で検索し、order_by の降順で返す
+
+        例: 同じ生年月日で採点した全候補者、今週の金運スコア上位
+        （since=time.time() - 7 * 86400, order_by="wealth_fortune_score"）。
+        """
+        if order_by not in ORDER_COLUMNS:
+            raise ValueError(f"order_by must be one of {ORDER_COLUMNS}: {order_by!r}")
+        conditions, params = [], []
+        if birth_date is not None:
+            conditions.append("birth_date = ?")
+            params.append(format_birth_date(birth_date))
+        if element is not None:
+            conditions.append("element = ?")
+            params.append(element)
+        if fingerprint is not None:
+            conditions.append("fingerprint = ?")
+            params.append(fingerprint)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = (
+            self._connect()
+            .execute(
+                f"SELECT * FROM candidates{where}"
+                f" ORDER BY {order_by} DESC, created_at DESC LIMIT ?",
+                (*params, limit),
+            )
+            .fetchall()
+        )
+        return [dict(row) for row in rows]
+
+    def recent_reports(self, birth_date=None, limit: int = 20) -> list:
+        """新しい順のレポート一覧（birth_date で絞り込み可能）"""
+        if birth_date is None:
+            sql, params = "SELECT * FROM reports", ()
+        else:
+            sql = "SELECT * FROM reports WHERE birth_date = ?"
+            params = (format_birth_date(birth_date),)
+        rows = (
+            self._connect()
+            .execute(f"{sql} ORDER BY created_at DESC LIMIT ?", (*params, limit))
+            .fetchall()
+        )
+        return [dict(row) for row in rows]
+
+    def stats(self) -> dict:
+        """件数・ヒット数などの統計を返す"""
+        conn = self._connect()
+        counts = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("analyses", "reports", "candidates")
+        }
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                **counts,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        """たまっている分を書き込み、このスレッドの接続を閉じる"""
+        with self._lock:
+            timer, self._flush_timer = self._flush_timer, None
+        if timer is not None:
+            timer.cancel()
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logging.warning(f"Result store flush failed: {str(e)}")
+        self._close_connection()
+
+    def _close_connection(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_default_store: Optional[ResultStore] = None
+_default_store_lock = threading.Lock()
+
+
+def default_store_path() -> str:
+    """既定の保存先（FENGSHUI_RESULT_DB、なければキャッシュと同じディレクトリ）"""
+    path = os.environ.get("FENGSHUI_RESULT_DB")
+    if path:
+        return path
+    cache_dir = os.environ.get("FENGSHUI_CACHE_DIR") or os.path.join(
+        os.getcwd(), "cache"
+    )
+    return os.path.join(cache_dir, "results.db")
+
+
+def get_result_store() -> ResultStore:
+    """プロセス共通のストアを返す（終了時にたまっている分を書き込む）"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            import atexit
+
+            _default_store = ResultStore(default_store_path())
+            atexit.register(_default_store.close)
+        return _default_store
@@ -0,0 +1,165 @@
+"""
+干支（六十干支）と五行の早見表
+Precomputed sexagenary (stem-branch) calendar with the risshun year boundary
+
+干支の年は元日ではなく立春（2月3〜5日ごろ）で切り替わる。1900〜2100年の立春の
+日付（日本時間）を表として持ち、生年月日から干支と五行を O(1) で引く。
+表の範囲外の年は立春を2月4日とみなす。
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+
+# 十干
+HEAVENLY_STEMS = ("甲", "乙", "丙", "丁", "戊", "己", "庚", "辛", "壬", "癸")
+# 十二支（表示用の動物名付き）
+EARTHLY_BRANCHES = ("子", "丑", "寅", "卯", "辰", "巳", "午", "未", "申", "酉", "戌", "亥")
+ZODIAC_ANIMALS = [
+    "子(鼠)",
+    "丑(牛)",
+    "寅(虎)",
+    "卯(兎)",
+    "辰(龍)",
+    "巳(蛇)",
+    "午(馬)",
+    "未(羊)",
+    "申(猿)",
+    "酉(鶏)",
+    "戌(犬)",
+    "亥(猪)",
+]
+
+# 一括計算で使う五行の並び（相生の循環順）
+ELEMENT_ORDER = ["木", "火", "土", "金", "水"]
+# 十干の五行（甲乙=木、丙丁=火、戊己=土、庚辛=金、壬癸=水）
+STEM_ELEMENTS = tuple(ELEMENT_ORDER[index // 2] for index in range(10))
+# 十二支の五行（相性の計算にはこちらを使う）
+BRANCH_ELEMENTS = ("水", "土", "木", "木", "土", "火", "火", "土", "金", "金", "土", "水")
+ZODIAC_ELEMENTS = dict(zip(ZODIAC_ANIMALS, BRANCH_ELEMENTS))
+
+# 甲子の年（西暦4年・1984年など）を0とする
+CYCLE_BASE_YEAR = 4
+
+TABLE_FIRST_YEAR = 1900
+TABLE_LAST_YEAR = 2100
+DEFAULT_RISSHUN_DAY = 4
+# 各年の立春の日（2月の何日か、日本時間）。太陽黄経315度の時刻から計算した
+_RISSHUN_DAYS = bytes(
+    int(day)
+    for day in (
+        "44555455545554555445"  # 1900-1919
+        "54455445544554455445"  # 1920-1939
+        "54455445544554445444"  # 1940-1959
+        "54445444544454445444"  # 1960-1979
+        "54445444444444444444"  # 1980-1999
+        "44444444444444444444"  # 2000-2019
+        "43444344434443444344"  # 2020-2039
+        "43444344434443444334"  # 2040-2059
+        "43344334433443344334"  # 2060-2079
+        "43344334433343334333"  # 2080-2099
+        "4"  # 2100
+    )
+)
+
+
+@dataclass(frozen=True)
+class Sexagenary:
+    """六十干支の1つ（甲子〜癸亥）"""
+
+    index: int
+    stem: str
+    branch: str
+    zodiac: str
+    element: str
+    stem_element: str
+
+    @property
+    def name(self) -> str:
+        """干支の名前（例: 甲子）"""
+        return self.stem + self.branch
+
+
+# 六十干支をすべて作っておき、検索時は添字で引くだけにする
+SEXAGENARY_CYCLE = tuple(
+    Sexagenary(
+        index=index,
+        stem=HEAVENLY_STEMS[index % 10],
+        branch=EARTHLY_BRANCHES[index % 12],
+        zodiac=ZODIAC_ANIMALS[index % 12],
+        element=BRANCH_ELEMENTS[index % 12],
+        stem_element=STEM_ELEMENTS[index % 10],
+    )
+    for index in range(60)
+)
+
+
+def risshun_day(year: int) -> int:
+    """その年の立春が2月の何日か（表の範囲外は2月4日）"""
+    if TABLE_FIRST_YEAR <= year <= TABLE_LAST_YEAR:
+        return _RISSHUN_DAYS[year - TABLE_FIRST_YEAR]
+    return DEFAULT_RISSHUN_DAY
+
+
+def sexagenary_year(birth_date) -> int:
+    """生年月日が属する干支の年（立春より前に生まれた場合は前年）"""
+    year = birth_date.year
+    if birth_date.month == 1 or (
+        birth_date.month == 2 and birth_date.day < risshun_day(year)
+    ):
+        return year - 1
+    return year
+
+
+def sexagenary_of_year(year: int) -> Sexagenary:
+    """干支の年（立春から翌年の立春の前日まで）の干支"""
+    return SEXAGENARY_CYCLE[(year - CYCLE_BASE_YEAR) % 60]
+
+
+def lookup_sexagenary(birth_date) -> Sexagenary:
+    """生年月日（date または datetime）から干支を引く"""
+    return sexagenary_of_year(sexagenary_year(birth_date))
+
+
+@lru_cache(maxsize=1)
+def _bulk_tables() -> tuple:
+    """一括検索用のNumPy配列（立春の年内通算日・干支ごとの五行の添字）"""
+    import numpy as np
+
+    # 1月1日を0とする立春の通算日（2月d日 = 31 + d - 1）
+    risshun_offsets = np.frombuffer(_RISSHUN_DAYS, dtype=np.uint8).astype(np.int64) + 30
+    element_codes = np.array(
+        [ELEMENT_ORDER.index(item.element) for item in SEXAGENARY_CYCLE], dtype=np.intp
+    )
+    return risshun_offsets, element_codes
+
+
+def bulk_sexagenary_indices(birth_dates):
+    """生年月日の配列から六十干支の添字（甲子=0）の配列を一括計算
+
+    birth_dates は date・datetime・"YYYY-MM-DD" 文字列のリストか datetime64 配列。
+    """
+    import numpy as np
+
+    risshun_offsets, _ = _bulk_tables()
+    days = np.asarray(birth_dates, dtype="datetime64[D]")
+    year_starts = days.astype("datetime64[Y]")
+    years = year_starts.astype(np.int64) + 1970
+    day_of_year = (days - year_starts).astype(np.int64)
+
+    in_table = (years >= TABLE_FIRST_YEAR) & (years <= TABLE_LAST_YEAR)
+    boundary = np.where(
+        in_table,
+        risshun_offsets[np.clip(years - TABLE_FIRST_YEAR, 0, len(risshun_offsets) - 1)],
+        DEFAULT_RISSHUN_DAY + 30,
+    )
+    cycle_years = years - (day_of_year < boundary)
+    return ((cycle_years - CYCLE_BASE_YEAR) % 60).astype(np.intp)
+
+
+def bulk_elements(birth_dates):
+    """生年月日の配列から五行の添字（ELEMENT_ORDER の順）の配列を一括計算
+
+    結果は bulk_element_compatibility・bulk_total_scores にそのまま渡せる。
+    """
+    _, element_codes = _bulk_tables()
+    return element_codes[bulk_sexagenary_indices(birth_dates)]
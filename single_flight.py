@@ -0,0 +1,109 @@
+"""
+同じ分析の同時実行をまとめる
+Single-flight coalescing of identical in-flight calls
+
+同じキーの呼び出しが実行中なら、後から来た呼び出しは新たに実行せずに
+その結果（または例外）を待つ。Streamlit の各セッションは別スレッド・
+別イベントループで動くため、共有する結果は concurrent.futures.Future で持ち、
+待機だけを各イベントループ上で行う。
+"""
+
+import asyncio
+import concurrent.futures
+import copy
+import threading
+from typing import Awaitable, Callable, Optional
+
+from metrics import SINGLE_FLIGHT_CALLS_TOTAL, get_metrics
+
+
+class _LeaderCancelled(Exception):
+    """実行していた呼び出しが取り消された（待っていた側は自分で実行し直す）"""
+
+
+class SingleFlight:
+    """キーごとに実行中の呼び出しを1つに保ち、同時に来た呼び出しに結果を配る"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> concurrent.futures.Future
+        self._executed = 0
+        self._coalesced = 0
+        self._retried = 0
+
+    async def do(self, key, func: Callable[[], Awaitable]):
+        """func() を実行して結果を返す（同じキーが実行中ならその結果を待つ）
+
+        待っていた側には結果のコピーを返すため、呼び出し側が結果を書き換えても
+        互いに影響しない。実行していた呼び出しが取り消された場合、待っていた側は
+        取り消されずに自分で実行し直す。
+        """
+        while True:
+            with self._lock:
+                shared = self._calls.get(key)
+                leader = shared is None
+                if leader:
+                    shared = concurrent.futures.Future()
+                    # 待つ側の取り消しが共有の Future に伝わらないよう実行中にする
+                    shared.set_running_or_notify_cancel()
+                    self._calls[key] = shared
+                    self._executed += 1
+                else:
+                    self._coalesced += 1
+            get_metrics().inc(
+                SINGLE_FLIGHT_CALLS_TOTAL, role="executed" if leader else "coalesced"
+            )
+
+            if leader:
+                return await self._run(key, shared, func)
+            try:
+                return copy.deepcopy(await asyncio.wrap_future(shared))
+            except _LeaderCancelled:
+                with self._lock:
+                    self._retried += 1
+                get_metrics().inc(SINGLE_FLIGHT_CALLS_TOTAL, role="retried")
+
+    async def _run(self, key, shared: concurrent.futures.Future, func: Callable):
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            self._finish(key, shared, exception=_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._finish(key, shared, exception=e)
+            raise
+        self._finish(key, shared, result=result)
+        return result
+
+    def _finish(self, key, shared, result=None, exception=None) -> None:
+        with self._lock:
+            if self._calls.get(key) is shared:
+                del self._calls[key]
+        if exception is not None:
+            shared.set_exception(exception)
+        else:
+            shared.set_result(result)
+
+    def stats(self) -> dict:
+        """監視用の統計（avoided が実行せずに済んだ重複呼び出しの数）"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self._executed,
+                "coalesced": self._coalesced,
+                "retried": self._retried,
+                "avoided": self._coalesced - self._retried,
+            }
+
+
+_default_single_flight: Optional[SingleFlight] = None
+_default_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """全セッションで共有するプロセス共通のインスタンスを返す"""
+    global _default_single_flight
+    with _default_single_flight_lock:
+        if _default_single_flight is None:
+            _default_single_flight = SingleFlight()
+        return _default_single_flight
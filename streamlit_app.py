@@ -4,16 +4,40 @@ Feng Shui Compatibility App
 """
 
 import streamlit as st
-from PIL import Image
 from datetime import datetime
 import asyncio
+import io
 import os
 from fengshui_analyzer import (
-    analyze_face_fengshui,
-    generate_compatibility_report,
-    calculate_zodiac,
-    FIVE_ELEMENTS,
+    DEFAULT_DETAIL_TOP,
+    DEFAULT_MAX_BATCH_SIZE,
+    HEDGE_ENABLED,
+    MODELS_TO_TRY,
+    TIER_FULL,
+    TIER_SCORES,
+    WORKING_IMAGE_EDGE,
+    analysis_tier,
+    analyze_faces_batched,
+    analyze_top_candidates,
+    default_candidate_name,
+    extract_face_tiles,
+    image_nbytes,
+    is_failed_analysis,
+    open_image,
+    rank_candidates,
+    save_report_history,
+    select_detail_candidates,
+    stream_faces_concurrently,
+    configure_logging,
 )
+from metrics import STAGE_SECONDS, get_metrics
+from model_router import get_model_router
+from rate_limiter import QuotaExceededError, get_rate_limiter
+from result_store import get_result_store
+from sexagenary import lookup_sexagenary
+from single_flight import get_single_flight
+
+configure_logging()
 
 # ページ設定
 st.set_page_config(
@@ -209,227 +233,427 @@ with st.sidebar:
 
     # 干支表示
     if man_birthdate:
-        zodiac = calculate_zodiac(man_birthdate.year)
+        # 干支の年は立春で切り替わるため、生年ではなく生年月日から引く
+        eto = lookup_sexagenary(man_birthdate)
         st.markdown(
             f"""
         <div style="background: linear-gradient(135deg, #667eea, #764ba2); 
                     color: white; padding: 1rem; border-radius: 10px; margin-top: 1rem;">
             <div style="font-size: 1.1rem; font-weight: 600;">あなたの干支</div>
             <div style="font-size: 2rem; text-align: center; margin-top: 0.5rem;">
-                {zodiac}
+                {eto.name}（{eto.zodiac}）
             </div>
+            <div style="text-align: center; margin-top: 0.25rem;">五行: {eto.element}</div>
         </div>
         """,
             unsafe_allow_html=True,
         )
 
-# メインエリア
-col1, col2 = st.columns(2)
+    batch_mode = st.checkbox(
+        "まとめて分析（APIリクエストを1回にする）",
+        value=True,
+        help="全員の画像を1回のリクエストで分析します。オフにすると1人ずつ分析し、結果を届いた順に表示します",
+    )
+    scores_only = st.checkbox(
+        "スコアのみで選考（高速）",
+        value=False,
+        help="顔の形とスコアだけを求めて順位付けし、上位の人だけをあとから詳しく分析します。人数が多いときに向いています",
+    )
+    analysis_depth = TIER_SCORES if scores_only else TIER_FULL
+
+    # API利用状況（全セッション共通のレート制限）
+    with st.expander("📈 API利用状況"):
+        limiter_stats = get_rate_limiter().stats()
+        st.write(f"待ち行列: {limiter_stats['queue_depth']}件")
+        st.write(f"推定待ち時間: {limiter_stats['estimated_wait']:.0f}秒")
+        st.write(
+            f"本日の利用: {limiter_stats['used_today']}/"
+            f"{limiter_stats['requests_per_day']}回"
+        )
+        # 同じ画像の同時分析を1回にまとめて省いた呼び出し
+        st.write(f"重複をまとめた分析: {get_single_flight().stats()['avoided']}回")
+        if HEDGE_ENABLED:
+            hedging = get_model_router(MODELS_TO_TRY).hedge_stats()
+            st.write(
+                f"ヘッジ: {hedging['hedged']}/{hedging['analyses']}回"
+                f"（予備が勝った回数 {hedging['backup_won']}、"
+                f"余分な呼び出し +{hedging['cost_overhead'] * 100:.0f}%）"
+            )
+
+        # 処理段階ごとの平均時間（FENGSHUI_METRICS=1 のときのみ）
+        metrics = get_metrics()
+        if metrics.enabled:
+            snapshot = metrics.snapshot()
+            for series in snapshot["histograms"].get(STAGE_SECONDS, []):
+                if series["count"]:
+                    st.write(
+                        f"{series['labels']['stage']}: "
+                        f"平均{series['sum'] / series['count'] * 1000:.0f}ms "
+                        f"({series['count']}回)"
+                    )
+            st.download_button(
+                "メトリクスをダウンロード",
+                metrics.prometheus_text(),
+                file_name="metrics.prom",
+                mime="text/plain",
+            )
+
+    # 同じ生年月日で過去に診断した候補者（総合スコア順）
+    with st.expander("📜 過去の診断結果"):
+        try:
+            history = get_result_store().query_candidates(
+                birth_date=man_birthdate, limit=10
+            )
+        except Exception as e:
+            import logging
+
+            logging.warning(f"Result store query failed: {str(e)}")
+            history = []
+        if history:
+            for row in history:
+                st.write(
+                    f"{datetime.fromtimestamp(row['created_at']):%Y-%m-%d} "
+                    f"{row['name']}: {row['total_score']}点（{row['element']}）"
+                )
+        else:
+            st.write("まだ記録がありません")
 
-with col1:
-    st.markdown("### 👩 女性A の画像")
-    woman1_image = st.file_uploader(
-        "画像をアップロード",
+# メインエリア
+st.markdown("### 👩 候補者の画像")
+GROUP_PHOTO_MODE = "集合写真（1枚）"
+photo_mode = st.radio(
+    "写真の種類",
+    ["1人ずつの写真", GROUP_PHOTO_MODE],
+    horizontal=True,
+    help="集合写真の場合は顔を自動で検出し、1人ずつ切り出して分析します",
+)
+if photo_mode == GROUP_PHOTO_MODE:
+    group_upload = st.file_uploader(
+        "集合写真をアップロード",
         type=["jpg", "jpeg", "png"],
-        key="woman1",
-        help="顔がはっきり写っている画像を選択してください",
+        key="group",
+        help="2人以上の顔が正面から写っている写真を選択してください",
     )
-
-    if woman1_image:
-        image1 = Image.open(woman1_image)
-        st.image(image1, caption="女性A", use_container_width=True)
-
-with col2:
-    st.markdown("### 👩 女性B の画像")
-    woman2_image = st.file_uploader(
-        "画像をアップロード",
+    uploaded_images = []
+else:
+    group_upload = None
+    uploaded_images = st.file_uploader(
+        "画像をアップロード（2枚以上、何枚でも可）",
         type=["jpg", "jpeg", "png"],
-        key="woman2",
+        accept_multiple_files=True,
+        key="candidates",
         help="顔がはっきり写っている画像を選択してください",
     )
 
-    if woman2_image:
-        image2 = Image.open(woman2_image)
-        st.image(image2, caption="女性B", use_container_width=True)
-
-# 分析ボタン
-st.markdown("<br>", unsafe_allow_html=True)
-analyze_button = st.button("🔮 風水診断を開始", use_container_width=True)
-
-# 分析実行
-if analyze_button:
-    if not api_key:
-        st.error("❌ Gemini APIキーを入力してください")
-    elif not woman1_image or not woman2_image:
-        st.error("❌ 両方の女性の画像をアップロードしてください")
-    else:
-        with st.spinner("🔮 風水分析中... しばらくお待ちください"):
-            try:
-                # 画像を開く
-                img1 = Image.open(woman1_image)
-                img2 = Image.open(woman2_image)
+# 1行あたりの表示列数
+GRID_COLUMNS = 4
+CARD_COLORS = ["#8B5CF6", "#EC4899", "#F59E0B", "#10B981"]
+# プレビュー用サムネイルの長辺
+THUMBNAIL_EDGE = 512
+# 1セッションが保持する画像（デコード済みピクセル）の合計の上限
+SESSION_IMAGE_BUDGET_BYTES = int(
+    float(os.environ.get("FENGSHUI_SESSION_IMAGE_MB", "64")) * 1024 * 1024
+)
 
-                # 非同期分析を同期的に実行
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
+# 分析中に届いた順に表示する項目
+STREAM_FIELD_LABELS = {
+    "face_shape": "顔の形",
+    "fortune_score": "運勢スコア",
+    "wealth_fortune_score": "金運スコア",
+    "face_shape_meaning": "意味",
+    "eyes_analysis": "目の分析",
+    "nose_analysis": "鼻の分析",
+    "mouth_analysis": "口の分析",
+    "forehead_analysis": "額の分析",
+    "ears_analysis": "耳の分析",
+    "complexion_analysis": "顔色・肌の分析",
+    "overall_impression": "全体的な印象",
+    "strengths": "強み",
+    "wealth_potential": "金運ポテンシャル",
+}
+
+
+def grid(count: int):
+    """count 個の要素を GRID_COLUMNS 列ずつ並べる列オブジェクトを返す"""
+    for start in range(0, count, GRID_COLUMNS):
+        yield from st.columns(GRID_COLUMNS)[: min(GRID_COLUMNS, count - start)]
+
+
+def upload_key(upload) -> str:
+    """アップロードを識別するキー（再実行をまたいで同じ値になる）"""
+    return getattr(upload, "file_id", None) or f"{upload.name}:{upload.size}"
+
+
+def session_image_bytes() -> int:
+    """セッションが保持している画像の合計バイト数"""
+    return sum(
+        image_nbytes(state["image"])
+        for state in st.session_state.get("uploads", {}).values()
+    )
 
-                # 両方の画像を分析
-                analysis1 = loop.run_until_complete(
-                    analyze_face_fengshui(img1, api_key, "女性A")
-                )
-                analysis2 = loop.run_until_complete(
-                    analyze_face_fengshui(img2, api_key, "女性B")
-                )
 
-                # 相性レポートの生成
-                report = generate_compatibility_report(
-                    man_age=man_age,
-                    man_birthdate=man_birthdate,
-                    woman1_analysis=analysis1,
-                    woman2_analysis=analysis2,
-                )
+def get_upload_state(key: str, source):
+    """候補者ごとのプレビュー画像と分析結果をセッションに保持する
 
-                st.markdown("## 📊 分析結果")
-
-                # 総合スコア比較
-                st.markdown("### 🏆 総合スコア比較")
-                score_col1, score_col2 = st.columns(2)
-
-                with score_col1:
-                    st.markdown(
-                        f"""
-                    <div class="card animate-fade-in">
-                        <h3 style="text-align: center; color: #8B5CF6;">女性A</h3>
-                        <div class="score-circle">{report['woman1']['total_score']}</div>
-                        <p style="text-align: center; margin-top: 1rem; font-size: 1.1rem;">
-                            五行: <strong>{report['woman1']['element']}</strong><br>
-                            相性: <strong>{report['woman1']['compatibility']['relationship']}</strong>
-                        </p>
-                    </div>
-                    """,
-                        unsafe_allow_html=True,
-                    )
+    大きな写真は長辺 WORKING_IMAGE_EDGE に縮小デコードした1枚をプレビューに使う。
+    セッションの上限を超える場合はさらに小さなプレビューだけを保持し、それも
+    収まらなければ None を返す。分析には常に元のバイト列を渡す。
+    """
+    uploads_state = st.session_state.setdefault("uploads", {})
+    if key not in uploads_state:
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+
+        used = session_image_bytes()
+        image = open_image(source, WORKING_IMAGE_EDGE)
+        if used + image_nbytes(image) > SESSION_IMAGE_BUDGET_BYTES:
+            image = open_image(image, THUMBNAIL_EDGE)
+            if used + image_nbytes(image) > SESSION_IMAGE_BUDGET_BYTES:
+                return None
+        uploads_state[key] = {"image": image, "analysis": None}
+    return uploads_state[key]
+
+
+def get_group_faces(upload) -> list:
+    """集合写真から切り出した顔タイルをセッションに保持する（最新の1枚分のみ）"""
+    key = upload_key(upload)
+    group = st.session_state.get("group_faces")
+    if group is None or group["key"] != key:
+        group = {"key": key, "tiles": extract_face_tiles(upload.getvalue())}
+        st.session_state["group_faces"] = group
+    return group["tiles"]
+
+
+# 候補者の一覧（キー・画像）を写真の種類に応じて作る
+if group_upload is not None:
+    face_tiles = get_group_faces(group_upload)
+    if not face_tiles:
+        st.warning("⚠️ 顔を検出できませんでした。正面を向いた顔が写っている写真をお試しください")
+    candidate_keys = [
+        f"{upload_key(group_upload)}#{index}" for index in range(len(face_tiles))
+    ]
+    candidate_sources = [tile.data for tile in face_tiles]
+else:
+    candidate_keys = [upload_key(upload) for upload in uploaded_images]
+    candidate_sources = list(uploaded_images)
+candidate_names = [default_candidate_name(i) for i in range(len(candidate_keys))]
+
+# 削除されたアップロードの状態を破棄
+current_keys = set(candidate_keys)
+for key in list(st.session_state.get("uploads", {})):
+    if key not in current_keys:
+        del st.session_state["uploads"][key]
+
+upload_states = []
+for key, source in zip(candidate_keys, candidate_sources):
+    state = get_upload_state(key, source)
+    if state is None:
+        st.warning(
+            f"⚠️ 画像が多すぎるため、{len(upload_states) + 1}枚目以降は読み込めませんでした"
+        )
+        break
+    upload_states.append(state)
+# 読み込めなかった候補者は除外する
+del candidate_keys[len(upload_states) :]
+del candidate_sources[len(upload_states) :]
+del candidate_names[len(upload_states) :]
+
+for column, state, name in zip(
+    grid(len(upload_states)), upload_states, candidate_names
+):
+    with column:
+        st.image(state["image"], caption=name, use_container_width=True)
+
+
+def render_report(report: dict) -> None:
+    """順位付けしたレポートを表示"""
+    candidates = report["candidates"]
+
+    st.markdown("## 📊 分析結果")
+
+    # 総合スコアランキング
+    st.markdown("### 🏆 総合スコアランキング")
+    for column, candidate in zip(grid(len(candidates)), candidates):
+        color = CARD_COLORS[candidate["index"] % len(CARD_COLORS)]
+        with column:
+            st.markdown(
+                f"""
+            <div class="card animate-fade-in">
+                <h3 style="text-align: center; color: {color};">{candidate['rank']}位 {candidate['name']}</h3>
+                <div class="score-circle">{candidate['total_score']}</div>
+                <p style="text-align: center; margin-top: 1rem; font-size: 1.1rem;">
+                    五行: <strong>{candidate['element']}</strong><br>
+                    相性: <strong>{candidate['compatibility']['relationship']}</strong>
+                </p>
+            </div>
+            """,
+                unsafe_allow_html=True,
+            )
+
+    # おすすめ表示
+    st.markdown(
+        f"""
+    <div class="result-card animate-fade-in" style="text-align: center;">
+        <h2>✨ おすすめ: {report['recommendation']}</h2>
+        <p style="font-size: 1.2rem;">2位とのスコア差: {report['score_difference']}点</p>
+    </div>
+    """,
+        unsafe_allow_html=True,
+    )
 
-                with score_col2:
-                    st.markdown(
-                        f"""
-                    <div class="card animate-fade-in">
-                        <h3 style="text-align: center; color: #EC4899;">女性B</h3>
-                        <div class="score-circle">{report['woman2']['total_score']}</div>
-                        <p style="text-align: center; margin-top: 1rem; font-size: 1.1rem;">
-                            五行: <strong>{report['woman2']['element']}</strong><br>
-                            相性: <strong>{report['woman2']['compatibility']['relationship']}</strong>
-                        </p>
-                    </div>
-                    """,
-                        unsafe_allow_html=True,
+    # 詳細分析
+    st.markdown("### 📋 詳細な顔相分析")
+
+    for column, candidate in zip(grid(len(candidates)), candidates):
+        analysis = candidate["face_analysis"]
+        with column:
+            st.markdown(f"#### {candidate['name']} の詳細")
+            with st.expander("🔍 顔相の詳細を見る", expanded=candidate["rank"] == 1):
+                st.write(f"**顔の形**: {analysis.get('face_shape', 'N/A')}")
+                if analysis_tier(analysis) == TIER_SCORES:
+                    st.write(f"**顔相スコア**: {analysis.get('fortune_score', 'N/A')}")
+                    st.write(
+                        f"**金運スコア**: {analysis.get('wealth_fortune_score', 'N/A')}"
                     )
+                    st.caption("スコアのみの簡易分析です")
+                    continue
+                st.write(f"**意味**: {analysis.get('face_shape_meaning', 'N/A')}")
+                st.write(f"**目の分析**: {analysis.get('eyes_analysis', 'N/A')}")
+                st.write(f"**鼻の分析**: {analysis.get('nose_analysis', 'N/A')}")
+                st.write(f"**口の分析**: {analysis.get('mouth_analysis', 'N/A')}")
+
+                st.markdown("**💰 金運ポテンシャル**")
+                st.info(analysis.get("wealth_potential", "N/A"))
+
+                st.markdown("**✨ 強み**")
+                for strength in analysis.get("strengths", []):
+                    st.success(f"✓ {strength}")
+
+    # 五行相性の詳細
+    st.markdown("### 🌟 五行相性の詳細")
+    for column, candidate in zip(grid(len(candidates)), candidates):
+        compatibility = candidate["compatibility"]
+        with column:
+            st.markdown(
+                f"""
+            <div class="card">
+                <h4>{candidate['name']} との相性</h4>
+                <p><strong>関係性</strong>: {compatibility['relationship']}</p>
+                <p><strong>スコア</strong>: {compatibility['score']}/100</p>
+                <p>{compatibility['description']}</p>
+            </div>
+            """,
+                unsafe_allow_html=True,
+            )
 
-                # おすすめ表示
-                st.markdown(
-                    f"""
-                <div class="result-card animate-fade-in" style="text-align: center;">
-                    <h2>✨ おすすめ: {report['recommendation']}</h2>
-                    <p style="font-size: 1.2rem;">スコア差: {report['score_difference']}点</p>
-                </div>
-                """,
-                    unsafe_allow_html=True,
-                )
-
-                # 詳細分析
-                st.markdown("### 📋 詳細な顔相分析")
 
-                detail_col1, detail_col2 = st.columns(2)
+def analysis_input(index: int):
+    """分析に渡す画像（元のバイト列）"""
+    # 縮小デコードを含む前処理は分析側で行い、キャッシュの指紋も元のバイト列から取る
+    source = candidate_sources[index]
+    return source if isinstance(source, bytes) else source.getvalue()
 
-                with detail_col1:
-                    st.markdown("#### 女性A の詳細")
-                    with st.expander("🔍 顔相の詳細を見る", expanded=True):
-                        st.write(f"**顔の形**: {analysis1.get('face_shape', 'N/A')}")
-                        st.write(
-                            f"**意味**: {analysis1.get('face_shape_meaning', 'N/A')}"
-                        )
-                        st.write(
-                            f"**目の分析**: {analysis1.get('eyes_analysis', 'N/A')}"
-                        )
-                        st.write(
-                            f"**鼻の分析**: {analysis1.get('nose_analysis', 'N/A')}"
-                        )
-                        st.write(
-                            f"**口の分析**: {analysis1.get('mouth_analysis', 'N/A')}"
-                        )
 
-                        st.markdown("**💰 金運ポテンシャル**")
-                        st.info(analysis1.get("wealth_potential", "N/A"))
+# 分析ボタン
+st.markdown("<br>", unsafe_allow_html=True)
+analyze_button = st.button("🔮 風水診断を開始", use_container_width=True)
 
-                        st.markdown("**✨ 強み**")
-                        for strength in analysis1.get("strengths", []):
-                            st.success(f"✓ {strength}")
+# 分析実行（分析済みの画像は再分析しない）
+if analyze_button:
+    if not api_key:
+        st.error("❌ Gemini APIキーを入力してください")
+    elif len(candidate_keys) < 2:
+        st.error("❌ 2名以上の画像をアップロードしてください（集合写真の場合は2人以上の顔が必要です）")
+    else:
+        queue_status = st.empty()
+
+        def show_queue_wait(reservation) -> None:
+            """混雑時に待ち順と推定待ち時間を表示"""
+            queue_status.info(
+                f"⏳ 混雑しています: {reservation.position}番目 "
+                f"(約{reservation.wait_seconds:.0f}秒お待ちください)"
+            )
+
+        # 詳細な分析を選んだ場合は、スコアのみの分析だった人も分析し直す
+        pending = [
+            index
+            for index, state in enumerate(upload_states)
+            if state["analysis"] is None
+            or is_failed_analysis(state["analysis"])
+            or (not scores_only and analysis_tier(state["analysis"]) == TIER_SCORES)
+        ]
 
-                with detail_col2:
-                    st.markdown("#### 女性B の詳細")
-                    with st.expander("🔍 顔相の詳細を見る", expanded=True):
-                        st.write(f"**顔の形**: {analysis2.get('face_shape', 'N/A')}")
-                        st.write(
-                            f"**意味**: {analysis2.get('face_shape_meaning', 'N/A')}"
-                        )
-                        st.write(
-                            f"**目の分析**: {analysis2.get('eyes_analysis', 'N/A')}"
-                        )
-                        st.write(
-                            f"**鼻の分析**: {analysis2.get('nose_analysis', 'N/A')}"
-                        )
-                        st.write(
-                            f"**口の分析**: {analysis2.get('mouth_analysis', 'N/A')}"
+        with st.spinner("🔮 風水分析中... しばらくお待ちください"):
+            try:
+                images = [analysis_input(index) for index in pending]
+                names = [candidate_names[index] for index in pending]
+
+                if batch_mode or group_upload is not None or scores_only:
+                    # 未分析の画像を1回のリクエストでまとめて分析する
+                    # （集合写真は切り出した全員を常に1回で分析する。
+                    # ストリーミング表示は詳細な分析のみ）
+                    analyses = asyncio.run(
+                        analyze_faces_batched(
+                            images,
+                            api_key,
+                            names,
+                            on_queue_wait=show_queue_wait,
+                            max_batch_size=(
+                                len(images)
+                                if group_upload is not None
+                                else DEFAULT_MAX_BATCH_SIZE
+                            ),
+                            tier=analysis_depth,
                         )
-
-                        st.markdown("**💰 金運ポテンシャル**")
-                        st.info(analysis2.get("wealth_potential", "N/A"))
-
-                        st.markdown("**✨ 強み**")
-                        for strength in analysis2.get("strengths", []):
-                            st.success(f"✓ {strength}")
-
-                # 五行相性の詳細
-                st.markdown("### 🌟 五行相性の詳細")
-                compat_col1, compat_col2 = st.columns(2)
-
-                with compat_col1:
-                    st.markdown(
-                        f"""
-                    <div class="card">
-                        <h4>女性A との相性</h4>
-                        <p><strong>関係性</strong>: {report['woman1']['compatibility']['relationship']}</p>
-                        <p><strong>スコア</strong>: {report['woman1']['compatibility']['score']}/100</p>
-                        <p>{report['woman1']['compatibility']['description']}</p>
-                    </div>
-                    """,
-                        unsafe_allow_html=True,
-                    )
-
-                with compat_col2:
-                    st.markdown(
-                        f"""
-                    <div class="card">
-                        <h4>女性B との相性</h4>
-                        <p><strong>関係性</strong>: {report['woman2']['compatibility']['relationship']}</p>
-                        <p><strong>スコア</strong>: {report['woman2']['compatibility']['score']}/100</p>
-                        <p>{report['woman2']['compatibility']['description']}</p>
-                    </div>
-                    """,
-                        unsafe_allow_html=True,
                     )
+                else:
+                    # 未分析の画像を同時に分析し、届いた項目から順に表示する
+                    progress_area = st.empty()
+                    with progress_area.container():
+                        st.markdown("### ⏳ 分析中の結果")
+                        field_slots = []
+                        for column, name in zip(grid(len(images)), names):
+                            with column:
+                                st.markdown(f"#### {name}")
+                                field_slots.append(
+                                    {key: st.empty() for key in STREAM_FIELD_LABELS}
+                                )
+
+                    analyses = [{} for _ in images]
+
+                    async def collect_analyses() -> None:
+                        async for index, key, value in stream_faces_concurrently(
+                            images, api_key, names, on_queue_wait=show_queue_wait
+                        ):
+                            analyses[index][key] = value
+                            if key in field_slots[index]:
+                                if isinstance(value, list):
+                                    value = "、".join(str(item) for item in value)
+                                field_slots[index][key].write(
+                                    f"**{STREAM_FIELD_LABELS[key]}**: {value}"
+                                )
+
+                    asyncio.run(collect_analyses())
+                    progress_area.empty()
+                queue_status.empty()
+
+                for index, analysis in zip(pending, analyses):
+                    upload_states[index]["analysis"] = analysis
+                # 再実行のたびに記録しないよう、分析した回だけ履歴に保存する
+                st.session_state["save_report"] = True
+
+            except QuotaExceededError as e:
+                queue_status.empty()
+                st.warning(
+                    f"⏳ ただいま混雑しています。約{max(1, round(e.estimated_wait / 60))}分後に"
+                    "もう一度お試しください"
+                )
 
             except Exception as e:
                 import logging
                 import traceback
 
-                # エラーログに記録
-                logging.basicConfig(
-                    filename="c:/opt/data/ai/fengshui/error.log",
-                    level=logging.ERROR,
-                    format="%(asctime)s - %(levelname)s - %(message)s",
-                    encoding="utf-8",
-                )
+                # エラーログに記録（出力先は configure_logging で設定済み）
                 error_msg = f"Analysis failed: {str(e)}\n{traceback.format_exc()}"
                 logging.error(error_msg)
 
@@ -437,6 +661,46 @@ if analyze_button:
                 st.info("💡 APIキーが正しいか、画像が適切か確認してください")
                 st.warning("⚠️ 詳細なエラー情報は error.log ファイルに記録されました")
 
+# 結果表示（サイドバーの変更などで再実行されても、保持した分析結果から再計算する）
+if len(upload_states) >= 2 and all(state["analysis"] for state in upload_states):
+    # 全候補者を一度にスコアリングして順位付け
+    report = rank_candidates(
+        man_age=man_age,
+        man_birthdate=man_birthdate,
+        analyses=[state["analysis"] for state in upload_states],
+        names=candidate_names,
+    )
+    if st.session_state.pop("save_report", False):
+        save_report_history(report, man_birthdate, candidate_sources)
+
+    # スコアのみで順位付けした場合は、上位の人だけを詳しく分析できる
+    detail_targets = select_detail_candidates(report, DEFAULT_DETAIL_TOP)
+    if detail_targets and st.button(
+        f"🔎 上位{len(detail_targets)}人を詳しく分析", use_container_width=True
+    ):
+        with st.spinner("🔮 上位の候補者を詳しく分析中..."):
+            try:
+                detailed = asyncio.run(
+                    analyze_top_candidates(
+                        report,
+                        [analysis_input(i) for i in range(len(upload_states))],
+                        api_key,
+                        DEFAULT_DETAIL_TOP,
+                    )
+                )
+            except QuotaExceededError as e:
+                detailed = {}
+                st.warning(
+                    f"⏳ ただいま混雑しています。約{max(1, round(e.estimated_wait / 60))}分後に"
+                    "もう一度お試しください"
+                )
+        if detailed:
+            for index, analysis in detailed.items():
+                upload_states[index]["analysis"] = analysis
+            st.session_state["save_report"] = True
+            st.rerun()
+    render_report(report)
+
 # フッター
 st.markdown("<br><br>", unsafe_allow_html=True)
 st.markdown(
@@ -0,0 +1,86 @@
+"""
+途中で切れた応答の解析の回帰テスト
+Regression tests: truncated replies must not be accepted as analyses
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import fengshui_analyzer as fa  # noqa: E402
+from analysis_json import AnalysisParseError  # noqa: E402
+
+FULL_ANALYSIS = {
+    "face_shape": "卵型",
+    "face_shape_meaning": "バランスの取れた運勢です。",
+    "eyes_analysis": "目元は穏やかです。",
+    "nose_analysis": "鼻筋が通っています。",
+    "mouth_analysis": "口角が上がっています。",
+    "forehead_analysis": "額が広いです。",
+    "ears_analysis": "耳たぶがふっくらしています。",
+    "complexion_analysis": "血色が良いです。",
+    "fortune_score": 78,
+    "wealth_fortune_score": 72,
+    "overall_impression": "明るく安定した運勢です。",
+    "strengths": ["協調性が高い"],
+    "wealth_potential": "堅実に資産を築けます。",
+}
+
+
+def _truncated(text: str, before: str) -> str:
+    """before の直前で切れた応答"""
+    return text[: text.index(before)]
+
+
+def test_complete_reply_is_accepted():
+    text = json.dumps(FULL_ANALYSIS, ensure_ascii=False)
+    assert fa._parse_analysis_text(text)["wealth_fortune_score"] == 72
+
+
+def test_reply_missing_only_closing_brace_is_accepted():
+    text = json.dumps(FULL_ANALYSIS, ensure_ascii=False)
+    assert fa._parse_analysis_text(text[:-1])["fortune_score"] == 78
+
+
+@pytest.mark.parametrize(
+    "cut", ['"wealth_fortune_score"', '"fortune_score"', '"strengths"', "耳たぶ"]
+)
+def test_truncated_reply_is_rejected(cut):
+    # 修復すればJSONとしては読めるが、項目が欠けているので成功扱いにしない
+    text = "以下が分析結果です。\n" + _truncated(
+        json.dumps(FULL_ANALYSIS, ensure_ascii=False), cut
+    )
+    with pytest.raises(AnalysisParseError):
+        fa._parse_analysis_text(text)
+
+
+def test_unreadable_score_is_rejected():
+    analysis = dict(FULL_ANALYSIS, wealth_fortune_score="不明")
+    with pytest.raises(AnalysisParseError):
+        fa._parse_analysis_text(json.dumps(analysis, ensure_ascii=False))
+
+
+def test_scores_tier_requires_only_scores():
+    text = json.dumps(
+        {"face_shape": "丸顔", "fortune_score": "85点", "wealth_fortune_score": 60},
+        ensure_ascii=False,
+    )
+    analysis = fa._parse_analysis_text(text, fa.TIER_SCORES)
+    assert analysis["fortune_score"] == 85
+    assert fa.analysis_tier(analysis) == fa.TIER_SCORES
+    with pytest.raises(AnalysisParseError):
+        fa._parse_analysis_text(_truncated(text, '"wealth'), fa.TIER_SCORES)
+
+
+def test_truncated_batch_item_is_dropped():
+    items = [
+        {"index": 0, **FULL_ANALYSIS},
+        {"index": 1, "face_shape": "丸顔", "fortune_score": 80},
+    ]
+    analyses = fa._complete_batch_items(items, 2)
+    assert list(analyses) == [0]
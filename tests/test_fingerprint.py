@@ -0,0 +1,29 @@
+"""
+画像指紋のテスト
+Tests for image_fingerprint
+"""
+
+import io
+import os
+import sys
+
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import fengshui_analyzer as fa  # noqa: E402
+
+
+def test_bytes_and_file_objects_match():
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), (10, 20, 30)).save(buffer, format="PNG")
+    data = buffer.getvalue()
+    assert fa.image_fingerprint(data) == fa.image_fingerprint(io.BytesIO(data))
+
+
+def test_image_edited_in_place_gets_a_new_fingerprint():
+    image = Image.new("RGB", (300, 300), (200, 160, 140))
+    before = fa.image_fingerprint(image)
+    image.paste((255, 0, 0), (0, 0, 10, 10))
+    assert fa.image_fingerprint(image) != before
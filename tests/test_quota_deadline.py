@@ -0,0 +1,82 @@
+"""
+クォータ超過と分析全体の期限の優先順位のテスト
+Quota errors from the rate limiter take precedence over the analysis deadline
+"""
+
+import asyncio
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+from fake_genai import FakeBackend  # noqa: E402
+
+FakeBackend(latency=0.0, jitter=0.0).install()
+
+import fengshui_analyzer as fa  # noqa: E402
+import rate_limiter  # noqa: E402
+from rate_limiter import QuotaExceededError, RateLimiter  # noqa: E402
+
+
+@pytest.fixture
+def photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 160, 140)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """テストごとに新しいプロセス共通のレート制限を使う"""
+
+    def install(**limits) -> RateLimiter:
+        limiter = RateLimiter(**limits)
+        monkeypatch.setattr(rate_limiter, "_default_limiter", limiter)
+        return limiter
+
+    return install
+
+
+def analyze(photo: bytes, timeout: float) -> dict:
+    return asyncio.run(
+        fa.analyze_face_fengshui(
+            photo, "key", use_cache=False, coalesce=False, timeout=timeout
+        )
+    )
+
+
+def test_exhausted_daily_quota_raises_before_the_deadline(photo, limiter):
+    limiter(requests_per_minute=0, requests_per_day=1, max_wait_seconds=120)
+    assert not fa.is_failed_analysis(analyze(photo, timeout=90))
+    with pytest.raises(QuotaExceededError, match="daily request quota exhausted"):
+        analyze(photo, timeout=90)
+
+
+def test_queue_wait_over_the_limit_raises(photo, limiter):
+    limiter(requests_per_minute=1, requests_per_day=0, max_wait_seconds=30)
+    analyze(photo, timeout=90)
+    with pytest.raises(QuotaExceededError, match="request queue is full"):
+        analyze(photo, timeout=90)
+
+
+def test_queue_wait_within_the_limit_but_past_the_deadline_times_out(photo, limiter):
+    limits = limiter(requests_per_minute=1, requests_per_day=0, max_wait_seconds=120)
+    analyze(photo, timeout=90)
+    result = analyze(photo, timeout=5)
+    assert fa.is_failed_analysis(result)
+    assert "queue_wait" in result["eyes_analysis"]
+    # 期限切れの呼び出しはクォータを消費しない
+    assert limits.stats()["granted"] == 1
+
+
+def test_unbounded_queue_wait_does_not_use_up_the_deadline(photo, limiter):
+    # 一括処理（待ち時間の上限なし）では順番待ちを期限に数えない
+    limiter(requests_per_minute=60, requests_per_day=0, max_wait_seconds=float("inf"))
+    analyze(photo, timeout=90)
+    assert not fa.is_failed_analysis(analyze(photo, timeout=0.5))
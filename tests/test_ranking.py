@@ -0,0 +1,46 @@
+"""
+候補者の順位付けのテスト
+Tests for rank_candidates
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import fengshui_analyzer as fa  # noqa: E402
+
+BIRTHDATE = datetime(1994, 1, 1)
+
+
+def _analysis(fortune: int, wealth: int) -> dict:
+    return {
+        "face_shape": "卵型",
+        "fortune_score": fortune,
+        "wealth_fortune_score": wealth,
+    }
+
+
+def test_ranking_does_not_depend_on_upload_order():
+    analyses = [_analysis(70, 80), _analysis(75, 70), _analysis(60, 65)]
+    names = ["A", "B", "C"]
+    forward = fa.rank_candidates(30, BIRTHDATE, analyses, names)
+    backward = fa.rank_candidates(30, BIRTHDATE, analyses[::-1], names[::-1])
+
+    def summary(report: dict) -> list:
+        return [
+            (c["name"], c["element"], c["total_score"]) for c in report["candidates"]
+        ]
+
+    assert summary(forward) == summary(backward)
+
+
+@pytest.mark.parametrize("field", ["names", "images"])
+def test_length_mismatch_is_rejected(field):
+    analyses = [_analysis(70, 80), _analysis(75, 70), _analysis(60, 65)]
+    with pytest.raises(ValueError):
+        fa.rank_candidates(30, BIRTHDATE, analyses, **{field: [None, None]})